@@ -0,0 +1,255 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+import numpy as np
+import pandas as pd
+from data import query_source
+from metrics import DURATION_BUCKETS, Counter, Gauge, Histogram
+from rollups import ROLLUPS, row_positions
+from sampling import PROGRESSIVE, get_sample
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Requests scanning more hourly rows than this are answered from the sample
+# only, or rejected without one
+MAX_QUERY_ROWS = int(os.environ.get("MTA_MAX_QUERY_ROWS", 50_000_000))
+# Scans of more hourly rows than this are heavy queries
+HEAVY_QUERY_ROWS = int(os.environ.get("MTA_HEAVY_QUERY_ROWS", 2_000_000))
+# Heavy queries running at once in a process; others wait for one to finish
+MAX_HEAVY_QUERIES = int(os.environ.get("MTA_MAX_HEAVY_QUERIES", 2))
+# Seconds a heavy query waits to run before it is turned away
+ADMISSION_TIMEOUT = float(os.environ.get("MTA_ADMISSION_TIMEOUT", 10))
+# Responses estimated larger than this draw the ridership trend coarser
+MAX_PAYLOAD_BYTES = int(os.environ.get("MTA_MAX_PAYLOAD_BYTES", 1_000_000))
+
+# Resolutions of the ridership trend as (pandas frequency, hours, label),
+# finest first
+RESOLUTIONS = [
+    ("h", 1, "hour"),
+    ("6h", 6, "6 hours"),
+    ("D", 24, "day"),
+    ("W", 168, "week"),
+]
+# Response size model, measured with MTA_MEASURE_PAYLOADS and typed arrays:
+# layout and traces of a figure, one point of the trend, and the map,
+# tables and per-station arrays of one station
+BYTES_PER_FIGURE = 4_000
+BYTES_PER_POINT = 10
+BYTES_PER_STATION = 500
+
+ADMISSIONS = Counter(
+    "mta_admission_decisions_total", "Admission decisions of range queries."
+)
+HEAVY_QUERIES = Gauge("mta_heavy_queries_running", "Heavy queries running.")
+ADMISSION_WAIT = Histogram(
+    "mta_admission_wait_seconds",
+    "Time heavy queries waited to run.",
+    DURATION_BUCKETS,
+)
+
+_heavy_slots = BoundedSemaphore(MAX_HEAVY_QUERIES)
+_running = 0
+_running_lock = Lock()
+
+
+def _range_hours(start_date, end_date):
+    hours = (pd.Timestamp(end_date) - pd.Timestamp(start_date)) / pd.Timedelta(hours=1)
+    return max(int(np.floor(hours)) + 1, 0)
+
+
+def estimate_payload(hours, series, stations, figures, resolution_hours=1):
+    """Estimated size in bytes of the outputs of a range."""
+    points = int(np.ceil(hours / resolution_hours)) * series
+    return (
+        figures * BYTES_PER_FIGURE
+        + points * BYTES_PER_POINT
+        + stations * BYTES_PER_STATION
+    )
+
+
+def estimate_cost(data, start_date, end_date, filters, figures):
+    """
+    Estimated cost of a request: the hourly rows in its range, where its
+    aggregations are read from, the figures built and the size of the
+    response. Every row of the range is read by a scan, whatever the fare
+    filters keep. With a query service backend the raw rows are not here,
+    so the rows are bounded by one per station, payment method and fare
+    class per hour.
+    """
+    hours = _range_hours(start_date, end_date)
+    stations = len(data["stations_df"])
+    ridership_df = data.get("ridership_df")
+    if ridership_df is not None:
+        first, last = row_positions(
+            ridership_df["transit_timestamp"].to_numpy(),
+            pd.Timestamp(start_date),
+            pd.Timestamp(end_date),
+            inclusive=True,
+        )
+        rows = last - first
+        source = query_source(start_date, end_date, data["version"], filters)
+    else:
+        rows = hours * stations * len(data["fare_class_ridership_df"])
+        # The query service answers unfiltered ranges from its rollups
+        source = "rollups" if ROLLUPS and not any((filters or {}).values()) else "rows"
+    series = len(data["hourly_ridership_df"].columns) - 1
+    return {
+        "hours": hours,
+        "rows": int(rows),
+        "source": source,
+        "series": series,
+        "stations": stations,
+        "figures": figures,
+        "payload": estimate_payload(hours, series, stations, figures),
+    }
+
+
+def combine_costs(costs):
+    """
+    Cost of loading several ranges together, such as a range and its
+    baseline: the rows scanned add up and the trend gets a series for each
+    range after the first.
+    """
+    scans = [cost for cost in costs if cost["source"] == "rows"]
+    combined = {
+        **costs[0],
+        "rows": sum(cost["rows"] for cost in scans) if scans else costs[0]["rows"],
+        "source": "rows" if scans else costs[0]["source"],
+        "series": costs[0]["series"] + len(costs) - 1,
+    }
+    combined["payload"] = estimate_payload(
+        combined["hours"],
+        combined["series"],
+        combined["stations"],
+        combined["figures"],
+    )
+    return combined
+
+
+def _can_sample(data):
+    if not PROGRESSIVE:
+        return False
+    # The query service keeps its own sample
+    return "ridership_df" not in data or get_sample(data["version"]) is not None
+
+
+def plan_query(data, cost):
+    """
+    Decide how to answer a request from its estimated cost. The decision is
+    "admitted", "sampled" when its scan is too large to run and it is
+    answered from the sample only, or "rejected" when there is no sample.
+    Heavy queries run under heavy_slot, and the ridership trend is drawn at
+    the finest of RESOLUTIONS that keeps the response under MAX_PAYLOAD_BYTES.
+    """
+    scans = cost["source"] == "rows"
+    decision = "admitted"
+    if scans and cost["rows"] > MAX_QUERY_ROWS:
+        decision = "sampled" if _can_sample(data) else "rejected"
+    for resolution in RESOLUTIONS:
+        payload = estimate_payload(
+            cost["hours"],
+            cost["series"],
+            cost["stations"],
+            cost["figures"],
+            resolution[1],
+        )
+        if payload <= MAX_PAYLOAD_BYTES:
+            break
+    plan = {
+        "decision": decision,
+        "heavy": scans and cost["rows"] > HEAVY_QUERY_ROWS,
+        "resolution": resolution,
+        "rows": cost["rows"],
+    }
+    logger.debug("Admission plan %s for cost %s", plan, cost)
+    return plan
+
+
+@contextmanager
+def heavy_slot(heavy=True):
+    """
+    Hold one of the MAX_HEAVY_QUERIES slots of the process while a heavy
+    query runs. Yields whether a slot was taken within ADMISSION_TIMEOUT;
+    light queries always run.
+    """
+    global _running
+    if not heavy:
+        yield True
+        return
+    start = time.perf_counter()
+    acquired = _heavy_slots.acquire(timeout=ADMISSION_TIMEOUT)
+    ADMISSION_WAIT.observe(time.perf_counter() - start)
+    if not acquired:
+        ADMISSIONS.inc(decision="busy")
+        logger.warning("No slot for a heavy query after %.0fs", ADMISSION_TIMEOUT)
+        yield False
+        return
+    with _running_lock:
+        _running += 1
+        HEAVY_QUERIES.set(_running)
+    try:
+        yield True
+    finally:
+        with _running_lock:
+            _running -= 1
+            HEAVY_QUERIES.set(_running)
+        _heavy_slots.release()
+
+
+def coarsen_trend(hourly_ridership_df, resolution):
+    """Ridership trend summed over the periods of a resolution."""
+    freq, hours, _ = resolution
+    if hours == 1:
+        return hourly_ridership_df
+    return (
+        hourly_ridership_df.resample(freq, on="transit_timestamp").sum().reset_index()
+    )
+
+
+def coarsen(new_data, resolution):
+    """
+    Processed data with the ridership trend summed over the periods of a
+    resolution, keyed apart in the plot cache. The data is not modified.
+    """
+    freq, hours, _ = resolution
+    if hours == 1:
+        return new_data
+    coarse = {
+        **new_data,
+        "hourly_ridership_df": coarsen_trend(
+            new_data["hourly_ridership_df"], resolution
+        ),
+    }
+    if new_data.get("cache_key"):
+        coarse["cache_key"] = (*new_data["cache_key"], freq)
+    return coarse
+
+
+def admission_note(plan, busy=False):
+    """Message telling the user how a request was limited, or ""."""
+    notes = []
+    if busy:
+        notes.append(
+            "The dashboard is busy with other large queries, please try again "
+            "in a moment or select a shorter range."
+        )
+    elif plan["decision"] == "sampled":
+        notes.append(
+            f"This range reads about {plan['rows']:,} hourly rows, more than "
+            f"the {MAX_QUERY_ROWS:,} an exact query may read, so it is answered "
+            "from a sample."
+        )
+    elif plan["decision"] == "rejected":
+        notes.append(
+            f"This range reads about {plan['rows']:,} hourly rows, more than "
+            f"the {MAX_QUERY_ROWS:,} a query may read, please select a shorter "
+            "range."
+        )
+    if plan["resolution"][1] > 1 and plan["decision"] != "rejected" and not busy:
+        notes.append(
+            f"Ridership over time is shown per {plan['resolution'][2]} to keep "
+            "the page light."
+        )
+    return " ".join(notes)
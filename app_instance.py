@@ -1,21 +1,54 @@
+import os
 import dash
 import dash_bootstrap_components as dbc
-import logging
+from importlib.util import find_spec
 from data import get_processed_data
 from visualizer import get_all_plots
+from serializer import configure_json_engine
+from http_hooks import register_http_hooks
+from metrics import register_metrics_route
+from export import register_export_route
+from heatmap_tiles import register_heatmap_route
+from spatial_index import build_station_index, register_station_index
+from log_config import setup_logging
+from warmup import register_warmup
 
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
-app.title = "MTA Subway Ridership Dashboard"
+# Compress responses with gzip/brotli when flask-compress is installed
+COMPRESS = find_spec("flask_compress") is not None
+# URL of the query service; when set, data is fetched from it instead of
+# being loaded and aggregated in this process
+BACKEND_URL = os.environ.get("MTA_BACKEND_URL")
 
-# Set up the logger
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler()],  # Log to the console
+app = dash.Dash(
+    __name__, external_stylesheets=[dbc.themes.BOOTSTRAP], compress=COMPRESS
 )
+app.title = "MTA Subway Ridership Dashboard"
+
+# Set up the logger (level and format from MTA_LOG_LEVEL / MTA_LOG_FORMAT)
+setup_logging()
+
+configure_json_engine()
 
 # Load data
-data = get_processed_data()
+if BACKEND_URL:
+    from query_client import QueryClient
+
+    backend = QueryClient(BACKEND_URL)
+    data = backend.get_processed_data()
+else:
+    backend = None
+    data = get_processed_data()
+
+# Index the stations of the full range for the map's viewport and
+# nearest-station queries
+register_station_index(build_station_index(data["stations_df"]))
 
 # Generate plots
 plots = get_all_plots(data)
+
+register_http_hooks(app, data["version"])
+register_metrics_route(app)
+register_export_route(app, data, backend)
+register_heatmap_route(app, data, backend)
+if backend is None:
+    register_warmup(app, data)
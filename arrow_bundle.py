@@ -0,0 +1,61 @@
+import json
+import pandas as pd
+import pyarrow as pa
+from serializer import encode
+
+MIME_TYPE = "application/vnd.apache.arrow.stream"
+# Compress IPC buffers when the build of pyarrow supports it
+COMPRESSION = "zstd" if pa.Codec.is_available("zstd") else None
+
+
+def _frame_to_ipc(df):
+    table = pa.Table.from_pandas(df)
+    sink = pa.BufferOutputStream()
+    options = pa.ipc.IpcWriteOptions(compression=COMPRESSION)
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_bundle(results):
+    """
+    Encode a dict of results as one Arrow IPC stream: one row per DataFrame,
+    holding the frame's own IPC stream, with all other values as JSON in the
+    schema metadata.
+    """
+    names, payloads, values = [], [], {}
+    for name, value in results.items():
+        if isinstance(value, pd.DataFrame):
+            names.append(name)
+            payloads.append(_frame_to_ipc(value))
+        else:
+            values[name] = value
+    metadata = {b"keys": json.dumps(list(results)), b"values": encode(values)}
+    table = pa.table(
+        {
+            "name": pa.array(names, pa.string()),
+            "frame": pa.array(payloads, pa.binary()),
+        },
+        metadata=metadata,
+    )
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def decode_bundle(payload):
+    """Decode a bundle written by encode_bundle back into a dict of results."""
+    table = pa.ipc.open_stream(payload).read_all()
+    metadata = table.schema.metadata
+    values = json.loads(metadata[b"values"])
+    frames = {
+        name: pa.ipc.open_stream(frame).read_all().to_pandas()
+        for name, frame in zip(
+            table.column("name").to_pylist(), table.column("frame").to_pylist()
+        )
+    }
+    return {
+        name: frames[name] if name in frames else values[name]
+        for name in json.loads(metadata[b"keys"])
+    }
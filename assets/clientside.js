@@ -0,0 +1,281 @@
+// Clientside callbacks for chart interactions that don't need the server.
+// They work on the compact per-station arrays in the station-series-store.
+
+function sumColumns(rows, width) {
+    var totals = new Array(width).fill(0);
+    rows.forEach(function (row) {
+        for (var j = 0; j < width; j++) {
+            totals[j] += row[j];
+        }
+    });
+    return totals;
+}
+
+// Row of a station in the series arrays and the stations stats table, or -1
+function stationPosition(series, station) {
+    if (!station || !Object.prototype.hasOwnProperty.call(series.positions, station)) {
+        return -1;
+    }
+    return series.positions[station];
+}
+
+function selectSeries(station, series, figure, valuesKey, categoriesKey) {
+    if (!series || !figure) {
+        return window.dash_clientside.no_update;
+    }
+    var categories = series[categoriesKey];
+    var index = stationPosition(series, station);
+    var values =
+        index >= 0
+            ? series[valuesKey][index]
+            : sumColumns(series[valuesKey], categories.length);
+
+    var trace = Object.assign({}, figure.data[0], { x: categories, y: values });
+    return Object.assign({}, figure, { data: [trace] });
+}
+
+function stationProfileFigure(station, series, index) {
+    return {
+        data: [
+            {
+                type: "bar",
+                x: Array.from({ length: 24 }, function (_, hour) { return hour; }),
+                y: series.hourly[index],
+                name: "By hour",
+                xaxis: "x",
+                yaxis: "y",
+            },
+            {
+                type: "bar",
+                x: series.days,
+                y: series.daily[index],
+                name: "By day",
+                xaxis: "x2",
+                yaxis: "y2",
+            },
+        ],
+        layout: {
+            title: { text: station + " ridership profile" },
+            xaxis: { domain: [0, 0.48], title: { text: "Hour of Day" } },
+            yaxis: { title: { text: "Number of Riders" } },
+            xaxis2: { domain: [0.52, 1], title: { text: "Day of the Week" } },
+            yaxis2: { anchor: "x2" },
+            showlegend: false,
+            height: 350,
+        },
+    };
+}
+
+// Milliseconds of a Plotly date axis value, read as UTC like Plotly does
+function dateToMs(value) {
+    if (typeof value === "number") {
+        return value;
+    }
+    var text = String(value).replace(" ", "T");
+    return Date.parse(text.length === 10 ? text + "T00:00Z" : text + "Z");
+}
+
+// [lo, hi] of an axis zoomed or panned to in relayoutData, or null
+function relayoutRange(relayoutData, axis) {
+    if (!relayoutData) {
+        return null;
+    }
+    if (relayoutData[axis + ".range[0]"] !== undefined) {
+        return [relayoutData[axis + ".range[0]"], relayoutData[axis + ".range[1]"]];
+    }
+    return relayoutData[axis + ".range"] || null;
+}
+
+// Level of a tile pyramid axis with no more image pixels than screen pixels
+function tileLevel(levels, cells, pixels) {
+    var cellsPerPixel = Math.max(cells / Math.max(pixels, 1), 1);
+    return Math.max(levels - Math.ceil(Math.log2(cellsPerPixel)), 0);
+}
+
+// Layout images of the heatmap tiles covering the hours and rows in view
+function heatmapImages(tiles, hours, rows, width, height) {
+    var level = Math.max(
+        tileLevel(tiles.levels[0], hours[1] - hours[0], width),
+        tileLevel(tiles.levels[1], rows[1] - rows[0], height)
+    );
+    // Hours and rows per pixel at the level
+    var fx = Math.pow(2, Math.max(tiles.levels[0] - level, 0));
+    var fy = Math.pow(2, Math.max(tiles.levels[1] - level, 0));
+    var spanX = tiles.size * fx;
+    var spanY = tiles.size * fy;
+    var lastX = Math.ceil(tiles.hours / spanX) - 1;
+    var lastY = Math.ceil(tiles.stations / spanY) - 1;
+    var images = [];
+    var x0 = Math.max(Math.floor(hours[0] / spanX), 0);
+    var x1 = Math.min(Math.floor(hours[1] / spanX), lastX);
+    var y0 = Math.max(Math.floor(rows[0] / spanY), 0);
+    var y1 = Math.min(Math.floor(rows[1] / spanY), lastY);
+    for (var tx = x0; tx <= x1; tx++) {
+        for (var ty = y0; ty <= y1; ty++) {
+            images.push({
+                source: "/heatmap/" + level + "/" + tx + "/" + ty + ".png?" + tiles.query,
+                xref: "x",
+                yref: "y",
+                x: tiles.start + tx * spanX * 3600000,
+                y: ty * spanY,
+                sizex: spanX * 3600000,
+                sizey: spanY,
+                xanchor: "left",
+                yanchor: "top",
+                sizing: "stretch",
+                layer: "below",
+            });
+        }
+    }
+    return images;
+}
+
+// Station x hour heatmap axes with its tiles as layout images, see heatmap_tiles.py
+function heatmapFigure(tiles, images) {
+    var borders = tiles.boroughs.slice(1).map(function (borough) {
+        return {
+            type: "line",
+            xref: "paper",
+            x0: 0,
+            x1: 1,
+            y0: borough[1],
+            y1: borough[1],
+            line: { color: "white", width: 1 },
+        };
+    });
+    return {
+        // Invisible corners, so autoscaling shows the whole matrix
+        data: [
+            {
+                type: "scatter",
+                x: [tiles.start, tiles.start + tiles.hours * 3600000],
+                y: [0, tiles.stations],
+                mode: "markers",
+                marker: { opacity: 0 },
+                hoverinfo: "skip",
+                showlegend: false,
+            },
+        ],
+        layout: {
+            height: 700,
+            margin: { r: 20, t: 40, l: 120, b: 40 },
+            xaxis: { type: "date", showgrid: false },
+            yaxis: {
+                autorange: "reversed",
+                showgrid: false,
+                zeroline: false,
+                // Boroughs are labelled in the middle of their rows
+                tickvals: tiles.boroughs.map(function (borough) {
+                    return (borough[1] + borough[2]) / 2;
+                }),
+                ticktext: tiles.boroughs.map(function (borough) {
+                    return borough[0];
+                }),
+            },
+            plot_bgcolor: "white",
+            images: images,
+            shapes: borders,
+            // A new range resets the view, panning and zooming keep it
+            uirevision: tiles.query,
+        },
+    };
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    mta: {
+        stationOptions: function (series) {
+            if (!series) {
+                return [[], []];
+            }
+            var options = series.stations.map(function (station) {
+                return { label: station, value: station };
+            });
+            return [options, options];
+        },
+
+        stationWeekly: function (station, series, figure) {
+            return selectSeries(station, series, figure, "daily", "days");
+        },
+
+        stationTimeBlock: function (station, series, figure) {
+            return selectSeries(station, series, figure, "time_block", "time_blocks");
+        },
+
+        stationDetails: function (clickData, series, records) {
+            var hidden = [[], {}, { display: "none" }];
+            if (!clickData || !series || !records) {
+                return hidden;
+            }
+            var station = clickData.points[0].hovertext;
+            var index = stationPosition(series, station);
+            // The table's rows are in the order of the series' stations
+            var record = index >= 0 ? records[index] : undefined;
+            if (!record || record.Station !== station) {
+                return hidden;
+            }
+            return [
+                [record],
+                stationProfileFigure(station, series, index),
+                { display: "block" },
+            ];
+        },
+
+        boroughVisibility: function (selected, series, figure) {
+            if (!figure) {
+                return window.dash_clientside.no_update;
+            }
+            var data = figure.data.map(function (trace) {
+                // A baseline trace follows the series it is the baseline of
+                var name = (trace.meta && trace.meta.baseline_of) || trace.name;
+                var visible = selected.indexOf(name) >= 0 ? true : "legendonly";
+                return Object.assign({}, trace, { visible: visible });
+            });
+            return Object.assign({}, figure, { data: data });
+        },
+
+        exportLinks: function (startDate, endDate, paymentMethods, fareClasses, paths) {
+            var params = new URLSearchParams();
+            if (startDate && endDate) {
+                params.append("start_date", startDate);
+                params.append("end_date", endDate);
+            }
+            (paymentMethods || []).forEach(function (value) {
+                params.append("payment_method", value);
+            });
+            (fareClasses || []).forEach(function (value) {
+                params.append("fare_class_category", value);
+            });
+            var query = params.toString();
+            return paths.map(function (path) {
+                return query ? path + "?" + query : path;
+            });
+        },
+
+        heatmapTiles: function (relayoutData, tiles) {
+            if (!tiles) {
+                return window.dash_clientside.no_update;
+            }
+            var hours = [0, tiles.hours];
+            var rows = [0, tiles.stations];
+            var triggered = window.dash_clientside.callback_context.triggered;
+            var newRange = triggered.some(function (t) {
+                return t.prop_id === "heatmap-tiles-store.data";
+            });
+            var xRange = newRange ? null : relayoutRange(relayoutData, "xaxis");
+            var yRange = newRange ? null : relayoutRange(relayoutData, "yaxis");
+            if (xRange) {
+                hours = xRange.map(function (value) {
+                    return (dateToMs(value) - tiles.start) / 3600000;
+                });
+            }
+            if (yRange) {
+                rows = [Math.min(yRange[0], yRange[1]), Math.max(yRange[0], yRange[1])];
+            }
+            // Plot area of the graph, without its margins
+            var graph = document.getElementById("station-hour-heatmap");
+            var width = ((graph && graph.offsetWidth) || 1100) - 140;
+            var images = heatmapImages(tiles, hours, rows, width, 620);
+            return heatmapFigure(tiles, images);
+        },
+    },
+});
@@ -0,0 +1,45 @@
+"""
+Compare serial and parallel wall-clock time of the aggregations run by
+get_processed_data over a range of row counts.
+
+Usage: python -m benchmarks.bench_aggregations --rows 10000 100000 1000000
+"""
+
+import argparse
+import json
+import time
+from benchmarks.synthetic import make_ridership
+from data import clean_data, run_aggregations
+
+
+def time_mode(df, mode, workers, repeat):
+    """Return the best wall-clock time of running all aggregations in a mode."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run_aggregations(df, mode=mode, max_workers=workers)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--modes", nargs="+", default=["serial", "thread", "process"])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for n_rows in args.rows:
+        df = clean_data(make_ridership(n_rows))
+        row = {"rows": n_rows}
+        for mode in args.modes:
+            row[mode] = round(time_mode(df, mode, args.workers, args.repeat), 4)
+        if "serial" in row:
+            for mode in args.modes:
+                row[f"{mode}_speedup"] = round(row["serial"] / row[mode], 2)
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
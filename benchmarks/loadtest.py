@@ -0,0 +1,511 @@
+"""
+Load-test the dashboard with concurrent simulated users. Each session loads
+the page, then repeatedly loads a random date range (sometimes with fare
+filters) and clicks random stations on the map, with think time between
+actions. Reports throughput and p50/p95/p99 latency per callback and the
+server's RSS over time, read from /metrics.
+
+Usage:
+    python -m benchmarks.loadtest --serve --rows 1000000 --users 20 --duration 120
+    python -m benchmarks.loadtest --url http://127.0.0.1:8050 --users 50
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+import requests
+from benchmarks.synthetic import write_ridership
+from helper import get_code_version
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_URL = "http://127.0.0.1:8050"
+RSS_METRIC = re.compile(r"^mta_process_resident_memory_bytes (\S+)$", re.MULTILINE)
+PERCENTILES = (50, 95, 99)
+
+# Server callbacks driven by the sessions, by the component property that
+# triggers them; station details are drawn in the browser, so a station
+# click only reaches the server through show_nearby_stations
+CALLBACK_TRIGGERS = {
+    "on_page_load": "url.pathname",
+    "update_graph": "load-button.n_clicks",
+    "update_graph_exact": "exact-request-store.data",
+    "show_nearby_stations": "station-map-view.clickData",
+}
+
+
+def _parse_outputs(output):
+    """Outputs of a callback as the renderer sends them, from its output key."""
+    outputs = []
+    for key in output.strip(".").split("..."):
+        component_id, prop = key.rsplit(".", 1)
+        outputs.append({"id": component_id, "property": prop.split("@")[0]})
+    return outputs if output.startswith("..") else outputs[0]
+
+
+def find_callbacks(session, url):
+    """Server callbacks of CALLBACK_TRIGGERS by name, from /_dash-dependencies."""
+    dependencies = session.get(url + "/_dash-dependencies").json()
+    callbacks = {}
+    for name, trigger in CALLBACK_TRIGGERS.items():
+        for dependency in dependencies:
+            inputs = [f"{i['id']}.{i['property']}" for i in dependency["inputs"]]
+            if trigger in inputs and not dependency.get("clientside_function"):
+                callbacks[name] = dependency
+                break
+        else:
+            raise RuntimeError(f"No server callback is triggered by {trigger}")
+    return callbacks
+
+
+def _find_props(node, component_id):
+    if isinstance(node, dict):
+        if node.get("props", {}).get("id") == component_id:
+            return node["props"]
+        children = node.values()
+    elif isinstance(node, list):
+        children = node
+    else:
+        return None
+    for child in children:
+        props = _find_props(child, component_id)
+        if props is not None:
+            return props
+    return None
+
+
+def _trace_values(values):
+    # Numeric arrays may be sent as base64 typed arrays, see serializer.py
+    if isinstance(values, dict) and "bdata" in values:
+        return np.frombuffer(base64.b64decode(values["bdata"]), values["dtype"])
+    return values
+
+
+def read_layout(layout):
+    """
+    Fare filter options, clickable stations (name, lat, lon) and comparison
+    options, or None without a comparison selector, of the layout.
+    """
+    options = {
+        component_id: [
+            option["value"] if isinstance(option, dict) else option
+            for option in _find_props(layout, component_id)["options"]
+        ]
+        for component_id in ("payment-method-select", "fare-class-select")
+    }
+    stations = []
+    for trace in _find_props(layout, "station-map-view")["figure"]["data"]:
+        names = trace.get("hovertext") or []
+        lat, lon = _trace_values(trace["lat"]), _trace_values(trace["lon"])
+        stations += [
+            (name, float(la), float(lo)) for name, la, lo in zip(names, lat, lon)
+        ]
+    compare = _find_props(layout, "compare-select")
+    comparisons = (
+        None
+        if compare is None
+        else [option["value"] for option in compare.get("options", [])]
+    )
+    return options, stations, comparisons
+
+
+class LoadTest:
+    """Shared state of a run: the callbacks, the layout and the timings."""
+
+    def __init__(
+        self,
+        url,
+        callbacks,
+        options,
+        stations,
+        think,
+        filter_share,
+        comparisons=None,
+        compare_share=0,
+    ):
+        self.url = url
+        self.callbacks = callbacks
+        self.options = options
+        self.stations = stations
+        self.think = think
+        self.filter_share = filter_share
+        self.comparisons = comparisons
+        self.compare_share = compare_share
+        self.lock = threading.Lock()
+        # name -> list of (end time, latency in seconds, ok)
+        self.timings = defaultdict(list)
+
+    def record(self, name, started, ok):
+        ended = time.perf_counter()
+        with self.lock:
+            self.timings[name].append((ended, ended - started, ok))
+
+    def get(self, session, name, path):
+        started = time.perf_counter()
+        try:
+            response = session.get(self.url + path)
+            ok = response.status_code in (200, 304)
+        except requests.RequestException:
+            response, ok = None, False
+        self.record(name, started, ok)
+        return response if ok else None
+
+    def call(self, session, name, inputs, state=()):
+        """POST a callback as the renderer does and return its response."""
+        dependency = self.callbacks[name]
+        body = {
+            "output": dependency["output"],
+            "outputs": _parse_outputs(dependency["output"]),
+            "inputs": inputs,
+            "state": list(state),
+            "changedPropIds": [f"{i['id']}.{i['property']}" for i in inputs],
+        }
+        started = time.perf_counter()
+        try:
+            response = session.post(self.url + "/_dash-update-component", json=body)
+            ok = response.status_code in (200, 204)
+        except requests.RequestException:
+            response, ok = None, False
+        self.record(name, started, ok)
+        return response.json()["response"] if ok and response.content else None
+
+    def pause(self, stop):
+        stop.wait(random.expovariate(1 / self.think) if self.think else 0)
+
+    def random_range(self, dates):
+        """A random range of one day to the whole dataset, in whole days."""
+        first, last = (pd.Timestamp(date).normalize() for date in dates)
+        days = max((last - first).days, 1)
+        length = random.randint(1, days)
+        start = first + pd.Timedelta(days=random.randint(0, days - length))
+        return str(start.date()), str((start + pd.Timedelta(days=length)).date())
+
+    def random_filters(self):
+        """Fare filters of one random payment method or fare class, or none."""
+        values = {"payment-method-select": None, "fare-class-select": None}
+        if random.random() < self.filter_share:
+            component_id = random.choice(list(self.options))
+            if self.options[component_id]:
+                values[component_id] = [random.choice(self.options[component_id])]
+        return values
+
+    def session(self, stop, clicks):
+        """Simulate one user until stop is set."""
+        session = requests.Session()
+        if self.get(session, "page", "/") is None:
+            return
+        self.get(session, "page_layout", "/_dash-layout")
+        page = self.call(
+            session,
+            "on_page_load",
+            [{"id": "url", "property": "pathname", "value": "/"}],
+        )
+        if page is None:
+            return
+        dates = (
+            page["date-picker-start"]["date"],
+            page["date-picker-end"]["date"],
+        )
+        n_clicks = 0
+        while not stop.is_set():
+            self.pause(stop)
+            n_clicks += 1
+            start_date, end_date = self.random_range(dates)
+            filters = self.random_filters()
+            state = [
+                {"id": "date-picker-start", "property": "date", "value": start_date},
+                {"id": "date-picker-end", "property": "date", "value": end_date},
+                *[
+                    {"id": component_id, "property": "value", "value": value}
+                    for component_id, value in filters.items()
+                ],
+            ]
+            if self.comparisons is not None:
+                comparison = None
+                if self.comparisons and random.random() < self.compare_share:
+                    comparison = random.choice(self.comparisons)
+                state.append(
+                    {"id": "compare-select", "property": "value", "value": comparison}
+                )
+            response = self.call(
+                session,
+                "update_graph",
+                [{"id": "load-button", "property": "n_clicks", "value": n_clicks}],
+                state,
+            )
+            # Approximate results are followed by exact ones, as in the browser
+            exact_load = (response or {}).get("exact-request-store", {}).get("data")
+            if exact_load and exact_load.get("request"):
+                self.call(
+                    session,
+                    "update_graph_exact",
+                    [
+                        {
+                            "id": "exact-request-store",
+                            "property": "data",
+                            "value": exact_load,
+                        }
+                    ],
+                    [{"id": "load-button", "property": "n_clicks", "value": n_clicks}],
+                )
+            for _ in range(random.randint(0, clicks)):
+                if stop.is_set() or not self.stations:
+                    break
+                self.pause(stop)
+                name, lat, lon = random.choice(self.stations)
+                point = {"hovertext": name, "lat": lat, "lon": lon}
+                self.call(
+                    session,
+                    "show_nearby_stations",
+                    [
+                        {
+                            "id": "station-map-view",
+                            "property": "clickData",
+                            "value": {"points": [point]},
+                        }
+                    ],
+                )
+
+
+def sample_rss(url, stop, interval, samples, started):
+    """Append (seconds since start, server RSS in MB) every interval seconds."""
+    session = requests.Session()
+    while not stop.is_set():
+        try:
+            match = RSS_METRIC.search(session.get(url + "/metrics").text)
+            if match:
+                samples.append(
+                    (
+                        round(time.perf_counter() - started, 1),
+                        round(float(match.group(1)) / 1024**2, 1),
+                    )
+                )
+        except requests.RequestException:
+            pass
+        stop.wait(interval)
+
+
+def summarize(timings, started, ended):
+    """Throughput and latency percentiles in ms per callback."""
+    summary = {}
+    for name, records in sorted(timings.items()):
+        latencies = np.array([latency for _, latency, ok in records if ok]) * 1000
+        errors = sum(not ok for _, _, ok in records)
+        summary[name] = {
+            "requests": len(records),
+            "errors": errors,
+            "throughput_rps": round(len(records) / (ended - started), 2),
+            **{
+                f"p{q}_ms": round(float(np.percentile(latencies, q)), 1)
+                for q in PERCENTILES
+                if len(latencies)
+            },
+            "max_ms": round(float(latencies.max()), 1) if len(latencies) else None,
+        }
+    return summary
+
+
+def run(
+    url,
+    users,
+    duration,
+    ramp,
+    think,
+    clicks,
+    filter_share,
+    rss_interval,
+    compare_share=0,
+):
+    """Run the load test against a dashboard and return the report."""
+    session = requests.Session()
+    callbacks = find_callbacks(session, url)
+    options, stations, comparisons = read_layout(
+        session.get(url + "/_dash-layout").json()
+    )
+    test = LoadTest(
+        url,
+        callbacks,
+        options,
+        stations,
+        think,
+        filter_share,
+        comparisons,
+        compare_share,
+    )
+
+    stop, rss_samples = threading.Event(), []
+    started = time.perf_counter()
+    sampler = threading.Thread(
+        target=sample_rss,
+        args=(url, stop, rss_interval, rss_samples, started),
+        daemon=True,
+    )
+    sampler.start()
+    threads = []
+    for i in range(users):
+        thread = threading.Thread(target=test.session, args=(stop, clicks), daemon=True)
+        thread.start()
+        threads.append(thread)
+        # Sessions start evenly over the ramp-up
+        stop.wait(ramp / users)
+    stop.wait(max(duration - ramp, 0))
+    stop.set()
+    for thread in threads:
+        thread.join()
+    ended = time.perf_counter()
+    sampler.join()
+
+    rss = [mb for _, mb in rss_samples]
+    return {
+        "callbacks": summarize(test.timings, started, ended),
+        "rss_mb": {
+            "start": rss[0] if rss else None,
+            "max": max(rss) if rss else None,
+            "end": rss[-1] if rss else None,
+            "samples": rss_samples,
+        },
+    }
+
+
+def serve(rows, port):
+    """
+    Start the dashboard on a synthetic dataset of rows rows in a temporary
+    directory, with a cold cache. Returns the process and the directory.
+    """
+    work_dir = tempfile.mkdtemp(prefix="mta-loadtest-")
+    os.makedirs(os.path.join(work_dir, "data"))
+    write_ridership(os.path.join(work_dir, "data", "data_11_2024.csv"), rows)
+    # Borough boundaries are not part of the synthetic dataset
+    boundaries = os.path.join(REPO_DIR, "data", "borough_boundaries.geojson")
+    target = os.path.join(work_dir, "data", "borough_boundaries.geojson")
+    if os.path.exists(boundaries):
+        shutil.copy(boundaries, target)
+    else:
+        with open(target, "w") as f:
+            json.dump({"type": "FeatureCollection", "features": []}, f)
+
+    script = (
+        "from app import app; "
+        f"app.run(port={port}, debug=False, use_reloader=False, threaded=True)"
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-c", script],
+        cwd=work_dir,
+        env={**os.environ, "PYTHONPATH": REPO_DIR},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return process, work_dir
+
+
+def wait_until_up(url, process=None, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("The dashboard exited during startup")
+        try:
+            if requests.get(url + "/_dash-layout", timeout=5).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    raise TimeoutError(f"The dashboard at {url} did not start in {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=DEFAULT_URL, help="Dashboard to test")
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Start the dashboard on a synthetic dataset of --rows rows",
+    )
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--port", type=int, default=8060)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60, help="Seconds")
+    parser.add_argument("--ramp", type=float, default=10, help="Ramp-up seconds")
+    parser.add_argument(
+        "--think", type=float, default=2, help="Mean seconds between actions"
+    )
+    parser.add_argument(
+        "--clicks", type=int, default=3, help="Most station clicks per range"
+    )
+    parser.add_argument(
+        "--filter-share",
+        type=float,
+        default=0.2,
+        help="Share of range loads with a fare filter",
+    )
+    parser.add_argument(
+        "--compare-share",
+        type=float,
+        default=0.1,
+        help="Share of range loads compared with a baseline",
+    )
+    parser.add_argument("--rss-interval", type=float, default=2, help="Seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    process = work_dir = None
+    url = args.url
+    if args.serve:
+        url = f"http://127.0.0.1:{args.port}"
+        process, work_dir = serve(args.rows, args.port)
+    try:
+        wait_until_up(url, process)
+        results = run(
+            url,
+            args.users,
+            args.duration,
+            args.ramp,
+            args.think,
+            args.clicks,
+            args.filter_share,
+            args.rss_interval,
+            args.compare_share,
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "code_version": get_code_version(),
+            "python": platform.python_version(),
+            "url": url,
+            "rows": args.rows if args.serve else None,
+            "users": args.users,
+            "duration": args.duration,
+            "think": args.think,
+        },
+        **results,
+    }
+    for name, stats in report["callbacks"].items():
+        print(name, json.dumps(stats), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Time how long a headless browser takes to draw the hourly trend chart and the
+station map in SVG and WebGL render modes over a range of point counts.
+
+Needs Playwright and a Chromium build (pip install playwright, then
+playwright install chromium), or an installed Chrome via --browser. With
+--kaleido it draws in the Chromium bundled with kaleido 0.2.1 instead.
+
+Usage:
+    python -m benchmarks.render --hours 720 8760 43800 --stations 400 5000
+    python -m benchmarks.render --kaleido --output benchmarks/render_results.json
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.io as pio
+from plotly.offline import get_plotlyjs
+import visualizer
+
+BOROUGHS = ["Bronx", "Brooklyn", "Manhattan", "Queens", "Staten Island"]
+LINE_COLORS = ["#EE352E", "#00933C", "#B933AD", "#0039A6", "#FF6319", "#6CBE45"]
+
+# Draws a figure repeat times into el and resolves with the times in
+# milliseconds, each up to the second animation frame after Plotly.newPlot
+# resolves, and the WebGL renderer the browser used
+BENCHMARK = """
+async function runBenchmark(el, figure, repeat) {
+    var times = [];
+    for (var i = 0; i < repeat; i++) {
+        Plotly.purge(el);
+        var start = performance.now();
+        await Plotly.newPlot(el, figure.data, figure.layout);
+        await new Promise(function (resolve) {
+            requestAnimationFrame(function () { requestAnimationFrame(resolve); });
+        });
+        times.push(performance.now() - start);
+    }
+    var gl = document.createElement("canvas").getContext("webgl");
+    var info = gl && gl.getExtension("WEBGL_debug_renderer_info");
+    var renderer = info ? gl.getParameter(info.UNMASKED_RENDERER_WEBGL) : null;
+    return {times: times, renderer: renderer};
+}
+"""
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><script src="plotly.min.js"></script></head>
+<body>
+<div id="plot" style="width:1200px;height:600px"></div>
+<script>
+%s
+var figure = %s;
+window.runFigure = function (repeat) {
+    return runBenchmark(document.getElementById("plot"), figure, repeat);
+};
+</script>
+</body>
+</html>
+"""
+
+# Appended to the plotly.js that Kaleido loads: figures whose layout.meta
+# carries benchmark_repeat are timed instead of exported, and the timings come
+# back in place of the image data
+KALEIDO_HOOK = """
+;(function () {
+    %s
+    var toImage = Plotly.toImage;
+    Plotly.toImage = async function (figure, options) {
+        var repeat = figure.layout.meta && figure.layout.meta.benchmark_repeat;
+        if (!repeat) return toImage(figure, options);
+        var el = document.createElement("div");
+        el.style.width = "1200px";
+        el.style.height = "600px";
+        document.body.appendChild(el);
+        var result = await runBenchmark(el, figure, repeat);
+        Plotly.purge(el);
+        el.remove();
+        return JSON.stringify(result);
+    };
+})();
+"""
+
+
+def make_hourly_ridership(n_hours, seed=0):
+    """Hourly ridership by borough in the shape of get_hourly_ridership."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "transit_timestamp": pd.date_range("2020-01-01", periods=n_hours, freq="h"),
+            **{
+                borough: rng.integers(0, 50_000, n_hours, dtype=np.int64)
+                for borough in BOROUGHS
+            },
+        }
+    )
+    df["total_ridership"] = df[BOROUGHS].sum(axis=1)
+    return df
+
+
+def make_stations(n_stations, seed=0):
+    """Stations in the shape of get_stations, spread over New York City."""
+    rng = np.random.default_rng(seed)
+    line_colors = rng.choice(LINE_COLORS, n_stations)
+    return pd.DataFrame(
+        {
+            "station_complex_id": np.arange(n_stations),
+            "station_complex": [f"Station {i}" for i in range(n_stations)],
+            "latitude": rng.uniform(40.57, 40.90, n_stations),
+            "longitude": rng.uniform(-74.05, -73.75, n_stations),
+            "borough": rng.choice(BOROUGHS, n_stations),
+            "station_size": 7,
+            "line_color": line_colors,
+            "line": [str(LINE_COLORS.index(color) + 1) for color in line_colors],
+            "ridership": rng.integers(0, 1_000_000, n_stations),
+        }
+    )
+
+
+def get_cases(hours, stations, map_style):
+    """List the figures to draw as (name, points, render mode, figure)."""
+    cases = []
+    for render_mode in ("svg", "webgl"):
+        for n_hours in hours:
+            df = make_hourly_ridership(n_hours)
+            fig = visualizer.plot_hourly_ridership(df, render_mode)
+            cases.append(
+                ("plot_hourly_ridership", n_hours * (df.shape[1] - 1), render_mode, fig)
+            )
+        for n_stations in stations:
+            fig = visualizer.plot_station_map_view(
+                make_stations(n_stations), render_mode
+            )
+            # Tiles come from the network, which would dominate the timing
+            subplot = "map" if render_mode == "webgl" else "mapbox"
+            fig.update_layout({subplot: {"style": map_style}})
+            cases.append(("plot_station_map_view", n_stations, render_mode, fig))
+    return cases
+
+
+def summarize(name, points, render_mode, fig, timing):
+    """One result row from the timings of a case."""
+    times = timing["times"]
+    result = {
+        "figure": name,
+        "render_mode": render_mode,
+        "points": points,
+        "trace_types": sorted({trace.type for trace in fig.data}),
+        "renderer": timing["renderer"],
+        "min_ms": round(min(times), 1),
+        "median_ms": round(float(np.median(times)), 1),
+    }
+    print(json.dumps(result))
+    return result
+
+
+def run_cases(cases, repeat, browser_path=None):
+    """Draw every case in headless Chromium and return the timings."""
+    from playwright.sync_api import sync_playwright
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir, sync_playwright() as playwright:
+        with open(os.path.join(tmp_dir, "plotly.min.js"), "w") as f:
+            f.write(get_plotlyjs())
+        # Software WebGL, so the run does not depend on the machine's GPU
+        browser = playwright.chromium.launch(
+            executable_path=browser_path,
+            args=["--use-angle=swiftshader", "--enable-unsafe-swiftshader"],
+        )
+        page = browser.new_page(viewport={"width": 1280, "height": 720})
+        for name, points, render_mode, fig in cases:
+            path = os.path.join(tmp_dir, "figure.html")
+            with open(path, "w") as f:
+                f.write(PAGE % (BENCHMARK, pio.to_json(fig)))
+            page.goto(f"file://{path}")
+            timing = page.evaluate("repeat => runFigure(repeat)", repeat)
+            results.append(summarize(name, points, render_mode, fig, timing))
+        browser.close()
+    return results
+
+
+def run_cases_kaleido(cases, repeat):
+    """Draw every case in Kaleido's headless Chromium and return the timings.
+
+    For machines where Playwright cannot download a browser: kaleido 0.2.1
+    installs from PyPI with its own Chromium, which renders WebGL with
+    SwiftShader.
+    """
+    from kaleido.scopes.plotly import PlotlyScope
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plotlyjs = os.path.join(tmp_dir, "plotly.min.js")
+        with open(plotlyjs, "w") as f:
+            f.write(get_plotlyjs() + KALEIDO_HOOK % BENCHMARK)
+        scope = PlotlyScope(plotlyjs=plotlyjs)
+        for name, points, render_mode, fig in cases:
+            fig = go.Figure(fig).update_layout(meta={"benchmark_repeat": repeat})
+            timing = json.loads(
+                scope.transform(fig, format="svg", width=1200, height=600)
+            )
+            results.append(summarize(name, points, render_mode, fig, timing))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hours", type=int, nargs="+", default=[720, 8760, 43800])
+    parser.add_argument("--stations", type=int, nargs="+", default=[400, 5000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--map-style", default="white-bg")
+    parser.add_argument("--browser", help="Path to a Chrome or Chromium binary")
+    parser.add_argument(
+        "--kaleido", action="store_true", help="Draw in Kaleido instead of Playwright"
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    cases = get_cases(args.hours, args.stations, args.map_style)
+    if args.kaleido:
+        results = run_cases_kaleido(cases, args.repeat)
+    else:
+        results = run_cases(cases, args.repeat, args.browser)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+Time every data.py and visualizer.py function on synthetic data and report
+wall-clock time, peak traced memory and payload size as JSON.
+
+Usage:
+    python -m benchmarks.run --rows 10000 100000 --output results.json
+    python -m benchmarks.run --rows 10000 --compare results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+import plotly
+import data
+import rollups
+import sampling
+import visualizer
+from benchmarks.synthetic import make_ridership
+from helper import get_code_version
+from serializer import encode, pack_figure
+
+# A benchmark is slower than its baseline when its time grows by this factor
+REGRESSION_THRESHOLD = 1.2
+
+
+def _copy(df):
+    return lambda: (df.copy(),)
+
+
+def _args(*args):
+    return lambda: args
+
+
+def _read_csv_args(raw, tmp_dir):
+    """Write the raw data where read_data_from_file expects it."""
+    raw.to_csv(os.path.join(tmp_dir, "data_11_2024.csv"), index=False)
+    return _args(tmp_dir + os.sep)
+
+
+def get_benchmarks(raw, tmp_dir):
+    """
+    List benchmarks as (name, function, argument factory, payload) tuples.
+    Payload marks results that are sent to the browser and get their encoded
+    size reported.
+    """
+    df = data.clean_data(raw.copy())
+    start_date, end_date = data.get_default_dates(df)
+    filtered = data.filter_data(df, start_date, end_date)
+    processed = data.run_aggregations(filtered)
+    processed["filtered_df"] = filtered
+    rollups.register_rollups("benchmark", rollups.build_rollups(df), df)
+
+    return [
+        (
+            "data.read_data_from_file",
+            data.read_data_from_file,
+            _read_csv_args(raw, tmp_dir),
+            False,
+        ),
+        ("data.clean_data", data.clean_data, _copy(raw), False),
+        ("data.get_data_version", data.get_data_version, _args(df), False),
+        ("data.get_default_dates", data.get_default_dates, _args(df), False),
+        ("data.filter_data", data.filter_data, _args(df, start_date, end_date), False),
+        ("rollups.build_rollups", rollups.build_rollups, _args(df), False),
+        ("sampling.build_sample", sampling.build_sample, _args(df), False),
+        (
+            "data.plan_inputs",
+            data.plan_inputs,
+            _args(df, start_date, end_date, "benchmark"),
+            False,
+        ),
+        (
+            "data.get_hourly_ridership",
+            data.get_hourly_ridership,
+            _args(filtered),
+            False,
+        ),
+        (
+            "data.get_weekly_ridership",
+            data.get_weekly_ridership,
+            _args(filtered),
+            False,
+        ),
+        (
+            "data.get_time_block_ridership",
+            data.get_time_block_ridership,
+            _args(filtered),
+            False,
+        ),
+        ("data.get_stations", data.get_stations, _args(filtered), False),
+        ("data.get_key_metrics", data.get_key_metrics, _args(filtered), True),
+        (
+            "data.get_stations_stats_df",
+            data.get_stations_stats_df,
+            _args(filtered),
+            True,
+        ),
+        ("data.get_borough_stats_df", data.get_borough_stats_df, _args(filtered), True),
+        ("data.get_line_stats_df", data.get_line_stats_df, _args(filtered), True),
+        ("data.run_aggregations", data.run_aggregations, _args(filtered), False),
+        (
+            "data.get_processed_data",
+            data.get_processed_data,
+            _args(df, start_date, end_date),
+            False,
+        ),
+        (
+            "visualizer.plot_hourly_ridership",
+            visualizer.plot_hourly_ridership,
+            _args(processed["hourly_ridership_df"]),
+            True,
+        ),
+        (
+            "visualizer.plot_weekly_ridership[borough]",
+            visualizer.plot_weekly_ridership,
+            _args(processed["weekly_ridership_df"], "borough"),
+            True,
+        ),
+        (
+            "visualizer.plot_weekly_ridership[station]",
+            visualizer.plot_weekly_ridership,
+            _args(processed["station_weekly_ridership_df"], "station_complex"),
+            True,
+        ),
+        (
+            "visualizer.plot_time_block_ridership[borough]",
+            visualizer.plot_time_block_ridership,
+            _args(processed["time_block_ridership_df"], "borough"),
+            True,
+        ),
+        (
+            "visualizer.plot_time_block_ridership[station]",
+            visualizer.plot_time_block_ridership,
+            _args(processed["stations_time_block_ridership_df"], "station_complex"),
+            True,
+        ),
+        (
+            "visualizer.bar_figure_dict[station]",
+            visualizer.bar_figure_dict,
+            _args(
+                processed["station_weekly_ridership_df"],
+                "station_complex",
+                "day",
+                "Day of the Week",
+                visualizer.DAY_ORDER,
+                "All Stations",
+            ),
+            True,
+        ),
+        (
+            "visualizer.plot_station_map_view",
+            visualizer.plot_station_map_view,
+            _args(processed["stations_df"]),
+            True,
+        ),
+        ("visualizer.get_all_plots", visualizer.get_all_plots, _args(processed), False),
+    ]
+
+
+def payload_bytes(result):
+    """Size of a result as sent to the browser."""
+    if isinstance(result, dict) and "data" in result and "layout" in result:
+        return len(encode(pack_figure(result)))
+    if hasattr(result, "to_plotly_json"):
+        return len(encode(pack_figure(result)))
+    if isinstance(result, pd.DataFrame):
+        return len(encode(result.to_dict("records")))
+    return len(encode(result))
+
+
+def run_benchmark(func, make_args, repeat, payload):
+    """Return the best time, the peak traced memory and the payload size."""
+    timings = []
+    for _ in range(repeat):
+        args = make_args()
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+
+    args = make_args()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    return {
+        "seconds": round(min(timings), 6),
+        "peak_memory_bytes": peak,
+        "payload_bytes": payload_bytes(result) if payload else None,
+    }
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Print the time ratio against a baseline run and return the regressions."""
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if not before or "seconds" not in before or "seconds" not in result:
+            continue
+        ratio = result["seconds"] / max(before["seconds"], 1e-9)
+        flag = "REGRESSION" if ratio > threshold else ""
+        print(
+            f"{key:60s} {before['seconds']:10.4f} {result['seconds']:10.4f} "
+            f"{ratio:6.2f}x {flag}"
+        )
+        if ratio > threshold:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--filter", default="", help="Only run matching benchmarks")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    results = {}
+    for n_rows in args.rows:
+        raw = make_ridership(n_rows)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, func, make_args, payload in get_benchmarks(raw, tmp_dir):
+                if args.filter not in name:
+                    continue
+                key = f"{name}[rows={n_rows}]"
+                try:
+                    results[key] = run_benchmark(func, make_args, args.repeat, payload)
+                except FileNotFoundError as e:
+                    results[key] = {"skipped": str(e)}
+                print(key, json.dumps(results[key]), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "code_version": get_code_version(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "plotly": plotly.__version__,
+            "rows": args.rows,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
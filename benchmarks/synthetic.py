@@ -0,0 +1,230 @@
+import argparse
+import numpy as np
+import pandas as pd
+from helper import LINE_COLOR_MAP
+
+# Rough bounding boxes (lat_min, lat_max, lon_min, lon_max) per borough
+BOROUGH_BOUNDS = {
+    "Manhattan": (40.70, 40.87, -74.02, -73.91),
+    "Brooklyn": (40.57, 40.70, -74.04, -73.86),
+    "Queens": (40.66, 40.78, -73.96, -73.74),
+    "Bronx": (40.80, 40.90, -73.93, -73.83),
+    "Staten Island": (40.50, 40.64, -74.25, -74.06),
+}
+BOROUGH_WEIGHTS = [0.35, 0.3, 0.2, 0.12, 0.03]
+
+STREET_NAMES = [
+    "Canal",
+    "Broadway",
+    "Houston",
+    "Fulton",
+    "Chambers",
+    "Jay",
+    "Court",
+    "Atlantic Av",
+    "Roosevelt Av",
+    "Jamaica",
+    "Fordham Rd",
+    "Grand",
+    "Myrtle",
+    "Church Av",
+    "Kings Hwy",
+]
+
+# Every SHARED_NAME_EVERY-th station shares its street and number with an
+# earlier one on other lines in another borough, as the real "86 St (R)" in
+# Brooklyn and "86 St (4,5,6)" in Manhattan, whose names are equal once
+# format_station_name drops the lines
+SHARED_NAME_EVERY = 10
+
+# Relative ridership by hour of day, with morning and evening peaks
+HOURLY_PROFILE = np.concatenate(
+    [
+        [2, 1, 1, 1, 2, 5],  # night
+        [12, 20, 24, 16, 11, 10],  # morning peak
+        [11, 11, 12, 15, 20, 24],  # afternoon and evening peak
+        [19, 13, 10, 8, 6, 4],  # evening
+    ]
+).astype(float)
+WEEKDAY_PROFILE = np.array([1.0, 1.05, 1.05, 1.05, 1.0, 0.65, 0.55])
+
+# (payment_method, fare_class_category, share of a station-hour's riders)
+FARE_CLASSES = [
+    ("metrocard", "Metrocard - Full Fare", 0.12),
+    ("metrocard", "Metrocard - Unlimited 30-Day", 0.08),
+    ("metrocard", "Metrocard - Unlimited 7-Day", 0.05),
+    ("metrocard", "Metrocard - Seniors & Disability", 0.03),
+    ("metrocard", "Metrocard - Students", 0.03),
+    ("metrocard", "Metrocard - Fair Fare", 0.02),
+    ("metrocard", "Metrocard - Other", 0.02),
+    ("omny", "OMNY - Full Fare", 0.55),
+    ("omny", "OMNY - Seniors & Disability", 0.04),
+    ("omny", "OMNY - Students", 0.03),
+    ("omny", "OMNY - Fair Fare", 0.02),
+    ("omny", "OMNY - Other", 0.01),
+]
+
+
+def make_stations(n_stations=428, seed=0):
+    """
+    Generate station complexes with MTA-style names, boroughs and locations,
+    some of which differ only in their lines and borough, see
+    SHARED_NAME_EVERY.
+    """
+    rng = np.random.default_rng(seed)
+    lines = list(LINE_COLOR_MAP)
+    borough_names = list(BOROUGH_BOUNDS)
+    boroughs = rng.choice(borough_names, size=n_stations, p=BOROUGH_WEIGHTS)
+
+    records, numbers, station_lines_of = [], [], []
+    for i, borough in enumerate(boroughs):
+        street = STREET_NAMES[i % len(STREET_NAMES)]
+        station_lines = sorted(
+            rng.choice(lines, size=rng.integers(1, 4), replace=False)
+        )
+        number = i + 1
+        if i >= len(STREET_NAMES) and i % SHARED_NAME_EVERY == 0:
+            # The earlier station on the same street
+            other = i - len(STREET_NAMES)
+            number = numbers[other]
+            other_borough = borough_names.index(records[other]["borough"])
+            borough = borough_names[(other_borough + 1) % len(borough_names)]
+            while station_lines == station_lines_of[other]:
+                station_lines = sorted(
+                    rng.choice(lines, size=rng.integers(1, 4), replace=False)
+                )
+        numbers.append(number)
+        station_lines_of.append(station_lines)
+        name = f"{street} {number} St ({','.join(station_lines)})"
+        lat_min, lat_max, lon_min, lon_max = BOROUGH_BOUNDS[borough]
+        records.append(
+            {
+                "station_complex_id": str(i + 1),
+                "station_complex": name,
+                "borough": borough,
+                "latitude": round(rng.uniform(lat_min, lat_max), 6),
+                "longitude": round(rng.uniform(lon_min, lon_max), 6),
+                "popularity": rng.lognormal(mean=0.0, sigma=1.0),
+            }
+        )
+
+    return pd.DataFrame(records)
+
+
+def _ridership_chunk(stations, first_row, n_rows, start, seed, fare_classes):
+    """Generate rows [first_row, first_row + n_rows) of the synthetic dataset."""
+    rng = np.random.default_rng([seed, first_row])
+    n_stations = len(stations)
+    n_fares = len(FARE_CLASSES) if fare_classes else 1
+    rows = np.arange(first_row, first_row + n_rows)
+    hour_idx = rows // (n_stations * n_fares)
+    station_idx = rows // n_fares % n_stations
+    fare_idx = rows % n_fares
+
+    ts = pd.Timestamp(start) + pd.to_timedelta(hour_idx, unit="h")
+    expected = (
+        HOURLY_PROFILE[ts.hour]
+        * WEEKDAY_PROFILE[ts.dayofweek]
+        * stations["popularity"].to_numpy()[station_idx]
+        * 10
+    )
+
+    df = stations.drop(columns="popularity").iloc[station_idx].reset_index(drop=True)
+    df.insert(0, "transit_timestamp", ts)
+    df.insert(1, "transit_mode", "subway")
+    if fare_classes:
+        methods, categories, shares = zip(*FARE_CLASSES)
+        df["payment_method"] = np.array(methods)[fare_idx]
+        df["fare_class_category"] = np.array(categories)[fare_idx]
+        expected = expected * np.array(shares)[fare_idx]
+    df["ridership"] = rng.poisson(expected)
+
+    return df
+
+
+def iter_ridership(
+    n_rows,
+    n_stations=428,
+    start="2024-11-01",
+    seed=0,
+    chunk_rows=1_000_000,
+    fare_classes=True,
+):
+    """
+    Yield a deterministic synthetic ridership dataset in the MTA hourly schema
+    in chunks, so datasets larger than memory can be written to disk. Rows are
+    laid out as consecutive hours, each covering every station and, unless
+    fare_classes is False, every payment method and fare class.
+    """
+    stations = make_stations(n_stations, seed)
+    for first_row in range(0, n_rows, chunk_rows):
+        yield _ridership_chunk(
+            stations,
+            first_row,
+            min(chunk_rows, n_rows - first_row),
+            start,
+            seed,
+            fare_classes,
+        )
+
+
+def make_ridership(
+    n_rows, n_stations=428, start="2024-11-01", seed=0, fare_classes=True
+):
+    """Generate a synthetic ridership frame in memory."""
+    return pd.concat(
+        iter_ridership(n_rows, n_stations, start, seed, fare_classes=fare_classes),
+        ignore_index=True,
+    )
+
+
+def write_ridership(path, n_rows, **kwargs):
+    """Write a synthetic dataset to CSV or Parquet, one chunk at a time."""
+    if path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        for chunk in iter_ridership(n_rows, **kwargs):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+        return
+
+    for i, chunk in enumerate(iter_ridership(n_rows, **kwargs)):
+        chunk.to_csv(path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic MTA dataset.")
+    parser.add_argument("--rows", type=int, required=True)
+    parser.add_argument("--stations", type=int, default=428)
+    parser.add_argument("--start", default="2024-11-01")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-fare-classes",
+        action="store_true",
+        help="One row per station-hour instead of one per fare class",
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="CSV or Parquet file to write, e.g. in a scratch data/ directory",
+    )
+    args = parser.parse_args()
+
+    write_ridership(
+        args.output,
+        args.rows,
+        n_stations=args.stations,
+        start=args.start,
+        seed=args.seed,
+        fare_classes=not args.no_fare_classes,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,131 @@
-from dash import Input, Output, State, no_update
-from app_instance import app, data
-from helper import add_dash_table
+from dash import (
+    Input,
+    Output,
+    State,
+    ClientsideFunction,
+    no_update,
+    callback_context,
+    Patch,
+)
+from app_instance import app, data, backend
+import json
 import logging
-from data import get_processed_data
-from visualizer import get_all_plots
+from collections import OrderedDict
+from threading import Lock
+import pandas as pd
+from data import get_processed_data, get_processed_ranges, get_approximate_data
+from helper import table_columns
+from visualizer import get_all_plots, plot_forecast, plot_station_map_view
+from serializer import pack_figure, measure_outputs, MEASURE_PAYLOADS
+from metrics import instrument
+from profiler import profile_callback
+from station_series import build_station_series
+from warmup import record_range
+from sampling import PROGRESSIVE
+from export import EXPORT_LINKS
+from admission import (
+    ADMISSIONS,
+    admission_note,
+    coarsen,
+    coarsen_trend,
+    combine_costs,
+    estimate_cost,
+    heavy_slot,
+    plan_query,
+)
+from comparison import (
+    TABLE_KEYS,
+    add_baseline_trend,
+    baseline_offset,
+    baseline_total,
+    format_change,
+    compare_table,
+)
+from heatmap_tiles import heatmap_layout, heatmap_stations
+from forecast import forecast_note, get_forecast, station_forecast
+from spatial_index import (
+    NEAREST_STATIONS,
+    VIEWPORT_MIN_POINTS,
+    get_station_index,
+    parse_viewport,
+)
 
 logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
-stations_stats_df = data["station_stats_df"]
 default_dates = data["dates"]
 
+# Stations of the recently loaded ranges, by range, for the map's viewport
+# queries
+MAP_RANGES = 16
+_map_stations = OrderedDict()
+_map_stations_lock = Lock()
+# Rows of the station x hour heatmap, the same for every range
+heatmap_rows = heatmap_stations(data["stations_df"])
 
-@app.callback(
-    Output("station-details-table", "children"),
+# Interactions served in the browser from the station-series-store
+# (see assets/clientside.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="mta", function_name="stationDetails"),
+    Output("station-table", "data"),
+    Output("station-profile-graph", "figure"),
+    Output("station-details-table", "style"),
     Input("station-map-view", "clickData"),
+    State("station-series-store", "data"),
+    State("stations-stats-table", "data"),
 )
-def display_station_details(clickData):
-    logger.debug(clickData)
-    if clickData is None:
-        return None
 
-    station_name = clickData["points"][0]["hovertext"]
+app.clientside_callback(
+    ClientsideFunction(namespace="mta", function_name="stationOptions"),
+    Output("station-weekly-select", "options"),
+    Output("station-time-block-select", "options"),
+    Input("station-series-store", "data"),
+    prevent_initial_call=True,
+)
 
-    station_data = stations_stats_df[stations_stats_df["Station"] == station_name]
-    station_dash_table = add_dash_table(station_data, "station-table")
+app.clientside_callback(
+    ClientsideFunction(namespace="mta", function_name="stationWeekly"),
+    Output("station-ridership-weekly-graph", "figure", allow_duplicate=True),
+    Input("station-weekly-select", "value"),
+    Input("station-series-store", "data"),
+    State("station-ridership-weekly-graph", "figure"),
+    prevent_initial_call=True,
+)
 
-    return station_dash_table
+app.clientside_callback(
+    ClientsideFunction(namespace="mta", function_name="stationTimeBlock"),
+    Output("station-ridership-time-block-graph", "figure", allow_duplicate=True),
+    Input("station-time-block-select", "value"),
+    Input("station-series-store", "data"),
+    State("station-ridership-time-block-graph", "figure"),
+    prevent_initial_call=True,
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace="mta", function_name="boroughVisibility"),
+    Output("ridership-trend-graph", "figure", allow_duplicate=True),
+    Input("trend-borough-select", "value"),
+    Input("station-series-store", "data"),
+    State("ridership-trend-graph", "figure"),
+    prevent_initial_call=True,
+)
+
+# Download links for the selected range and fare filters
+app.clientside_callback(
+    ClientsideFunction(namespace="mta", function_name="exportLinks"),
+    *[Output(f"export-{table}-{fmt}", "href") for table, fmt, _ in EXPORT_LINKS],
+    Input("date-picker-start", "date"),
+    Input("date-picker-end", "date"),
+    Input("payment-method-select", "value"),
+    Input("fare-class-select", "value"),
+    State("export-paths", "data"),
+)
+
+# Station x hour heatmap, fetching only the tiles in view
+app.clientside_callback(
+    ClientsideFunction(namespace="mta", function_name="heatmapTiles"),
+    Output("station-hour-heatmap", "figure"),
+    Input("station-hour-heatmap", "relayoutData"),
+    Input("heatmap-tiles-store", "data"),
+)
 
 
 @app.callback(
@@ -32,79 +133,479 @@ def display_station_details(clickData):
     Output("date-picker-end", "date"),
     Input("url", "pathname"),
 )
+@instrument
 def on_page_load(pathname):
     """Callback to update date pickers on page load."""
     start_date, end_date = default_dates
     logger.debug(
-        f"Page loaded with default start_date: {start_date}, end_date: {end_date}"
+        "Page loaded with default start_date: %s, end_date: %s", start_date, end_date
     )
     return start_date, end_date
 
 
-@app.callback(
+# Outputs of update_graph and update_graph_exact, as (component id, property)
+GRAPH_OUTPUTS = [
     # Plots
-    Output("ridership-trend-graph", "figure"),
-    Output("ridership-weekly-graph", "figure"),
-    Output("station-ridership-weekly-graph", "figure"),
-    Output("ridership-time-block-graph", "figure"),
-    Output("station-ridership-time-block-graph", "figure"),
-    Output("station-map-view", "figure"),
+    ("ridership-trend-graph", "figure"),
+    ("ridership-weekly-graph", "figure"),
+    ("station-ridership-weekly-graph", "figure"),
+    ("ridership-time-block-graph", "figure"),
+    ("station-ridership-time-block-graph", "figure"),
+    ("station-map-view", "figure"),
+    ("fare-class-graph", "figure"),
     # Tables
-    Output("borough-stats-table", "data"),
-    Output("line-stats-table", "data"),
-    Output("stations-stats-table", "data"),
+    ("borough-stats-table", "data"),
+    ("line-stats-table", "data"),
+    ("stations-stats-table", "data"),
+    # Table columns, with the change from the baseline when comparing
+    ("borough-stats-table", "columns"),
+    ("line-stats-table", "columns"),
+    ("stations-stats-table", "columns"),
     # Cards - Row 1
-    Output("total-boroughs-card-body", "children"),
-    Output("total-lines-card-body", "children"),
-    Output("total-stations-card-body", "children"),
-    Output("total-rides-card-body", "children"),
+    ("total-boroughs-card-body", "children"),
+    ("total-lines-card-body", "children"),
+    ("total-stations-card-body", "children"),
+    ("total-rides-card-body", "children"),
     # Cards - Row 2
-    Output("busiest-station-card-body", "children"),
-    Output("busiest-station-card-para", "children"),
-    Output("busiest-line-card-body", "children"),
-    Output("busiest-line-card-para", "children"),
-    Output("busiest-borough-card-body", "children"),
-    Output("busiest-borough-card-para", "children"),
+    ("busiest-station-card-body", "children"),
+    ("busiest-station-card-para", "children"),
+    ("busiest-line-card-body", "children"),
+    ("busiest-line-card-para", "children"),
+    ("busiest-borough-card-body", "children"),
+    ("busiest-borough-card-para", "children"),
+    # Per-station arrays for the clientside callbacks
+    ("station-series-store", "data"),
+    ("approximate-note", "children"),
+    # Range shown on the station map
+    ("map-range-store", "data"),
+    # Tile pyramid of the station x hour heatmap
+    ("heatmap-tiles-store", "data"),
+    # How admission control limited the request, see admission.py
+    ("admission-note", "children"),
+]
+# Figures built for a range, for its cost estimate
+FIGURES = sum(prop == "figure" for _, prop in GRAPH_OUTPUTS)
+
+
+def load_processed_data(start_date, end_date, filters, approximate=False, heavy=False):
+    """
+    Processed data for a range from the query service or computed here. With
+    approximate, data estimated from a sample is returned instead when exact
+    results would take long, marked by its "approximate" key. Heavy queries
+    wait for a slot (see admission.heavy_slot) and None is returned when no
+    slot frees up in time.
+    """
+    if backend is not None:
+        with heavy_slot(heavy) as admitted:
+            if not admitted:
+                return None
+            return backend.get_processed_data(
+                start_date, end_date, filters, approximate
+            )
+    if approximate:
+        new_data = get_approximate_data(start_date, end_date, data["version"], filters)
+        if new_data is not None:
+            return new_data
+    with heavy_slot(heavy) as admitted:
+        if not admitted:
+            return None
+        return get_processed_data(
+            data["ridership_df"],
+            start_date,
+            end_date,
+            version=data["version"],
+            filters=filters,
+        )
+
+
+def load_processed_ranges(ranges, filters, heavy=False):
+    """
+    Processed data of several ranges, such as a range and its baseline,
+    filtered in one pass here or fetched one by one from the query service.
+    Returns None when a heavy query gets no slot in time.
+    """
+    with heavy_slot(heavy) as admitted:
+        if not admitted:
+            return None
+        if backend is not None:
+            return [
+                backend.get_processed_data(start_date, end_date, filters)
+                for start_date, end_date in ranges
+            ]
+        return get_processed_ranges(
+            data["ridership_df"], ranges, data["version"], filters
+        )
+
+
+def request_ranges(request):
+    """
+    Date ranges a request loads: its own, then its baseline when it is
+    compared with one. Both sides of a comparison are clipped to the dates
+    with data on both of them, so they cover the same hours, and there is
+    no baseline when no such dates are left.
+    """
+    ranges = [(request["start_date"], request["end_date"])]
+    if request.get("compare"):
+        offset = baseline_offset(*ranges[0], request["compare"])
+        start, end = (pd.Timestamp(date) for date in ranges[0])
+        first, last = (pd.Timestamp(date) for date in data["dates"])
+        clipped = (max(start, first + offset), min(end, last))
+        if clipped[0] <= clipped[1]:
+            if clipped != (start, end):
+                ranges = [tuple(date.isoformat() for date in clipped)]
+            ranges.append(tuple((date - offset).isoformat() for date in clipped))
+    return ranges
+
+
+def plan_request(request, ranges=None):
+    """Admission plan of a request's ranges from their estimated cost."""
+    ranges = ranges or request_ranges(request)[:1]
+    costs = [
+        estimate_cost(data, start_date, end_date, request["filters"], FIGURES)
+        for start_date, end_date in ranges
+    ]
+    return plan_query(data, combine_costs(costs))
+
+
+def plan_comparison(request):
+    """
+    Ranges to load for a request, their admission plan and a note for the
+    user. Comparisons are exact, so one that would be answered from the
+    sample or rejected falls back to the range alone.
+    """
+    ranges = request_ranges(request)
+    plan = plan_request(request, ranges)
+    if len(ranges) > 1 and plan["decision"] != "admitted":
+        ranges = ranges[:1]
+        plan = plan_request(request, ranges)
+        return ranges, plan, "This range is too large to compare, shown alone."
+    if request.get("compare") and len(ranges) == 1:
+        return ranges, plan, "There is no data to compare this range with."
+    if ranges[0] != (request["start_date"], request["end_date"]):
+        start_date, end_date = (pd.Timestamp(date) for date in ranges[0])
+        return (
+            ranges,
+            plan,
+            f"Compared from {start_date:%Y-%m-%d %H:%M} to {end_date:%Y-%m-%d %H:%M},"
+            " the dates with data on both sides.",
+        )
+    return ranges, plan, ""
+
+
+def limited_outputs(note, approximate_note=no_update):
+    """Values of GRAPH_OUTPUTS keeping the page as it is, with a note."""
+    outputs = dict.fromkeys(GRAPH_OUTPUTS, no_update)
+    outputs[("approximate-note", "children")] = approximate_note
+    outputs[("admission-note", "children")] = note
+    return tuple(outputs.values())
+
+
+def _format_total(value, approximate, key):
+    if approximate is None:
+        return f"{value:,}"
+    return f"≈{value:,.0f} ± {approximate[key]:,}"
+
+
+def _remember_stations(map_range, stations_df):
+    key = json.dumps(map_range, sort_keys=True, default=str)
+    with _map_stations_lock:
+        _map_stations[key] = stations_df
+        _map_stations.move_to_end(key)
+        while len(_map_stations) > MAP_RANGES:
+            _map_stations.popitem(last=False)
+
+
+def map_stations(map_range):
+    """Stations of a range shown on the map, loaded again if forgotten."""
+    key = json.dumps(map_range, sort_keys=True, default=str)
+    with _map_stations_lock:
+        stations_df = _map_stations.get(key)
+        if stations_df is not None:
+            _map_stations.move_to_end(key)
+    if stations_df is None:
+        new_data = load_processed_data(
+            map_range["start_date"], map_range["end_date"], map_range["filters"]
+        )
+        stations_df = new_data["stations_df"]
+        _remember_stations(map_range, stations_df)
+    return stations_df
+
+
+def _with_change(text, value, baseline_value):
+    """A card's text followed by the relative change from the baseline."""
+    return f"{text} ({format_change(value, baseline_value)} vs baseline)"
+
+
+def graph_outputs(new_data, map_range, plan, baseline=None, note=""):
+    """
+    Values of GRAPH_OUTPUTS for the processed data of a range, with the
+    changes from the processed data of its baseline when comparing.
+    """
+    _remember_stations(map_range, new_data["stations_df"])
+    new_data = coarsen(new_data, plan["resolution"])
+    new_metrics = new_data["metrics"]
+    approximate = new_data.get("approximate")
+    # Generate plots
+    plots = get_all_plots(new_data)
+    trend = pack_figure(plots["hourly_ridership_plot"])
+    tables = {key: new_data[key] for key in TABLE_KEYS}
+    if baseline is not None:
+        # The baseline's trend is drawn over the range's, from its start
+        offset = pd.Timestamp(map_range["start_date"]) - pd.Timestamp(
+            baseline["dates"][0]
+        )
+        trend = add_baseline_trend(
+            trend,
+            coarsen_trend(baseline["hourly_ridership_df"], plan["resolution"]),
+            offset,
+        )
+        tables = {
+            key: compare_table(table, baseline[key], TABLE_KEYS[key])
+            for key, table in tables.items()
+        }
+    total_rides = new_metrics["no_of_rides"]
+    if baseline is not None:
+        total_rides = _with_change(
+            _format_total(total_rides, approximate, "no_of_rides"),
+            total_rides,
+            baseline["metrics"]["no_of_rides"],
+        )
+    elif approximate is not None:
+        total_rides = _format_total(total_rides, approximate, "no_of_rides")
+
+    def busiest(metric):
+        name, value = new_metrics[metric]
+        text = "Total Ridership: " + _format_total(value, approximate, metric)
+        if baseline is None:
+            return text
+        return _with_change(text, value, baseline_total(baseline, metric, name))
+
+    outputs = (
+        # Plots
+        trend,
+        pack_figure(plots["weekly_ridership_plot"]),
+        pack_figure(plots["station_weekly_ridership_plot"]),
+        pack_figure(plots["time_block_ridership_plot"]),
+        pack_figure(plots["station_time_block_ridership_plot"]),
+        pack_figure(plots["station_map_view"]),
+        pack_figure(plots["fare_class_ridership_plot"]),
+        # Tables
+        tables["borough_stats_df"].to_dict("records"),
+        tables["line_stats_df"].to_dict("records"),
+        tables["station_stats_df"].to_dict("records"),
+        table_columns(tables["borough_stats_df"]),
+        table_columns(tables["line_stats_df"]),
+        table_columns(tables["station_stats_df"]),
+        # Cards - Row 1
+        new_metrics["no_of_boroughs"],
+        new_metrics["no_of_lines"],
+        new_metrics["no_of_stations"],
+        total_rides,
+        # Cards - Row 2
+        new_metrics["busiest_station"][0],
+        busiest("busiest_station"),
+        new_metrics["busiest_line"][0],
+        busiest("busiest_line"),
+        new_metrics["busiest_borough"][0],
+        busiest("busiest_borough"),
+        # Per-station arrays for the clientside callbacks
+        build_station_series(new_data),
+        (
+            ""
+            if approximate is None
+            else f"Approximate results from a 1 in {approximate['step']} sample "
+            "(± 95% margins of error)"
+            + (
+                ", exact results are loading..."
+                if plan["decision"] == "admitted"
+                else "."
+            )
+        ),
+        map_range,
+        heatmap_layout(
+            heatmap_rows,
+            map_range["start_date"],
+            map_range["end_date"],
+            data["version"],
+            map_range["filters"],
+            bounds=data["dates"],
+        ),
+        " ".join(filter(None, [admission_note(plan), note])),
+    )
+    if MEASURE_PAYLOADS:
+        measure_outputs(callback_context.outputs_list, outputs)
+    return outputs
+
+
+@app.callback(
+    *[Output(component_id, prop) for component_id, prop in GRAPH_OUTPUTS],
+    Output("exact-request-store", "data"),
     Input("load-button", "n_clicks"),
     State("date-picker-start", "date"),
     State("date-picker-end", "date"),
+    State("payment-method-select", "value"),
+    State("fare-class-select", "value"),
+    State("compare-select", "value"),
 )
-def update_graph(n_clicks, start_date, end_date):
-    """Update the graph based on the selected date range."""
+@instrument
+@profile_callback
+def update_graph(
+    n_clicks, start_date, end_date, payment_methods, fare_classes, comparison
+):
+    """
+    Update the graph based on the selected date range. Slow ranges are first
+    answered from a sample, with update_graph_exact sending exact results.
+    Ranges over the admission budgets are answered from the sample only,
+    rejected or drawn coarser, see admission.plan_query. A range compared
+    with a baseline is loaded exactly, together with the baseline.
+    """
     if n_clicks:
         logger.debug(
-            f"Update graph called with start_date: {start_date}, end_date: {end_date}"
+            "Update graph called with start_date: %s, end_date: %s",
+            start_date,
+            end_date,
         )
-        # Load data
-        ridership_df = data["ridership_df"]
-        new_data = get_processed_data(ridership_df, start_date, end_date)
-        new_metrics = new_data["metrics"]
-        # Generate plots
-        plots = get_all_plots(new_data)
-
-        return (
-            # Plots
-            plots["hourly_ridership_plot"],
-            plots["weekly_ridership_plot"],
-            plots["station_weekly_ridership_plot"],
-            plots["time_block_ridership_plot"],
-            plots["station_time_block_ridership_plot"],
-            plots["station_map_view"],
-            # Tables
-            new_data["borough_stats_df"].to_dict("records"),
-            new_data["line_stats_df"].to_dict("records"),
-            new_data["station_stats_df"].to_dict("records"),
-            # Cards - Row 1
-            new_metrics["no_of_boroughs"],
-            new_metrics["no_of_lines"],
-            new_metrics["no_of_stations"],
-            new_metrics["no_of_rides"],
-            # Cards - Row 2
-            new_metrics["busiest_station"][0],
-            f"Total Ridership: {new_metrics['busiest_station'][1]:,}",
-            new_metrics["busiest_line"][0],
-            f"Total Ridership: {new_metrics['busiest_line'][1]:,}",
-            new_metrics["busiest_borough"][0],
-            f"Total Ridership: {new_metrics['busiest_borough'][1]:,}",
+        record_range(start_date, end_date)
+        filters = {
+            "payment_method": payment_methods,
+            "fare_class_category": fare_classes,
+        }
+        request = {
+            "start_date": start_date,
+            "end_date": end_date,
+            "filters": filters,
+            "compare": comparison,
+        }
+        # Every load replaces the exact request, so exact results of an
+        # earlier load still being computed are dropped by the browser
+        no_exact = {"token": n_clicks, "request": None}
+        ranges, plan, note = plan_comparison(request)
+        ADMISSIONS.inc(decision=plan["decision"])
+        if plan["decision"] == "rejected":
+            return (*limited_outputs(admission_note(plan)), no_exact)
+        if len(ranges) > 1:
+            loaded = load_processed_ranges(ranges, filters, plan["heavy"])
+            if loaded is None:
+                return (*limited_outputs(admission_note(plan, busy=True)), no_exact)
+            new_data, baseline = loaded
+            compared = dict(request, start_date=ranges[0][0], end_date=ranges[0][1])
+            return (
+                *graph_outputs(new_data, compared, plan, baseline, note),
+                no_exact,
+            )
+        new_data = load_processed_data(
+            start_date,
+            end_date,
+            filters,
+            PROGRESSIVE or plan["decision"] == "sampled",
+            plan["heavy"],
         )
+        if new_data is None:
+            return (*limited_outputs(admission_note(plan, busy=True)), no_exact)
+        exact_request = (
+            {"token": n_clicks, "request": request}
+            if "approximate" in new_data and plan["decision"] == "admitted"
+            else no_exact
+        )
+        return (*graph_outputs(new_data, request, plan, note=note), exact_request)
     return no_update
+
+
+@app.callback(
+    *[
+        Output(component_id, prop, allow_duplicate=True)
+        for component_id, prop in GRAPH_OUTPUTS
+    ],
+    Input("exact-request-store", "data"),
+    State("load-button", "n_clicks"),
+    prevent_initial_call=True,
+)
+@instrument
+@profile_callback
+def update_graph_exact(exact_load, n_clicks):
+    """
+    Replace approximate results sent by update_graph with exact ones, which
+    are kept when the process is too busy to compute them. Loads without
+    exact results to send, and loads followed by another, send nothing.
+    """
+    exact_request = exact_load["request"]
+    if exact_request is None or exact_load["token"] != n_clicks:
+        return [no_update] * len(GRAPH_OUTPUTS)
+    _, plan, note = plan_comparison(exact_request)
+    new_data = load_processed_data(
+        exact_request["start_date"],
+        exact_request["end_date"],
+        exact_request["filters"],
+        heavy=plan["heavy"],
+    )
+    if new_data is None:
+        return limited_outputs(
+            admission_note(plan, busy=True),
+            "Approximate results from a sample (± 95% margins of error).",
+        )
+    return graph_outputs(new_data, exact_request, plan, note=note)
+
+
+@app.callback(
+    Output("station-map-view", "figure", allow_duplicate=True),
+    Input("station-map-view", "relayoutData"),
+    State("map-range-store", "data"),
+    prevent_initial_call=True,
+)
+@instrument
+def update_map_view(relayout_data, map_range):
+    """
+    Redraw the stations of a large map for the view it was panned or zoomed
+    to. Smaller maps have all their stations drawn already.
+    """
+    viewport = parse_viewport(relayout_data)
+    if viewport is None or len(get_station_index()) <= VIEWPORT_MIN_POINTS:
+        return no_update
+    figure = plot_station_map_view(map_stations(map_range), viewport=viewport)
+    # Only the station traces change, the borough boundaries stay in the browser
+    patched = Patch()
+    patched["data"] = pack_figure(figure)["data"]
+    return patched
+
+
+@app.callback(
+    Output("nearby-stations", "children"),
+    Input("station-map-view", "clickData"),
+    prevent_initial_call=True,
+)
+@instrument
+def show_nearby_stations(click_data):
+    """List the stations nearest to a clicked station or cluster."""
+    point = click_data["points"][0]
+    nearest = get_station_index().nearest(
+        point["lat"], point["lon"], NEAREST_STATIONS + 1
+    )
+    nearby = [
+        f"{name} ({distance:.1f} km)"
+        for name, distance in nearest
+        if name != point.get("hovertext")
+    ][:NEAREST_STATIONS]
+    return "Nearest stations: " + ", ".join(nearby)
+
+
+def load_forecast(station):
+    """Forecast of a station, or of all stations, from the query service if set."""
+    if backend is not None:
+        return backend.get_forecast(station)
+    return station_forecast(get_forecast(data), station)
+
+
+@app.callback(
+    Output("forecast-graph", "figure"),
+    Output("forecast-note", "children"),
+    Input("tabs", "value"),
+    Input("forecast-station-select", "value"),
+)
+@instrument
+def update_forecast_tab(tab, station):
+    """Draw the forecast of the selected station once the tab is open."""
+    if tab != "tab-5":
+        return no_update, no_update
+    forecast = load_forecast(station)
+    figure = plot_forecast(forecast["history_df"], forecast["forecast_df"])
+    return pack_figure(figure), forecast_note(forecast)
@@ -0,0 +1,97 @@
+import logging
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from helper import format_station_name
+from serializer import pack_figure
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Baselines a range can be compared with, as (value, label)
+COMPARISONS = [
+    ("period", "Previous period"),
+    ("week", "Same period last week"),
+    ("year", "Same period last year"),
+]
+CHANGE_COLUMN = "Change vs Baseline (%)"
+# Key column of each stats table compared with its baseline
+TABLE_KEYS = {
+    "station_stats_df": "Station",
+    "borough_stats_df": "Borough",
+    "line_stats_df": "Line",
+}
+
+
+def baseline_offset(start_date, end_date, comparison):
+    """
+    How far back the baseline of a range is: the range's length in whole
+    days for the previous period, a week, or a calendar year.
+    """
+    if comparison == "week":
+        return pd.DateOffset(weeks=1)
+    if comparison == "year":
+        return pd.DateOffset(years=1)
+    if comparison == "period":
+        length = pd.Timestamp(end_date) - pd.Timestamp(start_date)
+        return pd.DateOffset(days=max(int(np.ceil(length / pd.Timedelta(days=1))), 1))
+    raise ValueError(f"Unknown comparison: {comparison}")
+
+
+def format_change(current, baseline):
+    """Relative change from a baseline value, e.g. "+5.2%"."""
+    if not baseline:
+        return "n/a"
+    return f"{(current - baseline) / baseline:+.1%}"
+
+
+def compare_table(current_df, baseline_df, key):
+    """
+    A stats table with the relative change of its total ridership from the
+    baseline's in CHANGE_COLUMN, empty for rows missing from the baseline.
+    """
+    baseline = baseline_df.set_index(key)["Total Ridership"]
+    previous = current_df[key].map(baseline)
+    change = (current_df["Total Ridership"] - previous) / previous * 100
+    return current_df.assign(
+        **{CHANGE_COLUMN: change.round(1).replace([np.inf, -np.inf], np.nan)}
+    )
+
+
+def baseline_total(baseline_data, metric, name):
+    """
+    Total ridership in the baseline of the station, line or borough a
+    busiest_* metric names, or None when it has no ridership there.
+    """
+    if metric == "busiest_station":
+        stations = baseline_data["station_stats_df"]
+        totals = stations.groupby(stations["Station"].map(format_station_name))[
+            "Total Ridership"
+        ].sum()
+    elif metric == "busiest_line":
+        totals = baseline_data["line_stats_df"].set_index("Line")["Total Ridership"]
+    else:
+        totals = baseline_data["borough_stats_df"].set_index("Borough")[
+            "Total Ridership"
+        ]
+    return totals.get(name)
+
+
+def add_baseline_trend(figure, baseline_trend_df, offset):
+    """
+    Overlay the baseline's total ridership on the ridership trend figure,
+    moved forward by offset onto the range's time axis. The trace is tied to
+    the "Total ridership" toggle of the trend chart through its meta.
+    """
+    figure = pack_figure(figure)
+    trace_type = figure["data"][0].get("type", "scatter") if figure["data"] else None
+    trace = go.Scatter(
+        x=baseline_trend_df["transit_timestamp"] + offset,
+        y=baseline_trend_df["total_ridership"],
+        mode="lines",
+        name="Total ridership (baseline)",
+        line={"dash": "dot", "color": "gray"},
+        meta={"baseline_of": "Total ridership"},
+    ).to_plotly_json()
+    trace["type"] = trace_type or "scatter"
+    baseline = pack_figure({"data": [trace], "layout": {}})["data"]
+    return {**figure, "data": figure["data"] + baseline}
@@ -1,8 +1,10 @@
 import requests
+import numpy as np
 import pandas as pd
 import logging
 from helper import (
     extract_lines,
+    normalize_range,
     LINE_COLOR_MAP,
     ensure_all_values_present,
     generate_time_blocks,
@@ -11,39 +13,82 @@ from helper import (
     get_busiest,
 )
 import os
+import time
+import hashlib
+import json
+from metrics import instrument, DATASET_ROWS
+from disk_cache import (
+    CACHE_DIR,
+    DISK_CACHE,
+    contains,
+    load_results,
+    store_results,
+    file_fingerprint,
+)
+from single_flight import SingleFlight
+from rollups import (
+    ROLLUPS,
+    FARE_DIMENSIONS,
+    build_rollups,
+    update_rollups,
+    register_rollups,
+    get_rollups,
+    query_rollups,
+    row_positions,
+)
+from sampling import (
+    PROGRESSIVE,
+    SAMPLE_STEP,
+    PROGRESSIVE_MIN_ROWS,
+    build_sample,
+    register_sample,
+    get_sample,
+    error_bounds,
+)
+import multiprocessing
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
 DATA_DIR = "data/"
+DATA_FILES = ["data_11_2024.csv"]
+# Source files of the last cleaned data in the disk cache, so data files that
+# only gained newer rows extend it instead of being cleaned again
+LATEST_SOURCE_FILE = os.path.join(CACHE_DIR, "latest_source.json")
+
+# Execution mode for the aggregations: "serial", "thread" or "process"
+AGGREGATION_MODE = os.environ.get("MTA_AGGREGATION_MODE", "serial")
+AGGREGATION_WORKERS = int(os.environ.get("MTA_AGGREGATION_WORKERS", os.cpu_count()))
 
 
 def fetch_data_from_api(url):
     """Fetch data from the given API URL."""
     response = requests.get(url)
     if response.status_code == 200:
-        logger.info(f"Successfully fetched data from {url}")
+        logger.info("Successfully fetched data from %s", url)
         return pd.DataFrame(response.json())
     else:
-        logger.error(f"Failed to fetch data from {url}")
+        logger.error("Failed to fetch data from %s", url)
         return pd.DataFrame()
 
 
 def read_data_from_file(file_path):
     """Read data from the given file path."""
-    files = ["data_11_2024.csv"]
     data = pd.DataFrame()
 
     try:
-        for file in files:
+        for file in DATA_FILES:
             if file.endswith(".csv"):
                 df = pd.read_csv(file_path + file)
                 data = pd.concat([data, df], ignore_index=True)
-        logger.info(f"Succesfully read files.")
+        logger.info("Succesfully read files.")
         return data
     except FileNotFoundError:
-        logger.error(f"File not found: {file_path}")
+        logger.error("File not found: %s", file_path)
         return pd.DataFrame()
 
 
+@instrument
 def load_data():
     """Load ridership data from file or API."""
     try:
@@ -57,6 +102,7 @@ def load_data():
     return ridership_df
 
 
+@instrument
 def clean_data(df):
     """Clean and preprocess the ridership data."""
     df["transit_timestamp"] = pd.to_datetime(df["transit_timestamp"])
@@ -76,12 +122,21 @@ def clean_data(df):
         )
     )
     df["station_size"] = 7
+    # Small categorical dimensions; older extracts without them get one value
+    for column in FARE_DIMENSIONS:
+        if column not in df:
+            df[column] = "unknown"
+        df[column] = df[column].astype("category")
     df = df[~df["station_complex"].isin(["Central Park North", "RI Tramway"])]
     return df
 
 
-def filter_data(df, start_date=None, end_date=None):
-    """Filter data based on date range."""
+@instrument
+def filter_data(df, start_date=None, end_date=None, filters=None):
+    """
+    Filter data based on date range and, optionally, the selected values of
+    categorical columns such as payment_method.
+    """
     if start_date is None or end_date is None:
         logger.debug("No date range provided, using default dates.")
         start_date, end_date = get_default_dates(df)
@@ -89,9 +144,43 @@ def filter_data(df, start_date=None, end_date=None):
     mask = (df["transit_timestamp"] >= start_date) & (
         df["transit_timestamp"] <= end_date
     )
+    for column, values in (filters or {}).items():
+        if values:
+            mask &= df[column].isin(values)
     return df.loc[mask]
 
 
+@instrument
+def filter_ranges(df, ranges, filters=None):
+    """
+    Filter data to several date ranges at once, one frame per range. The
+    ranges are located by binary search in the descending timestamps, and
+    the fare filters are applied in one pass over the rows of all of them.
+    """
+    timestamps = df["transit_timestamp"].to_numpy()
+    slices = [
+        row_positions(
+            timestamps, pd.Timestamp(start), pd.Timestamp(end), inclusive=True
+        )
+        for start, end in ranges
+    ]
+    positions = np.concatenate(
+        [np.arange(first, last) for first, last in slices] or [np.empty(0, int)]
+    )
+    mask = np.ones(len(positions), dtype=bool)
+    for column, values in (filters or {}).items():
+        if values:
+            mask &= df[column].iloc[positions].isin(values).to_numpy()
+    # Rows of each range kept by the filters, then one frame of all of them
+    bounds = np.cumsum([0] + [last - first for first, last in slices])
+    kept = np.cumsum(
+        [0] + [int(mask[lo:hi].sum()) for lo, hi in zip(bounds, bounds[1:])]
+    )
+    selected = df.iloc[positions[mask]]
+    return [selected.iloc[lo:hi] for lo, hi in zip(kept, kept[1:])]
+
+
+@instrument
 def get_hourly_ridership(df: pd.DataFrame) -> pd.DataFrame:
     """Get hourly ridership data."""
     hourly_ridership_df = (
@@ -105,6 +194,7 @@ def get_hourly_ridership(df: pd.DataFrame) -> pd.DataFrame:
     return hourly_ridership_df
 
 
+@instrument
 def get_stations(ridership_data: pd.DataFrame) -> pd.DataFrame:
     """Get all stations in the dataset."""
     stations_info = ridership_data[
@@ -128,6 +218,7 @@ def get_stations(ridership_data: pd.DataFrame) -> pd.DataFrame:
     return stations
 
 
+@instrument
 def get_weekly_ridership(df: pd.DataFrame) -> pd.DataFrame:
     """Get weekly ridership data grouped by day and borough."""
 
@@ -156,6 +247,7 @@ def get_weekly_ridership(df: pd.DataFrame) -> pd.DataFrame:
     return weekly_ridership_df, station_weekly_ridership_df
 
 
+@instrument
 def get_time_block_ridership(df: pd.DataFrame) -> pd.DataFrame:
     """Get ridership data grouped by 3-hour time blocks and borough."""
 
@@ -188,18 +280,30 @@ def get_time_block_ridership(df: pd.DataFrame) -> pd.DataFrame:
     return time_block_ridership_df, stations_time_block_ridership_df
 
 
+@instrument
 def get_stations_stats_df(df: pd.DataFrame) -> pd.DataFrame:
     """Generate Station Stats with total ridership, avg ridership, peak hour, busiest day."""
 
     # Total ridership per station
-    station_stats_df = (
-        df.groupby("station_complex")
-        .agg(
-            total_ridership=("ridership", "sum"),
-            avg_hourly_ridership=("ridership", "mean"),
+    if "rows" in df:
+        # Rolled-up rows carry the number of hourly rows they sum
+        station_stats_df = (
+            df.groupby("station_complex")
+            .agg(total_ridership=("ridership", "sum"), rows=("rows", "sum"))
+            .reset_index()
+        )
+        station_stats_df["avg_hourly_ridership"] = station_stats_df[
+            "total_ridership"
+        ] / station_stats_df.pop("rows")
+    else:
+        station_stats_df = (
+            df.groupby("station_complex")
+            .agg(
+                total_ridership=("ridership", "sum"),
+                avg_hourly_ridership=("ridership", "mean"),
+            )
+            .reset_index()
         )
-        .reset_index()
-    )
     station_stats_df = station_stats_df.merge(
         df[["station_complex", "lines"]], on="station_complex", how="left"
     ).drop_duplicates(subset=["station_complex"])
@@ -268,6 +372,7 @@ def get_stations_stats_df(df: pd.DataFrame) -> pd.DataFrame:
     return station_stats_df
 
 
+@instrument
 def get_borough_stats_df(df):
     """Generate Borough comparison stats"""
 
@@ -347,6 +452,7 @@ def get_borough_stats_df(df):
     return borough_stats
 
 
+@instrument
 def get_line_stats_df(df):
     """Generate line comparison stats"""
     df = df.copy()
@@ -425,6 +531,13 @@ def get_line_stats_df(df):
     return line_stats
 
 
+@instrument
+def get_fare_class_ridership(df: pd.DataFrame) -> pd.DataFrame:
+    """Get ridership by payment method and fare class."""
+    return df.groupby(FARE_DIMENSIONS, observed=True)["ridership"].sum().reset_index()
+
+
+@instrument
 def get_key_metrics(df):
     busiest_station = df.groupby("station_complex")["ridership"].sum().idxmax()
     busiest_station = format_station_name(busiest_station)
@@ -456,41 +569,429 @@ def get_key_metrics(df):
     return metrics
 
 
-def get_data():
-    """Load and clean data."""
-    ridership_data = load_data()
-    ridership_df = clean_data(ridership_data)
-    default_dates = get_default_dates(ridership_df)
+# Output keys in the processed data and the aggregation that produces them
+AGGREGATIONS = [
+    (("hourly_ridership_df",), get_hourly_ridership),
+    (("weekly_ridership_df", "station_weekly_ridership_df"), get_weekly_ridership),
+    (
+        ("time_block_ridership_df", "stations_time_block_ridership_df"),
+        get_time_block_ridership,
+    ),
+    (("stations_df",), get_stations),
+    (("fare_class_ridership_df",), get_fare_class_ridership),
+    (("metrics",), get_key_metrics),
+    (("station_stats_df",), get_stations_stats_df),
+    (("borough_stats_df",), get_borough_stats_df),
+    (("line_stats_df",), get_line_stats_df),
+]
+
+# Concurrent requests for the same range share one computation
+_aggregation_flights = SingleFlight("aggregations")
+
+# Input shared with forked worker processes, inherited instead of pickled.
+# Set and forked under the lock, so one process mode run happens at a time
+_shared_df = None
+_shared_inputs = {}
+_shared_lock = Lock()
+
+
+def _timed_call(func, df):
+    """Call an aggregation and return its result with the elapsed time."""
+    start = time.perf_counter()
+    result = func(df)
+    return result, time.perf_counter() - start
+
+
+def _timed_call_shared(func):
+    """
+    Call an aggregation on the data inherited from the parent process. The
+    undecorated function runs, as the metrics and log locks may have been
+    held by another of the parent's threads when it forked.
+    """
+    frame = _shared_inputs.get(func.__name__, _shared_df)
+    return _timed_call(getattr(func, "__wrapped__", func), frame)
+
+
+def _run_in_processes(funcs, df, inputs, max_workers):
+    """
+    Run aggregations in forked processes that share the parent's data. The
+    server forks while its other threads run, so the children only run the
+    pandas code of the aggregations, and concurrent runs wait for each other.
+    """
+    global _shared_df, _shared_inputs
+    with _shared_lock:
+        _shared_df, _shared_inputs = df, inputs
+        try:
+            context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers, mp_context=context) as pool:
+                return list(pool.map(_timed_call_shared, funcs))
+        finally:
+            _shared_df, _shared_inputs = None, {}
+
+
+@instrument
+def run_aggregations(df, mode=None, max_workers=None, inputs=None):
+    """
+    Run all aggregations on the filtered data, either one after another or
+    concurrently on a thread or process pool. inputs maps aggregation names
+    to a different input frame, such as a rollup, for that aggregation.
+    """
+    mode = mode or AGGREGATION_MODE
+    max_workers = max_workers or AGGREGATION_WORKERS
+    inputs = inputs or {}
+    funcs = [func for _, func in AGGREGATIONS]
+    frames = [inputs.get(func.__name__, df) for func in funcs]
+
+    if mode == "process" and "fork" not in multiprocessing.get_all_start_methods():
+        logger.warning("Process mode requires fork, falling back to threads.")
+        mode = "thread"
+
+    start = time.perf_counter()
+    if mode == "serial":
+        results = [_timed_call(func, frame) for func, frame in zip(funcs, frames)]
+    elif mode == "thread":
+        with ThreadPoolExecutor(max_workers) as pool:
+            results = list(pool.map(_timed_call, funcs, frames))
+    elif mode == "process":
+        results = _run_in_processes(funcs, df, inputs, max_workers)
+    else:
+        raise ValueError(f"Unknown aggregation mode: {mode}")
+    total = time.perf_counter() - start
 
-    return ridership_df, default_dates
+    data = {}
+    for (keys, func), (result, elapsed) in zip(AGGREGATIONS, results):
+        logger.debug(
+            "%s took %.3fs",
+            func.__name__,
+            elapsed,
+            extra={"stage": func.__name__, "duration_ms": round(elapsed * 1000, 3)},
+        )
+        if len(keys) == 1:
+            result = (result,)
+        data.update(zip(keys, result))
+    logger.info(
+        "Aggregations (%s) on %d rows took %.3fs",
+        mode,
+        len(df),
+        total,
+        extra={"stage": "aggregations", "duration_ms": round(total * 1000, 3)},
+    )
 
+    return data
+
+
+@instrument
+def get_data_version(df):
+    """Fingerprint the ridership data so derived results can be keyed by version."""
+    hashed = pd.util.hash_pandas_object(
+        df[["transit_timestamp", "station_complex", "ridership"]], index=False
+    )
+    return hashlib.sha1(hashed.to_numpy().tobytes()).hexdigest()[:16]
 
+
+def get_source_version():
+    """Fingerprint the data files, or None when they are missing."""
+    try:
+        return file_fingerprint([DATA_DIR + file for file in DATA_FILES])
+    except FileNotFoundError:
+        return None
+
+
+def _row_hashes(raw_df):
+    """Hash of every raw row over all of its columns, as clean_data keeps them all."""
+    return pd.util.hash_pandas_object(raw_df, index=False).to_numpy()
+
+
+def _digest(row_hashes):
+    """Fingerprint of raw rows that does not depend on their order."""
+    return str(row_hashes.sum())
+
+
+def _read_cached_ridership(cached):
+    """Split a cached ridership entry into its frame, version, sample and rollups."""
+    ridership_df = cached.pop("ridership_df")
+    # Parquet returns list columns as arrays
+    ridership_df["lines"] = ridership_df["lines"].map(list)
+    version = cached.pop("version")
+    sample = cached.pop("sample_df")
+    sample["lines"] = sample["lines"].map(list)
+    rollups = {key.removeprefix("rollup_"): value for key, value in cached.items()}
+    return ridership_df, version, sample, rollups
+
+
+def _remember_source(source_version, raw_end, raw_digest):
+    if not DISK_CACHE:
+        return
+    try:
+        with open(LATEST_SOURCE_FILE, "w") as f:
+            json.dump(
+                {
+                    "source_version": source_version,
+                    "end": raw_end.isoformat(),
+                    "digest": raw_digest,
+                },
+                f,
+            )
+    except OSError as e:
+        logger.warning("Could not record the data source: %s", e)
+
+
+def _latest_source():
+    """The source files last loaded, see _remember_source, or None."""
+    try:
+        with open(LATEST_SOURCE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _extend_cached(ridership_data, timestamps, latest, row_hashes):
+    """
+    The cleaned data and rollups of the latest source files extended with
+    the raw rows newer than them, or None when the files changed in other
+    ways. Only the new rows are cleaned and folded into the rollups.
+    """
+    if latest.get("digest") is None:
+        return None
+    old_rows = (timestamps <= pd.Timestamp(latest["end"])).to_numpy()
+    if old_rows.all() or _digest(row_hashes[old_rows]) != latest["digest"]:
+        return None
+    cached = load_results("ridership", latest["source_version"])
+    if not cached:
+        return None
+    old_df, _, _, rollups = _read_cached_ridership(cached)
+    new_df = clean_data(ridership_data[~old_rows].copy())
+    logger.info(
+        "Extending cached data of %d rows with %d new rows", len(old_df), len(new_df)
+    )
+    # update_rollups expects the new rows before the old ones
+    ridership_df = pd.concat([new_df, old_df], ignore_index=True)
+    for column in FARE_DIMENSIONS:
+        ridership_df[column] = ridership_df[column].astype("category")
+    return ridership_df, update_rollups(rollups, new_df)
+
+
+def get_data():
+    """
+    Load and clean data, reusing the cleaned frame cached for the source
+    files, or extending the last one when the files only gained newer rows.
+    """
+    source_version = get_source_version()
+    cached = source_version and load_results("ridership", source_version)
+    if cached:
+        ridership_df, version, sample, rollups = _read_cached_ridership(cached)
+    else:
+        ridership_data = load_data()
+        timestamps = pd.to_datetime(ridership_data["transit_timestamp"])
+        latest = source_version and _latest_source()
+        # Raw rows are only hashed when there are recorded ones to compare
+        # them with, so the first load records no digest
+        row_hashes = _row_hashes(ridership_data) if latest else None
+        extended = latest and _extend_cached(
+            ridership_data, timestamps, latest, row_hashes
+        )
+        if extended:
+            ridership_df, rollups = extended
+        else:
+            ridership_df = clean_data(ridership_data)
+            rollups = build_rollups(ridership_df)
+        version = get_data_version(ridership_df)
+        sample = build_sample(ridership_df)
+        if source_version:
+            store_results(
+                "ridership",
+                {
+                    "ridership_df": ridership_df,
+                    "version": version,
+                    "sample_df": sample,
+                    **{f"rollup_{key}": value for key, value in rollups.items()},
+                },
+                source_version,
+            )
+            _remember_source(
+                source_version,
+                timestamps.max(),
+                None if row_hashes is None else _digest(row_hashes),
+            )
+    register_rollups(version, rollups, ridership_df)
+    register_sample(version, sample)
+    default_dates = get_default_dates(ridership_df)
+
+    return ridership_df, default_dates, version
+
+
+def _usable_rollups(start_date, end_date, version, filters):
+    """The rollups of a version if they can answer the request, else None."""
+    if not ROLLUPS or not version or None in (start_date, end_date):
+        return None
+    if any((filters or {}).values()):
+        return None
+    return get_rollups(version)
+
+
+def processed_cache_key(version, start_date, end_date, filters=None):
+    """Key of the processed data of a request in the disk cache."""
+    key = (version, *normalize_range(start_date, end_date))
+    filters = tuple(
+        (column, tuple(sorted(values)))
+        for column, values in sorted((filters or {}).items())
+        if values
+    )
+    return key + (filters,) if filters else key
+
+
+def query_source(start_date, end_date, version=None, filters=None):
+    """
+    Where the aggregations of a request are read from: "cache" when they are
+    in the disk cache, "rollups" when the rollups can answer it, else "rows"
+    for a scan of the hourly rows.
+    """
+    if version and contains(
+        "aggregations", *processed_cache_key(version, start_date, end_date, filters)
+    ):
+        return "cache"
+    if _usable_rollups(start_date, end_date, version, filters) is not None:
+        return "rollups"
+    return "rows"
+
+
+def plan_inputs(ridership_df, start_date, end_date, version=None, filters=None):
+    """
+    Pick the input of the aggregations for a range. Without fare filters it
+    is read from the rollups: summed by station, day of week and hour from
+    the coarsest periods that cover the range exactly, with the trend and
+    fare class charts reading hourly totals. Filtered ranges, and data
+    without rollups, read the hourly rows.
+    """
+    rollups = _usable_rollups(start_date, end_date, version, filters)
+    if rollups is not None:
+        return query_rollups(rollups, start_date, end_date)
+    return filter_data(ridership_df, start_date, end_date, filters), None
+
+
+def get_station_hours(ridership_df, start_date, end_date, version=None, filters=None):
+    """
+    Ridership by station and hour of a range, read from the rollups'
+    station-hour totals when they can answer it, else the filtered hourly
+    rows with one row per fare class.
+    """
+    columns = ["transit_timestamp", "station_complex", "ridership"]
+    rollups = _usable_rollups(start_date, end_date, version, filters)
+    if rollups is None:
+        return filter_data(ridership_df, start_date, end_date, filters)[columns]
+    station_hourly = rollups["station_hourly"]
+    first, last = row_positions(
+        station_hourly["transit_timestamp"].to_numpy(),
+        pd.Timestamp(start_date),
+        pd.Timestamp(end_date),
+        inclusive=True,
+    )
+    return station_hourly.iloc[first:last][columns]
+
+
+def _get_cached_aggregations(filtered_df, inputs, cache_key):
+    aggregations = load_results("aggregations", *cache_key)
+    if aggregations is None:
+        aggregations = run_aggregations(filtered_df, inputs=inputs)
+        store_results("aggregations", aggregations, *cache_key)
+    return aggregations
+
+
+@instrument
 def get_processed_data(
-    ridership_df: pd.DataFrame = None, start_date=None, end_date=None
+    ridership_df: pd.DataFrame = None,
+    start_date=None,
+    end_date=None,
+    version=None,
+    filters=None,
+    filtered_df=None,
 ) -> tuple:
-    """Load and process data."""
+    """
+    Load and process data, optionally filtered to the selected values of the
+    FARE_DIMENSIONS columns. With the dataset version the aggregations are
+    read from and written to the disk cache. filtered_df holds the rows of
+    the range when they were already filtered, see get_processed_ranges.
+    """
     data = {}
     data["dates"] = (start_date, end_date)
     if ridership_df is None:
-        ridership_df, default_dates = get_data()
+        ridership_df, default_dates, version = get_data()
         start_date, end_date = default_dates
         data["ridership_df"] = ridership_df
         data["dates"] = default_dates
+        data["version"] = version
+        DATASET_ROWS.set(len(ridership_df), frame="ridership")
 
-    filtered_df = filter_data(ridership_df, start_date, end_date)
+    if filtered_df is None:
+        filtered_df, inputs = plan_inputs(
+            ridership_df, start_date, end_date, version, filters
+        )
+    else:
+        inputs = None
     data["filtered_df"] = filtered_df
+    DATASET_ROWS.set(len(filtered_df), frame="filtered")
+    if version is None:
+        data.update(run_aggregations(filtered_df, inputs=inputs))
+        return data
 
-    data["hourly_ridership_df"] = get_hourly_ridership(filtered_df)
-    data["weekly_ridership_df"], data["station_weekly_ridership_df"] = (
-        get_weekly_ridership(filtered_df)
-    )
-    data["time_block_ridership_df"], data["stations_time_block_ridership_df"] = (
-        get_time_block_ridership(filtered_df)
+    data["cache_key"] = processed_cache_key(version, start_date, end_date, filters)
+    data.update(
+        _aggregation_flights.do(
+            data["cache_key"],
+            _get_cached_aggregations,
+            filtered_df,
+            inputs,
+            data["cache_key"],
+        )
     )
-    data["stations_df"] = get_stations(filtered_df)
-    data["metrics"] = get_key_metrics(filtered_df)
-    data["station_stats_df"] = get_stations_stats_df(filtered_df)
-    data["borough_stats_df"] = get_borough_stats_df(filtered_df)
-    data["line_stats_df"] = get_line_stats_df(filtered_df)
 
     return data
+
+
+@instrument
+def get_processed_ranges(ridership_df, ranges, version=None, filters=None):
+    """
+    Processed data of several date ranges, such as a range and the baseline
+    it is compared with. The ranges that read the hourly rows are filtered
+    together in one pass, while each range is aggregated and cached on its
+    own, so a later request for either side is read from the disk cache.
+    """
+    ranges = [tuple(date_range) for date_range in ranges]
+    scans = [
+        date_range
+        for date_range in ranges
+        if query_source(*date_range, version, filters) == "rows"
+    ]
+    frames = dict(zip(scans, filter_ranges(ridership_df, scans, filters)))
+    return [
+        get_processed_data(
+            ridership_df,
+            start_date,
+            end_date,
+            version=version,
+            filters=filters,
+            filtered_df=frames.get((start_date, end_date)),
+        )
+        for start_date, end_date in ranges
+    ]
+
+
+@instrument
+def get_approximate_data(start_date, end_date, version, filters=None) -> dict:
+    """
+    Processed data estimated from the stratified sample of a dataset version,
+    with the margins of error of the key metrics in data["approximate"].
+    Returns None when exact results are quick: answered from the rollups or
+    the disk cache, or scanning fewer than PROGRESSIVE_MIN_ROWS hourly rows.
+    """
+    sample = get_sample(version) if PROGRESSIVE and version else None
+    if sample is None or query_source(start_date, end_date, version, filters) != "rows":
+        return None
+    sample_df = filter_data(sample, start_date, end_date, filters)
+    if sample_df.empty or len(sample_df) * SAMPLE_STEP < PROGRESSIVE_MIN_ROWS:
+        return None
+
+    data = {"dates": (start_date, end_date), "filtered_df": sample_df}
+    data.update(run_aggregations(sample_df))
+    data["approximate"] = error_bounds(sample_df, data["metrics"])
+    return data
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+from importlib.util import find_spec
+import pandas as pd
+from helper import get_code_version
+from metrics import instrument, record_cache, Gauge
+from serializer import encode
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Parquet needs pyarrow or fastparquet, without either the cache is disabled
+PARQUET_AVAILABLE = any(find_spec(name) for name in ("pyarrow", "fastparquet"))
+DISK_CACHE = os.environ.get("MTA_DISK_CACHE", "1") == "1" and PARQUET_AVAILABLE
+CACHE_DIR = os.environ.get("MTA_CACHE_DIR", "cache")
+# Least recently used entries are evicted beyond this total size
+CACHE_MAX_BYTES = int(float(os.environ.get("MTA_CACHE_MAX_MB", 1024)) * 1024**2)
+
+MANIFEST = "manifest.json"
+# Every key includes the code version, so a deploy never reads stale results
+CODE_VERSION = get_code_version()
+
+CACHE_BYTES = Gauge("mta_disk_cache_bytes", "Total size of the disk cache.")
+
+
+def cache_key(namespace, *parts):
+    """Content address of a result: namespace, key parts and code version."""
+    key = json.dumps([namespace, CODE_VERSION, *parts], default=str)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _entry_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path))
+
+
+def _write_entry(path, results):
+    """Write frames as Parquet and everything else as one JSON document."""
+    os.makedirs(path)
+    frames, values = [], {}
+    for name, value in results.items():
+        if isinstance(value, pd.DataFrame):
+            value.to_parquet(os.path.join(path, f"{name}.parquet"))
+            frames.append(name)
+        else:
+            values[name] = value
+    with open(os.path.join(path, "values.json"), "wb") as f:
+        f.write(encode(values))
+    # Written last, an entry without a manifest is incomplete
+    with open(os.path.join(path, MANIFEST), "w") as f:
+        json.dump({"keys": list(results), "frames": frames}, f)
+
+
+def _read_entry(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    with open(os.path.join(path, "values.json"), "rb") as f:
+        values = json.loads(f.read())
+    frames = {
+        name: pd.read_parquet(os.path.join(path, f"{name}.parquet"))
+        for name in manifest["frames"]
+    }
+    return {
+        name: frames[name] if name in frames else values[name]
+        for name in manifest["keys"]
+    }
+
+
+def contains(namespace, *parts):
+    """Check for a complete entry without reading it."""
+    path = os.path.join(CACHE_DIR, cache_key(namespace, *parts))
+    return DISK_CACHE and os.path.exists(os.path.join(path, MANIFEST))
+
+
+@instrument
+def load_results(namespace, *parts):
+    """Return the cached results for a key, or None on a miss."""
+    if not DISK_CACHE:
+        return None
+    path = os.path.join(CACHE_DIR, cache_key(namespace, *parts))
+    if not os.path.exists(os.path.join(path, MANIFEST)):
+        record_cache(f"disk_{namespace}", hit=False)
+        return None
+    try:
+        results = _read_entry(path)
+    except FileNotFoundError:
+        # Evicted by another thread while being read
+        record_cache(f"disk_{namespace}", hit=False)
+        return None
+    except Exception:
+        logger.warning("Discarding unreadable cache entry %s", path, exc_info=True)
+        shutil.rmtree(path, ignore_errors=True)
+        record_cache(f"disk_{namespace}", hit=False)
+        return None
+    # The manifest's mtime orders entries for eviction
+    try:
+        os.utime(os.path.join(path, MANIFEST))
+    except OSError:
+        # Evicted since it was read, the results are still valid
+        pass
+    record_cache(f"disk_{namespace}", hit=True)
+    return results
+
+
+@instrument
+def store_results(namespace, results, *parts):
+    """Write results to the cache and evict old entries beyond the size limit."""
+    if not DISK_CACHE:
+        return
+    key = cache_key(namespace, *parts)
+    path = os.path.join(CACHE_DIR, key)
+    tmp_path = os.path.join(CACHE_DIR, f".{key}.{uuid.uuid4().hex}.tmp")
+    try:
+        _write_entry(tmp_path, results)
+        os.rename(tmp_path, path)
+    except OSError as e:
+        # Another worker stored the same key first, or the disk is unavailable
+        if not os.path.exists(os.path.join(path, MANIFEST)):
+            logger.warning("Could not write cache entry %s: %s", path, e)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    except Exception:
+        logger.warning("Could not cache %s results", namespace, exc_info=True)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    evict()
+
+
+def evict(max_bytes=None):
+    """
+    Delete least recently used entries until the cache fits in max_bytes.
+    Entries removed by another thread or process while scanning are skipped.
+    """
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        manifest = os.path.join(entry.path, MANIFEST)
+        if entry.name.startswith(".") or not os.path.exists(manifest):
+            continue
+        try:
+            entries.append((os.stat(manifest).st_mtime, _entry_size(entry.path), entry))
+        except OSError:
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries, key=lambda item: item[0]):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total -= size
+        logger.debug("Evicted cache entry %s (%d bytes)", entry.name, size)
+    CACHE_BYTES.set(total)
+
+
+def file_fingerprint(paths):
+    """Identify source files by name, size and modification time."""
+    stats = []
+    for path in paths:
+        stat = os.stat(path)
+        stats.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1(json.dumps(stats).encode("utf-8")).hexdigest()[:16]
@@ -0,0 +1,187 @@
+import io
+import logging
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import Response, abort, request, stream_with_context
+from data import AGGREGATIONS, get_processed_data
+from metrics import Counter
+from rollups import FARE_DIMENSIONS, row_positions
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Rows per CSV chunk or Parquet row group, which bounds an export's memory
+EXPORT_CHUNK_ROWS = int(os.environ.get("MTA_EXPORT_CHUNK_ROWS", 100_000))
+MIME_TYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+# Exportable tables of the processed data by name, e.g. station_stats
+TABLES = {
+    key.removesuffix("_df"): key
+    for keys, _ in AGGREGATIONS
+    for key in keys
+    if key.endswith("_df")
+}
+
+# Download menu entries as (table, format, label)
+EXPORT_LINKS = [
+    ("ridership", "csv", "Hourly rows (CSV)"),
+    ("ridership", "parquet", "Hourly rows (Parquet)"),
+    ("station_stats", "csv", "Station stats (CSV)"),
+    ("borough_stats", "csv", "Borough stats (CSV)"),
+    ("line_stats", "csv", "Line stats (CSV)"),
+]
+
+EXPORTS = Counter("mta_exports_total", "Exports by table and format.")
+
+
+def request_query(data):
+    """Date range and fare filters of a request, defaulting to the full range."""
+    start_date = request.args.get("start_date", data["dates"][0])
+    end_date = request.args.get("end_date", data["dates"][1])
+    filters = {column: request.args.getlist(column) for column in FARE_DIMENSIONS}
+    return start_date, end_date, filters
+
+
+def iter_rows(df, start_date, end_date, filters=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Yield the hourly rows of a range in chunks. The range is located in the
+    descending timestamps by binary search and the fare filters are applied
+    chunk by chunk, so no copy of the whole range is made.
+    """
+    first, last = row_positions(
+        df["transit_timestamp"].to_numpy(),
+        pd.Timestamp(start_date),
+        pd.Timestamp(end_date),
+        inclusive=True,
+    )
+    for lo in range(first, last, chunk_rows):
+        chunk = df.iloc[lo : min(lo + chunk_rows, last)]
+        for column, values in (filters or {}).items():
+            if values:
+                chunk = chunk[chunk[column].isin(values)]
+        if len(chunk):
+            yield chunk
+
+
+def iter_chunks(df, chunk_rows=EXPORT_CHUNK_ROWS):
+    for lo in range(0, len(df), chunk_rows):
+        yield df.iloc[lo : lo + chunk_rows]
+
+
+def _csv_ready(chunk):
+    # Lists such as the lines of a station are written as "1, 2, 3"
+    if "lines" in chunk:
+        chunk = chunk.assign(lines=chunk["lines"].str.join(", "))
+    return chunk
+
+
+def stream_csv(columns, chunks):
+    """Yield a CSV file chunk by chunk, starting with the header."""
+    yield pd.DataFrame(columns=columns).to_csv(index=False)
+    for chunk in chunks:
+        yield _csv_ready(chunk).to_csv(index=False, header=False)
+
+
+class _ByteChunks(io.RawIOBase):
+    """Write-only file collecting bytes until they are drained."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        payload = b"".join(self.chunks)
+        self.chunks = []
+        return payload
+
+
+def stream_parquet(columns, chunks):
+    """
+    Yield a Parquet file with one row group per chunk, sending each row
+    group as soon as it is written. The schema is taken from the first chunk.
+    """
+    sink, writer = _ByteChunks(), None
+    for chunk in chunks:
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        yield sink.drain()
+    if writer is None:
+        empty = pd.DataFrame(columns=columns)
+        writer = pq.ParquetWriter(sink, pa.Schema.from_pandas(empty, False))
+    writer.close()
+    yield sink.drain()
+
+
+STREAMS = {"csv": stream_csv, "parquet": stream_parquet}
+
+
+def _filename(name, start_date, end_date, fmt):
+    start, end = (
+        pd.Timestamp(date).strftime("%Y%m%d") for date in (start_date, end_date)
+    )
+    return f"{name}_{start}_{end}.{fmt}"
+
+
+def export_response(data, name, fmt):
+    """Stream the hourly rows or a processed table of the requested range."""
+    start_date, end_date, filters = request_query(data)
+    ridership_df = data["ridership_df"]
+    if name == "ridership":
+        columns = ridership_df.columns
+        chunks = iter_rows(ridership_df, start_date, end_date, filters)
+    elif name in TABLES:
+        table = get_processed_data(
+            ridership_df,
+            start_date,
+            end_date,
+            version=data["version"],
+            filters=filters,
+        )[TABLES[name]]
+        columns, chunks = table.columns, iter_chunks(table)
+    else:
+        abort(404)
+
+    EXPORTS.inc(table=name, format=fmt)
+    filename = _filename(name, start_date, end_date, fmt)
+    logger.info("Exporting %s", filename, extra={"path": request.path})
+    return Response(
+        stream_with_context(STREAMS[fmt](columns, chunks)),
+        mimetype=MIME_TYPES[fmt],
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+def register_export_route(app, data, backend=None):
+    """
+    Serve exports at /export/<table>.<csv|parquet> on a Dash app's or Flask
+    server, where table is "ridership" for the hourly rows or one of TABLES.
+    With a query service backend the export is streamed from it.
+    """
+    server = getattr(app, "server", app)
+
+    @server.route("/export/<name>.<any(csv, parquet):fmt>")
+    def export(name, fmt):
+        if backend is None:
+            return export_response(data, name, fmt)
+        response = backend.stream_export(name, fmt, request.args.items(multi=True))
+        return Response(
+            stream_with_context(response.iter_content(chunk_size=None)),
+            status=response.status_code,
+            content_type=response.headers.get("Content-Type"),
+            headers={
+                "Content-Disposition": response.headers.get("Content-Disposition", "")
+            },
+        )
@@ -0,0 +1,439 @@
+import json
+import logging
+import os
+from threading import Lock
+import numpy as np
+import pandas as pd
+from data import get_station_hours
+from disk_cache import CACHE_DIR, DISK_CACHE, load_results, store_results
+from metrics import instrument, record_cache
+from single_flight import SingleFlight
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Weekly lags the regression forecasts from, e.g. 2 for the same hour one and
+# two weeks earlier
+FORECAST_LAGS = int(os.environ.get("MTA_FORECAST_LAGS", 4))
+# Weeks of hours the regression of every station is fit on
+FORECAST_TRAIN_WEEKS = int(os.environ.get("MTA_FORECAST_TRAIN_WEEKS", 8))
+# Ridge penalty of the lag weights in hours of each station's mean squared
+# ridership, so one setting suits busy and quiet stations
+FORECAST_ALPHA = float(os.environ.get("MTA_FORECAST_ALPHA", 1))
+
+# Hours in a week, the forecast horizon and the seasonal period
+WEEK = 168
+# Weeks of actual ridership shown before the forecast
+HISTORY_WEEKS = 2
+
+# Cache key of the latest forecast, whose stored model a forecast of the
+# extended data is updated from after a restart
+LATEST_FORECAST_FILE = os.path.join(CACHE_DIR, "latest_forecast.json")
+
+# Model of the latest dataset version, see register_forecast_model
+_model = {}
+_model_lock = Lock()
+# Forecasts of each dataset version
+_forecasts = {}
+_forecast_flights = SingleFlight("forecasts")
+
+
+def _lags(n_hours):
+    """Weekly lags a window of hours can fit, leaving a week of targets."""
+    return max(min(FORECAST_LAGS, n_hours // WEEK - 1), 0)
+
+
+def _window_hours(lags):
+    return WEEK * (FORECAST_TRAIN_WEEKS + lags)
+
+
+def station_matrix(station_hours, stations, first_hour, n_hours):
+    """Station x hour matrix of ridership, 0 for hours without rows."""
+    rows = pd.Categorical(
+        station_hours["station_complex"], categories=stations
+    ).codes.astype(np.int64)
+    columns = (
+        station_hours["transit_timestamp"].to_numpy() - np.datetime64(first_hour)
+    ) // np.timedelta64(1, "h")
+    keep = (rows >= 0) & (columns >= 0) & (columns < n_hours)
+    shape = (len(stations), n_hours)
+    return np.bincount(
+        rows[keep] * n_hours + columns[keep],
+        station_hours["ridership"].to_numpy(dtype=float)[keep],
+        np.prod(shape),
+    ).reshape(shape)
+
+
+def _features(matrix, lags, first, last):
+    """
+    Features of the target hours first to last of every station, shape
+    (stations, 1 + lags, hours): an intercept and the ridership of the same
+    hour 1 to lags weeks earlier.
+    """
+    features = np.ones((len(matrix), 1 + lags, last - first))
+    for lag in range(1, lags + 1):
+        features[:, lag] = matrix[:, first - lag * WEEK : last - lag * WEEK]
+    return features
+
+
+def _statistics(matrix, lags, first, last):
+    """
+    Sufficient statistics of the least squares fit of every station over
+    the target hours first to last: the Gram matrices X'X and moments X'y.
+    """
+    features = _features(matrix, lags, first, last)
+    gram = np.einsum("sph,sqh->spq", features, features)
+    moment = np.einsum("sph,sh->sp", features, matrix[:, first:last])
+    return gram, moment
+
+
+def _solve(gram, moment):
+    """Ridge weights of every station at once, the intercept unpenalized."""
+    lags = np.arange(1, gram.shape[1])
+    penalty = np.zeros_like(gram)
+    if len(lags):
+        # Mean squared ridership per target hour, at least 1 so stations
+        # without riders still have a solution
+        hours = np.maximum(gram[:, 0, 0], 1)
+        scale = np.maximum(gram[:, lags, lags].mean(axis=1) / hours, 1)
+        penalty[:, lags, lags] = FORECAST_ALPHA * scale[:, None]
+    return np.linalg.solve(gram + penalty, moment[..., None])[..., 0]
+
+
+def _model_from(matrix, stations, end, lags):
+    """Model of a window of hours ending at end, fit over all its targets."""
+    gram, moment = _statistics(matrix, lags, lags * WEEK, matrix.shape[1])
+    return {
+        "stations": stations,
+        "end": end,
+        "lags": lags,
+        "matrix": matrix,
+        "gram": gram,
+        "moment": moment,
+        "weights": _solve(gram, moment),
+    }
+
+
+@instrument
+def fit_forecast(station_hours, stations, end):
+    """
+    Fit the regression of every station on the hours of station_hours up to
+    the hour end, keeping the last FORECAST_TRAIN_WEEKS weeks of targets
+    and the hours their lags need.
+    """
+    end = pd.Timestamp(end).floor("h")
+    first = pd.Timestamp(station_hours["transit_timestamp"].min()).floor("h")
+    n_hours = max((end - first) // pd.Timedelta(hours=1) + 1, 0)
+    lags = _lags(n_hours)
+    n_hours = min(n_hours, _window_hours(lags))
+    first = end - pd.Timedelta(hours=n_hours - 1)
+    matrix = station_matrix(station_hours, stations, first, n_hours)
+    return _model_from(matrix, stations, end, lags)
+
+
+@instrument
+def update_forecast(model, new_station_hours):
+    """
+    Fold newly ingested hours into a model, as update_rollups does for the
+    rollups: the statistics of the new target hours are added, those of the
+    hours leaving the training window subtracted and the weights solved
+    again. The hours must follow the model's last hour.
+    """
+    new_end = pd.Timestamp(new_station_hours["transit_timestamp"].max()).floor("h")
+    n_new = (new_end - model["end"]) // pd.Timedelta(hours=1)
+    if n_new <= 0:
+        return model
+    new = station_matrix(
+        new_station_hours,
+        model["stations"],
+        model["end"] + pd.Timedelta(hours=1),
+        n_new,
+    )
+    matrix = np.hstack([model["matrix"], new])
+    lags = _lags(matrix.shape[1])
+    if lags != model["lags"]:
+        # Enough history for another lag, which changes every feature
+        matrix = matrix[:, -_window_hours(lags) :]
+        return _model_from(matrix, model["stations"], new_end, lags)
+
+    n_hours = model["matrix"].shape[1]
+    gram, moment = _statistics(matrix, lags, n_hours, matrix.shape[1])
+    gram, moment = model["gram"] + gram, model["moment"] + moment
+    dropped = matrix.shape[1] - _window_hours(lags)
+    if dropped > 0:
+        start = lags * WEEK
+        old_gram, old_moment = _statistics(matrix, lags, start, start + dropped)
+        gram, moment = gram - old_gram, moment - old_moment
+        matrix = matrix[:, dropped:]
+    return {
+        **model,
+        "end": new_end,
+        "matrix": matrix,
+        "gram": gram,
+        "moment": moment,
+        "weights": _solve(gram, moment),
+    }
+
+
+def predict(model):
+    """
+    Forecasts of the week after the model's last hour, shape (stations,
+    hours): the seasonal naive forecast repeating the last week, and the
+    regression's, None without enough history for a lag.
+    """
+    matrix, lags = model["matrix"], model["lags"]
+    n_hours = matrix.shape[1]
+    if n_hours < WEEK:
+        return None, None
+    seasonal_naive = matrix[:, -WEEK:]
+    if not lags:
+        return seasonal_naive, None
+    # Every lag of the next week's hours is an observed hour
+    padded = np.hstack([matrix, np.zeros((len(matrix), WEEK))])
+    features = _features(padded, lags, n_hours, n_hours + WEEK)
+    regression = np.einsum("sp,sph->sh", model["weights"], features)
+    return seasonal_naive, regression.clip(0)
+
+
+def backtest(model):
+    """
+    Mean absolute error of both forecasts of every station over the model's
+    last week, with the regression fit without it. NaN when fewer than two
+    weeks of targets remain.
+    """
+    matrix, lags = model["matrix"], model["lags"]
+    n_hours = matrix.shape[1]
+    first = n_hours - WEEK
+    missing = np.full(len(matrix), np.nan)
+    if not lags or first - WEEK < lags * WEEK:
+        return missing, missing
+    actual = matrix[:, first:]
+    seasonal_naive = np.abs(actual - matrix[:, first - WEEK : n_hours - WEEK])
+    gram, moment = _statistics(matrix, lags, first, n_hours)
+    weights = _solve(model["gram"] - gram, model["moment"] - moment)
+    features = _features(matrix, lags, first, n_hours)
+    regression = np.einsum("sp,sph->sh", weights, features).clip(0)
+    return seasonal_naive.mean(axis=1), np.abs(actual - regression).mean(axis=1)
+
+
+def forecast_results(model):
+    """
+    Frames of the forecast tab: forecast_df with both forecasts of every
+    station and hour of the next week, history_df with the actual ridership
+    of the weeks before, and accuracy_df with each forecast's backtest error.
+    """
+    stations = model["stations"]
+    matrix = model["matrix"]
+    seasonal_naive, regression = predict(model)
+    hours = pd.date_range(model["end"] + pd.Timedelta(hours=1), periods=WEEK, freq="h")
+    if seasonal_naive is None:
+        seasonal_naive = np.zeros((len(stations), 0))
+        hours = hours[:0]
+    if regression is None:
+        regression = np.full_like(seasonal_naive, np.nan)
+    forecast_df = pd.DataFrame(
+        {
+            "station_complex": np.repeat(stations, len(hours)),
+            "transit_timestamp": np.tile(hours, len(stations)),
+            "seasonal_naive": seasonal_naive.ravel(),
+            "ridge": regression.ravel(),
+        }
+    )
+    history = matrix[:, -HISTORY_WEEKS * WEEK :]
+    history_hours = pd.date_range(end=model["end"], periods=history.shape[1], freq="h")
+    history_df = pd.DataFrame(
+        {
+            "station_complex": np.repeat(stations, len(history_hours)),
+            "transit_timestamp": np.tile(history_hours, len(stations)),
+            "ridership": history.ravel(),
+        }
+    )
+    seasonal_naive_mae, ridge_mae = backtest(model)
+    accuracy_df = pd.DataFrame(
+        {
+            "station_complex": stations,
+            "seasonal_naive_mae": seasonal_naive_mae,
+            "ridge_mae": ridge_mae,
+        }
+    )
+    return {
+        "forecast_df": forecast_df,
+        "history_df": history_df,
+        "accuracy_df": accuracy_df,
+        "lags": model["lags"],
+    }
+
+
+def station_forecast(results, station=None):
+    """
+    Actual and forecast ridership of one station, or summed over all
+    stations, by hour, with the station's backtest errors, or their mean
+    over stations.
+    """
+    selected = {}
+    for name in ("history_df", "forecast_df", "accuracy_df"):
+        df = results[name]
+        if station:
+            df = df[df["station_complex"] == station]
+        selected[name] = df.drop(columns="station_complex")
+    for name in ("history_df", "forecast_df"):
+        selected[name] = (
+            selected[name].groupby("transit_timestamp", as_index=False).sum(min_count=1)
+        )
+    errors = selected.pop("accuracy_df").mean()
+    for column, error in errors.items():
+        selected[column] = None if np.isnan(error) else float(error)
+    return selected
+
+
+def forecast_note(forecast):
+    """How the forecasts of a station did over the last week, or why none."""
+    if forecast["forecast_df"].empty:
+        return "Forecasts need at least a week of hourly data."
+    if forecast["forecast_df"]["ridge"].isna().all():
+        return (
+            "The regression needs two weeks of data, only the seasonal naive "
+            "forecast is shown."
+        )
+    if forecast["ridge_mae"] is None:
+        return "Backtesting the forecasts needs more weeks of data."
+    return (
+        "Backtest over the last week, mean absolute error per station and hour: "
+        f"{forecast['ridge_mae']:,.1f} riders for the regression, "
+        f"{forecast['seasonal_naive_mae']:,.1f} for the seasonal naive forecast."
+    )
+
+
+def _frame(array):
+    return pd.DataFrame(array, columns=[str(i) for i in range(array.shape[1])])
+
+
+def _model_results(model):
+    """
+    A model as results of the disk cache: its arrays as frames with a row per
+    station, the weights being solved again when it is read back.
+    """
+    return {
+        "model_matrix": _frame(model["matrix"]),
+        "model_gram": _frame(model["gram"].reshape(len(model["gram"]), -1)),
+        "model_moment": _frame(model["moment"]),
+        "model_stations": np.asarray(model["stations"]).tolist(),
+        "model_end": model["end"].isoformat(),
+        "model_lags": model["lags"],
+    }
+
+
+def _read_model(results):
+    """The model stored with forecast results, see _model_results."""
+    lags = results["model_lags"]
+    gram = results["model_gram"].to_numpy()
+    gram = gram.reshape(len(gram), lags + 1, lags + 1)
+    moment = results["model_moment"].to_numpy()
+    return {
+        "stations": np.array(results["model_stations"], dtype=object),
+        "end": pd.Timestamp(results["model_end"]),
+        "lags": lags,
+        "matrix": results["model_matrix"].to_numpy(),
+        "gram": gram,
+        "moment": moment,
+        "weights": _solve(gram, moment),
+    }
+
+
+def _remember_forecast(key):
+    if not DISK_CACHE:
+        return
+    try:
+        with open(LATEST_FORECAST_FILE, "w") as f:
+            json.dump({"key": list(key)}, f, default=str)
+    except OSError as e:
+        logger.warning("Could not record the latest forecast: %s", e)
+
+
+def _stored_model():
+    """
+    The model of the latest forecast in the disk cache, or None when there
+    is none or it was fit with other settings.
+    """
+    try:
+        with open(LATEST_FORECAST_FILE) as f:
+            key = json.load(f)["key"]
+    except (OSError, ValueError, KeyError):
+        return None
+    if key[1:] != [FORECAST_LAGS, FORECAST_TRAIN_WEEKS, FORECAST_ALPHA]:
+        return None
+    results = load_results("forecast", *key)
+    if not results or "model_matrix" not in results:
+        return None
+    return _read_model(results)
+
+
+def register_forecast_model(version, model):
+    """Keep the model of the latest dataset version for incremental refits."""
+    with _model_lock:
+        _model.clear()
+        _model[version] = model
+
+
+def get_forecast_model():
+    """
+    The latest model, read from the disk cache after a restart, or None
+    before the first fit.
+    """
+    with _model_lock:
+        model = next(iter(_model.values()), None)
+    return _stored_model() if model is None else model
+
+
+def _extends(model, station_hours, stations):
+    """Whether data holds the model's window unchanged and hours after it."""
+    if model is None or list(model["stations"]) != list(stations):
+        return False
+    n_hours = model["matrix"].shape[1]
+    first = model["end"] - pd.Timedelta(hours=n_hours - 1)
+    window = station_matrix(station_hours, stations, first, n_hours)
+    return np.array_equal(window, model["matrix"])
+
+
+@instrument
+def _build_forecast(data):
+    ridership_df = data["ridership_df"]
+    timestamps = ridership_df["transit_timestamp"]
+    # The rows are sorted newest first
+    first, end = timestamps.iloc[-1], timestamps.iloc[0]
+    station_hours = get_station_hours(ridership_df, first, end, data["version"])
+    stations = np.sort(data["stations_df"]["station_complex"].unique())
+    model = get_forecast_model()
+    newer = model is not None and end.floor("h") > model["end"]
+    if newer and _extends(model, station_hours, stations):
+        new_rows = station_hours["transit_timestamp"] > model["end"]
+        model = update_forecast(model, station_hours[new_rows])
+    else:
+        model = fit_forecast(station_hours, stations, end)
+    logger.info(
+        "Forecast fit for %d stations with %d weekly lags",
+        len(stations),
+        model["lags"],
+    )
+    register_forecast_model(data["version"], model)
+    return {**forecast_results(model), **_model_results(model)}
+
+
+def get_forecast(data):
+    """
+    Forecasts of the week after the data for every station, fit once per
+    dataset version and kept in memory and in the disk cache, together with
+    their model so the forecast of extended data updates it.
+    """
+    version = data["version"]
+    key = (version, FORECAST_LAGS, FORECAST_TRAIN_WEEKS, FORECAST_ALPHA)
+    results = _forecasts.get(version)
+    record_cache("forecast", hit=results is not None)
+    if results is None:
+        results = load_results("forecast", *key)
+        if results is None:
+            results = _forecast_flights.do(version, _build_forecast, data)
+            store_results("forecast", results, *key)
+            _remember_forecast(key)
+        _forecasts.clear()
+        _forecasts[version] = results
+    return results
@@ -0,0 +1,295 @@
+import logging
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import urlencode
+import numpy as np
+import pandas as pd
+from flask import Response, abort, request
+from plotly.colors import sample_colorscale, unlabel_rgb
+from data import get_station_hours, processed_cache_key
+from export import request_query
+from metrics import Counter, instrument, record_cache
+from single_flight import SingleFlight
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Side of a square tile in pixels
+TILE_SIZE = 256
+# Station-hour pyramids kept in memory, one per range and fare filters
+HEATMAP_RANGES = int(os.environ.get("MTA_HEATMAP_RANGES", 4))
+# Rendered PNG tiles kept in memory
+HEATMAP_TILES = int(os.environ.get("MTA_HEATMAP_TILES", 4096))
+# Longest range drawn, as the station x hour matrix grows with it; longer
+# ranges are drawn for their last days
+HEATMAP_MAX_DAYS = int(os.environ.get("MTA_HEATMAP_MAX_DAYS", 366))
+# Tile URLs carry the dataset version, so browsers may keep them for a day
+TILE_CACHE_CONTROL = "public, max-age=86400"
+HEATMAP_COLORSCALE = "Viridis"
+
+# Palette index 0 is transparent, for cells without data and tile padding
+PALETTE = bytes(
+    int(channel)
+    for color in ["rgb(0, 0, 0)"]
+    + sample_colorscale(HEATMAP_COLORSCALE, np.linspace(0, 1, 255))
+    for channel in unlabel_rgb(color)
+)
+
+TILES_SERVED = Counter("mta_heatmap_tiles_total", "Heatmap tiles served by level.")
+
+_pyramids = OrderedDict()
+_tiles = OrderedDict()
+_cache_lock = Lock()
+# Concurrent tile requests for one range share one pyramid build
+_pyramid_flights = SingleFlight("heatmap_pyramids")
+
+
+def heatmap_stations(stations_df):
+    """Rows of the heatmap: every station, grouped by borough and by name."""
+    return (
+        stations_df[["station_complex", "borough"]]
+        .drop_duplicates(subset=["station_complex"])
+        .sort_values(["borough", "station_complex"], ignore_index=True)
+    )
+
+
+def heatmap_range(start_date, end_date, bounds):
+    """
+    Range drawn for a requested one: within the data's first and last
+    timestamps and at most HEATMAP_MAX_DAYS long, keeping its end. Raises
+    ValueError or TypeError for dates that are missing or do not parse.
+    """
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    if pd.isna(start) or pd.isna(end):
+        raise ValueError("Missing heatmap date")
+    first, last = (pd.Timestamp(date) for date in bounds)
+    end = min(end, last)
+    start = max(start, first, end - pd.Timedelta(days=HEATMAP_MAX_DAYS))
+    return start, end
+
+
+def hour_span(start_date, end_date):
+    """First hour and number of hours of the columns of a range."""
+    first_hour = pd.Timestamp(start_date).ceil("h")
+    last_hour = pd.Timestamp(end_date).floor("h")
+    return first_hour, max((last_hour - first_hour) // pd.Timedelta(hours=1) + 1, 0)
+
+
+def _levels(cells):
+    """Zoom levels along an axis until one pixel is one cell, past the first."""
+    return max(int(np.ceil(np.log2(max(cells, 1) / TILE_SIZE))), 0)
+
+
+def heatmap_layout(stations, start_date, end_date, version, filters=None, bounds=None):
+    """
+    Geometry of the tile pyramid of a range, for the figure and the
+    clientside callback placing its tiles. Level 0 fits the whole matrix in
+    one tile and each level halves the hours and stations per pixel, until
+    an axis reaches one cell per pixel. With the data's dates as bounds the
+    range is limited as the tile route limits it, see heatmap_range.
+    """
+    if bounds is not None:
+        start_date, end_date = heatmap_range(start_date, end_date, bounds)
+    first_hour, n_hours = hour_span(start_date, end_date)
+    query = [("start_date", str(start_date)), ("end_date", str(end_date))]
+    for column, values in sorted((filters or {}).items()):
+        query += [(column, value) for value in values or ()]
+    boroughs = stations.groupby("borough", sort=False).indices
+    return {
+        "start": first_hour.value // 10**6,
+        "hours": int(n_hours),
+        "stations": len(stations),
+        "levels": [_levels(n_hours), _levels(len(stations))],
+        "size": TILE_SIZE,
+        "query": urlencode(query + [("v", version)]),
+        "boroughs": [
+            [borough, int(rows.min()), int(rows.max()) + 1]
+            for borough, rows in boroughs.items()
+        ],
+    }
+
+
+def _halve(sums, counts, axis):
+    """Sum pairs of neighbouring cells along an axis, padding odd lengths."""
+    if sums.shape[axis] % 2:
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (0, 1)
+        sums, counts = np.pad(sums, pad), np.pad(counts, pad)
+    shape = list(sums.shape)
+    shape[axis : axis + 1] = [shape[axis] // 2, 2]
+    return (
+        sums.reshape(shape).sum(axis=axis + 1),
+        counts.reshape(shape).sum(axis=axis + 1),
+    )
+
+
+@instrument
+def build_pyramid(station_hours, stations, first_hour, n_hours):
+    """
+    Build the levels of the tile pyramid from ridership by station and hour:
+    the station x hour matrix of mean station-hour ridership per cell at
+    every level, NaN where no row was read, and each level's maximum.
+    """
+    rows = pd.Categorical(
+        station_hours["station_complex"], categories=stations["station_complex"]
+    ).codes.astype(np.int64)
+    columns = (
+        station_hours["transit_timestamp"].to_numpy() - np.datetime64(first_hour)
+    ) // np.timedelta64(1, "h")
+    keep = (rows >= 0) & (columns >= 0) & (columns < n_hours)
+    cells = rows[keep] * n_hours + columns[keep]
+    shape = (len(stations), n_hours)
+    sums = np.bincount(
+        cells, station_hours["ridership"].to_numpy()[keep], np.prod(shape)
+    ).reshape(shape)
+    # Filtered ranges have a row per fare class, which are summed above; a
+    # cell counts once, so the finest level holds station-hour totals
+    counts = np.bincount(np.unique(cells), minlength=np.prod(shape)).reshape(shape)
+
+    levels_x, levels_y = _levels(n_hours), _levels(len(stations))
+    pyramid = []
+    for level in range(max(levels_x, levels_y), -1, -1):
+        with np.errstate(invalid="ignore"):
+            means = (sums / counts).astype(np.float32)
+        pyramid.append((means, float(np.nanmax(means, initial=0))))
+        # The next coarser level halves the axes that are not yet in one tile
+        if 0 < level <= levels_x:
+            sums, counts = _halve(sums, counts, axis=1)
+        if 0 < level <= levels_y:
+            sums, counts = _halve(sums, counts, axis=0)
+    return pyramid[::-1]
+
+
+def encode_png(indices, palette=PALETTE):
+    """Encode a 2-D array of palette indices as an 8-bit palette PNG."""
+    height, width = indices.shape
+
+    def chunk(kind, payload):
+        body = kind + payload
+        return (
+            struct.pack(">I", len(payload)) + body + struct.pack(">I", zlib.crc32(body))
+        )
+
+    # Every scanline starts with filter type 0 (none)
+    scanlines = np.hstack([np.zeros((height, 1), np.uint8), indices.astype(np.uint8)])
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)),
+            chunk(b"PLTE", palette),
+            chunk(b"tRNS", b"\x00"),
+            chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6)),
+            chunk(b"IEND", b""),
+        ]
+    )
+
+
+def render_tile(pyramid, level, tx, ty):
+    """
+    PNG of one tile of a level, with mean ridership on a log scale to the
+    level's maximum, or None when the tile is outside the matrix.
+    """
+    if not 0 <= level < len(pyramid) or tx < 0 or ty < 0:
+        return None
+    means, maximum = pyramid[level]
+    block = means[
+        ty * TILE_SIZE : (ty + 1) * TILE_SIZE, tx * TILE_SIZE : (tx + 1) * TILE_SIZE
+    ]
+    if block.size == 0:
+        return None
+    tile = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+    tile[: block.shape[0], : block.shape[1]] = block
+    scaled = np.log1p(np.nan_to_num(tile).clip(0)) / np.log1p(max(maximum, 1))
+    indices = np.where(np.isnan(tile), 0, 1 + np.round(scaled * 254))
+    return encode_png(indices)
+
+
+def _remember(cache, key, value, max_entries):
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+
+
+def _recall(cache, key):
+    with _cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def get_pyramid(data, stations, start_date, end_date, filters):
+    """Tile pyramid of a range, built once and kept for HEATMAP_RANGES ranges."""
+    key = processed_cache_key(data["version"], start_date, end_date, filters)
+    pyramid = _recall(_pyramids, key)
+    record_cache("heatmap_pyramid", hit=pyramid is not None)
+    if pyramid is None:
+        pyramid = _pyramid_flights.do(
+            key, _build_range_pyramid, data, stations, start_date, end_date, filters
+        )
+        _remember(_pyramids, key, pyramid, HEATMAP_RANGES)
+    return pyramid
+
+
+def _build_range_pyramid(data, stations, start_date, end_date, filters):
+    station_hours = get_station_hours(
+        data["ridership_df"], start_date, end_date, data["version"], filters
+    )
+    return build_pyramid(station_hours, stations, *hour_span(start_date, end_date))
+
+
+def get_tile(data, stations, start_date, end_date, filters, level, tx, ty):
+    """PNG of a tile, cached by dataset version, range, fare filters and tile."""
+    key = (
+        processed_cache_key(data["version"], start_date, end_date, filters),
+        level,
+        tx,
+        ty,
+    )
+    png = _recall(_tiles, key)
+    record_cache("heatmap_tile", hit=png is not None)
+    if png is None:
+        pyramid = get_pyramid(data, stations, start_date, end_date, filters)
+        png = render_tile(pyramid, level, tx, ty)
+        if png is not None:
+            _remember(_tiles, key, png, HEATMAP_TILES)
+    return png
+
+
+def register_heatmap_route(app, data, backend=None):
+    """
+    Serve the station x hour heatmap tiles at /heatmap/<level>/<x>/<y>.png
+    for the range and fare filters in the query string, as export.py takes
+    them. With a query service backend the tiles are fetched from it.
+    """
+    server = getattr(app, "server", app)
+    stations = heatmap_stations(data["stations_df"])
+
+    @server.route("/heatmap/<int:level>/<int:tx>/<int:ty>.png")
+    def heatmap_tile(level, tx, ty):
+        if backend is not None:
+            response = backend.get_heatmap_tile(
+                level, tx, ty, request.args.items(multi=True)
+            )
+            if response.status_code != 200:
+                abort(response.status_code)
+            png = response.content
+        else:
+            start_date, end_date, filters = request_query(data)
+            try:
+                start_date, end_date = heatmap_range(
+                    start_date, end_date, data["dates"]
+                )
+            except (ValueError, TypeError):
+                abort(400)
+            png = get_tile(data, stations, start_date, end_date, filters, level, tx, ty)
+            if png is None:
+                abort(404)
+        TILES_SERVED.inc(level=str(level))
+        return Response(
+            png, mimetype="image/png", headers={"Cache-Control": TILE_CACHE_CONTROL}
+        )
@@ -1,4 +1,6 @@
+import hashlib
 import logging
+import os
 import re
 import pandas as pd
 from dash import html, dcc, dash_table
@@ -77,13 +79,48 @@ def get_default_dates(df):
     return start_date, end_date
 
 
+def normalize_range(start_date, end_date):
+    """Normalize a date range to ISO strings so it can be used as a cache key."""
+    return pd.Timestamp(start_date).isoformat(), pd.Timestamp(end_date).isoformat()
+
+
+def get_code_version():
+    """
+    Fingerprint the app's source files and assets so cached results and
+    pages change on deploy, including deploys changing only the assets.
+    """
+    digest = hashlib.sha1()
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = [name for name in os.listdir(app_dir) if name.endswith(".py")]
+    for root, _, files in os.walk(os.path.join(app_dir, "assets")):
+        paths += [os.path.relpath(os.path.join(root, name), app_dir) for name in files]
+    for path in sorted(paths):
+        # The path is part of the hash so renaming an asset changes it too
+        digest.update(path.encode("utf-8"))
+        with open(os.path.join(app_dir, path), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def summarize_arg(value):
+    """Describe an argument for logging without formatting whole DataFrames."""
+    if isinstance(value, pd.DataFrame):
+        return f"DataFrame(rows={len(value)}, columns={len(value.columns)})"
+    text = repr(value)
+    return text if len(text) <= 200 else text[:200] + "..."
+
+
 def log_function_call(func):
     """Decorator to log the function name and parameters when called."""
 
     def wrapper(*args, **kwargs):
-        logger.debug(
-            f"Function called: {func.__name__} with args: {args} and kwargs: {kwargs}"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Function called: %s with args: %s and kwargs: %s",
+                func.__name__,
+                [summarize_arg(arg) for arg in args],
+                {key: summarize_arg(value) for key, value in kwargs.items()},
+            )
         return func(*args, **kwargs)
 
     return wrapper
@@ -152,6 +189,19 @@ def add_bars_to_figure(fig, unique_keys, data, key, x_col, y_col):
         )
 
 
+def table_columns(df: pd.DataFrame) -> list:
+    """Column definitions of a Dash DataTable showing a DataFrame."""
+    return [
+        {
+            "name": col,
+            "id": col,
+            "deletable": False,
+            "selectable": True,
+        }
+        for col in list(df.columns)
+    ]
+
+
 def add_dash_table(df: pd.DataFrame, id) -> dash_table.DataTable:
     """
     Create a Dash DataTable from a DataFrame.
@@ -159,15 +209,7 @@ def add_dash_table(df: pd.DataFrame, id) -> dash_table.DataTable:
     table = dash_table.DataTable(
         id=id,
         sort_action="native",
-        columns=[
-            {
-                "name": col,
-                "id": col,
-                "deletable": False,
-                "selectable": True,
-            }
-            for col in list(df.columns)
-        ],
+        columns=table_columns(df),
         data=df.to_dict("records"),
         style_table={
             "overflowX": "auto",
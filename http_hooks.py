@@ -0,0 +1,88 @@
+import logging
+import time
+from flask import g, request, request_finished
+from helper import get_code_version
+from metrics import HTTP_SECONDS, record_cache
+from log_config import new_request_id
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Dash fingerprints asset and component suite URLs, so they can be cached forever
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+STATIC_PREFIXES = ("assets/", "_dash-component-suites/")
+# Pages that only change when the data or the code changes
+VERSIONED_PATHS = ("", "_dash-layout")
+
+
+def register_http_hooks(app, data_version):
+    """
+    Add ETag revalidation for the index page and initial layout, keyed by the
+    dataset and code version, long-lived caching for static assets, and
+    logging of response size and time before and after compression.
+    """
+    server = app.server
+    prefix = app.config.routes_pathname_prefix
+    versioned_paths = {prefix + path for path in VERSIONED_PATHS}
+    static_prefixes = tuple(prefix + path for path in STATIC_PREFIXES)
+    etag = f"{data_version}-{get_code_version()}"
+
+    @server.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        request_id = request.headers.get("X-Request-ID", "")
+        g.request_id = new_request_id(
+            request_id if request_id.isalnum() and len(request_id) <= 64 else None
+        )
+        if (
+            request.method == "GET"
+            and request.path in versioned_paths
+            and request.if_none_match.contains_weak(etag)
+        ):
+            record_cache("http_layout", hit=True)
+            response = server.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+    @server.after_request
+    def add_cache_headers(response):
+        if request.path in versioned_paths and response.status_code == 200:
+            record_cache("http_layout", hit=False)
+            response.set_etag(etag, weak=True)
+            response.headers["Cache-Control"] = "no-cache"
+        elif request.path.startswith(static_prefixes) and response.status_code == 200:
+            response.headers["Cache-Control"] = STATIC_CACHE_CONTROL
+        response.headers["X-Request-ID"] = g.get("request_id", "")
+        if not response.is_streamed:
+            g.uncompressed_size = response.calculate_content_length()
+        return response
+
+    def log_response(sender, response, **extra):
+        if "request_start" not in g:
+            return
+        elapsed = time.perf_counter() - g.request_start
+        rule = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_SECONDS.observe(elapsed, rule=rule)
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        sent = response.calculate_content_length()
+        encoding = response.headers.get("Content-Encoding", "identity")
+        logger.debug(
+            "%s %s %d: %s bytes, %s bytes sent (%s) in %.3fs",
+            request.method,
+            request.path,
+            response.status_code,
+            g.get("uncompressed_size"),
+            sent,
+            encoding,
+            elapsed,
+            extra={
+                "path": request.path,
+                "status": response.status_code,
+                "bytes": g.get("uncompressed_size"),
+                "bytes_sent": sent,
+                "encoding": encoding,
+                "duration_ms": round(elapsed * 1000, 3),
+            },
+        )
+
+    request_finished.connect(log_response, server, weak=False)
@@ -8,17 +8,39 @@ from helper import (
     load_button,
 )
 from app_instance import data, plots
+from serializer import pack_figure
+from station_series import build_station_series
+from export import EXPORT_LINKS
+from heatmap_tiles import heatmap_layout, heatmap_stations
+from comparison import COMPARISONS
 
-hourly_ridership_plot = plots["hourly_ridership_plot"]
-weekly_ridership_plot = plots["weekly_ridership_plot"]
-station_weekly_ridership_plot = plots["station_weekly_ridership_plot"]
-time_block_ridership_plot = plots["time_block_ridership_plot"]
-station_time_block_ridership_plot = plots["station_time_block_ridership_plot"]
-station_map_view = plots["station_map_view"]
+hourly_ridership_plot = pack_figure(plots["hourly_ridership_plot"])
+weekly_ridership_plot = pack_figure(plots["weekly_ridership_plot"])
+station_weekly_ridership_plot = pack_figure(plots["station_weekly_ridership_plot"])
+time_block_ridership_plot = pack_figure(plots["time_block_ridership_plot"])
+station_time_block_ridership_plot = pack_figure(
+    plots["station_time_block_ridership_plot"]
+)
+station_map_view = pack_figure(plots["station_map_view"])
+fare_class_ridership_plot = pack_figure(plots["fare_class_ridership_plot"])
 metrics = data["metrics"]
 stations_stats_df = data["station_stats_df"]
 borough_stats_df = data["borough_stats_df"]
 line_stats_df = data["line_stats_df"]
+station_series = build_station_series(data)
+station_options = [
+    {"label": station, "value": station} for station in station_series["stations"]
+]
+trend_series = [trace["name"] for trace in hourly_ridership_plot["data"]]
+fare_class_ridership_df = data["fare_class_ridership_df"]
+payment_methods = sorted(fare_class_ridership_df["payment_method"].unique())
+heatmap_tiles = heatmap_layout(
+    heatmap_stations(data["stations_df"]),
+    *data["dates"],
+    data["version"],
+    bounds=data["dates"],
+)
+fare_classes = sorted(fare_class_ridership_df["fare_class_category"].unique())
 
 
 def get_layout():
@@ -50,6 +72,12 @@ def get_layout():
                 className="mx-auto",
             ),
             html.H6("By Stations", className="text-center mt-4", style=heading_style),
+            dcc.Dropdown(
+                id="station-weekly-select",
+                options=station_options,
+                placeholder="All Stations",
+                className="w-50 mx-auto",
+            ),
             dcc.Graph(
                 id="station-ridership-weekly-graph",
                 figure=station_weekly_ridership_plot,
@@ -68,6 +96,12 @@ def get_layout():
                 className="mx-auto",
             ),
             html.H6("By Stations", className="text-center mt-4", style=heading_style),
+            dcc.Dropdown(
+                id="station-time-block-select",
+                options=station_options,
+                placeholder="All Stations",
+                className="w-50 mx-auto",
+            ),
             dcc.Graph(
                 id="station-ridership-time-block-graph",
                 figure=station_time_block_ridership_plot,
@@ -79,11 +113,29 @@ def get_layout():
                 className="text-center mt-4",
                 style=heading_style,
             ),
+            dcc.Checklist(
+                id="trend-borough-select",
+                options=trend_series,
+                value=trend_series,
+                inline=True,
+                inputStyle={"marginLeft": "1rem", "marginRight": "0.25rem"},
+            ),
             dcc.Graph(
                 id="ridership-trend-graph",
                 figure=hourly_ridership_plot,
                 className="mx-auto",
             ),
+            html.Hr(className="my-4"),
+            html.H5(
+                "Ridership by Fare Class",
+                className="text-center mt-4",
+                style=heading_style,
+            ),
+            dcc.Graph(
+                id="fare-class-graph",
+                figure=fare_class_ridership_plot,
+                className="mx-auto",
+            ),
         ],
         className="text-center",
         style={"fontFamily": "Lato"},
@@ -100,8 +152,60 @@ def get_layout():
                 figure=station_map_view,
                 config={"scrollZoom": True},
             ),
+            html.P(id="nearby-stations", className="text-center mt-2"),
             html.Hr(className="my-4"),
-            html.Div(id="station-details-table"),
+            html.Div(
+                [
+                    add_dash_table(df=stations_stats_df.iloc[:0], id="station-table"),
+                    dcc.Graph(id="station-profile-graph"),
+                ],
+                id="station-details-table",
+                style={"display": "none"},
+            ),
+        ],
+        style={"fontFamily": "Lato"},
+    )
+
+    # Station Heatmap Tab
+    station_heatmap_tab = html.Div(
+        [
+            html.H4(
+                "🔥 Station × Hour Heatmap",
+                className="text-center mt-4",
+                style=heading_style,
+            ),
+            html.P(
+                "Mean hourly ridership of every station, grouped by borough. "
+                "Zoom in for single hours and stations.",
+                className="text-center",
+            ),
+            dcc.Graph(id="station-hour-heatmap", config={"scrollZoom": True}),
+        ],
+        style={"fontFamily": "Lato"},
+    )
+
+    # Forecast Tab, fit when it is first opened
+    forecast_tab = html.Div(
+        [
+            html.H4(
+                "🔮 Next Week's Ridership Forecast",
+                className="text-center mt-4",
+                style=heading_style,
+            ),
+            html.P(
+                "Hourly ridership forecast for the week after the data, repeating "
+                "the last week (seasonal naive) and from a regression on the same "
+                "hour of earlier weeks.",
+                className="text-center",
+            ),
+            dcc.Dropdown(
+                id="forecast-station-select",
+                options=station_options,
+                placeholder="All Stations",
+                className="w-50 mx-auto",
+            ),
+            dcc.Graph(id="forecast-graph", className="mx-auto"),
+            html.Div(id="forecast-note", className="text-center text-muted mt-2"),
         ],
         style={"fontFamily": "Lato"},
     )
@@ -226,6 +330,24 @@ def get_layout():
     return dbc.Container(
         [
             dcc.Location(id="url", refresh=False),
+            dcc.Store(id="station-series-store", data=station_series),
+            dcc.Store(
+                id="export-paths",
+                data=[f"/export/{table}.{fmt}" for table, fmt, _ in EXPORT_LINKS],
+            ),
+            # Range whose exact results follow approximate ones, see callbacks.py
+            dcc.Store(id="exact-request-store"),
+            # Tile pyramid of the heatmap, see heatmap_tiles.heatmap_layout
+            dcc.Store(id="heatmap-tiles-store", data=heatmap_tiles),
+            # Range shown on the station map, for its viewport queries
+            dcc.Store(
+                id="map-range-store",
+                data={
+                    "start_date": data["dates"][0],
+                    "end_date": data["dates"][1],
+                    "filters": {},
+                },
+            ),
             html.H2(
                 "🚇 NYC MTA Subway Ridership Dashboard",
                 className="text-center my-4",
@@ -260,9 +382,70 @@ def get_layout():
                         width="auto",
                     ),
                     dbc.Col(load_button, width="auto"),
+                    dbc.Col(
+                        dbc.DropdownMenu(
+                            [
+                                dbc.DropdownMenuItem(
+                                    label,
+                                    id=f"export-{table}-{fmt}",
+                                    external_link=True,
+                                )
+                                for table, fmt, label in EXPORT_LINKS
+                            ],
+                            label="Download",
+                            color="secondary",
+                        ),
+                        width="auto",
+                    ),
                 ],
                 justify="center",
             ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dcc.Dropdown(
+                            id="payment-method-select",
+                            options=payment_methods,
+                            multi=True,
+                            placeholder="All Payment Methods",
+                        ),
+                        width=4,
+                    ),
+                    dbc.Col(
+                        dcc.Dropdown(
+                            id="fare-class-select",
+                            options=fare_classes,
+                            multi=True,
+                            placeholder="All Fare Classes",
+                        ),
+                        width=4,
+                    ),
+                    dbc.Col(
+                        dcc.Dropdown(
+                            id="compare-select",
+                            options=[
+                                {"label": label, "value": value}
+                                for value, label in COMPARISONS
+                            ],
+                            placeholder="No Comparison",
+                        ),
+                        width=3,
+                    ),
+                ],
+                justify="center",
+                className="mt-2",
+            ),
+            html.Div(
+                id="approximate-note",
+                className="text-center text-muted mt-2",
+                style={"fontFamily": "Lato"},
+            ),
+            # How admission control limited a range, see admission.py
+            html.Div(
+                id="admission-note",
+                className="text-center text-warning mt-2",
+                style={"fontFamily": "Lato"},
+            ),
             html.Br(),
             dcc.Tabs(
                 id="tabs",
@@ -307,6 +490,25 @@ def get_layout():
                         ],
                         style={"fontFamily": "Lato"},
                     ),
+                    dcc.Tab(
+                        label="🔥 Station Heatmap",
+                        value="tab-4",
+                        children=[station_heatmap_tab],
+                        style={"fontFamily": "Lato"},
+                    ),
+                    dcc.Tab(
+                        label="🔮 Ridership Forecast",
+                        value="tab-5",
+                        children=[
+                            dbc.Spinner(
+                                forecast_tab,
+                                color="primary",
+                                type="border",
+                                spinner_style={"position": "relative", "zIndex": 10},
+                            ),
+                        ],
+                        style={"fontFamily": "Lato"},
+                    ),
                 ],
             ),
             html.Div(id="tabs-content", className="mt-4"),
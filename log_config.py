@@ -0,0 +1,93 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.environ.get("MTA_LOG_LEVEL", "INFO").upper()
+# "json" for one JSON object per line, "text" for human-readable lines
+LOG_FORMAT = os.environ.get("MTA_LOG_FORMAT", "json")
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s"
+
+# Attributes every LogRecord has; anything else was passed with extra=
+RESERVED_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+
+def new_request_id(request_id=None):
+    """Set the ID attached to log records emitted while handling a request."""
+    request_id = request_id or uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    return request_id
+
+
+class RequestIdFilter(logging.Filter):
+    """Attach the current request ID on the thread that emits the record."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON with the request ID and any extra= fields."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """Queue handler that leaves formatting, including JSON, to the listener."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """
+    Route all logging through a queue so request threads only enqueue records,
+    with a background listener formatting and writing them to the console.
+    """
+    console = logging.StreamHandler()
+    if log_format == "json":
+        console.setFormatter(JsonFormatter())
+    else:
+        console.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, console, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
@@ -0,0 +1,211 @@
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response
+
+# Histogram bucket upper bounds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+MEMORY_BUCKETS = (0, 1e6, 4e6, 16e6, 64e6, 256e6, 1e9, 4e9)
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# All metric families, in the order they are rendered
+REGISTRY = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Metric:
+    """Base class for a metric family with labelled series."""
+
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+        for labels, value in series:
+            lines += self._render_series(labels, value)
+        return lines
+
+    def _render_series(self, labels, value):
+        return [f"{self.name}{_format_labels(labels)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._series.get(tuple(sorted(labels.items())), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._series[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._series.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._series[key] = (counts, total + value, count + 1)
+
+    def _render_series(self, labels, value):
+        counts, total, count = value
+        lines = []
+        for bound, bucket_count in zip(
+            self.buckets + (float("inf"),), counts + [count]
+        ):
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            bucket_labels = _format_labels(labels + (("le", le),))
+            lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "mta_stage_duration_seconds",
+    "Time spent in each instrumented stage.",
+    DURATION_BUCKETS,
+)
+STAGE_MEMORY = Histogram(
+    "mta_stage_rss_growth_bytes",
+    "Growth of the process resident set size during each stage.",
+    MEMORY_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "mta_stage_errors_total", "Exceptions raised by each instrumented stage."
+)
+HTTP_SECONDS = Histogram(
+    "mta_http_request_duration_seconds",
+    "Time to serve HTTP requests, including JSON encoding.",
+    DURATION_BUCKETS,
+)
+CACHE_REQUESTS = Counter(
+    "mta_cache_requests_total", "Cache lookups by cache and result (hit or miss)."
+)
+CACHE_HIT_RATIO = Gauge("mta_cache_hit_ratio", "Fraction of cache lookups that hit.")
+DATASET_ROWS = Gauge("mta_dataset_rows", "Number of rows in each loaded data frame.")
+PROCESS_RSS = Gauge("mta_process_resident_memory_bytes", "Resident set size.")
+
+
+def get_rss():
+    """Return the current resident set size of the process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        import resource
+
+        # Peak rather than current RSS where /proc is unavailable (kB on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def timed(stage):
+    """Record the duration and RSS growth of a block of code under a stage name."""
+    start_rss = get_rss()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        rss_growth = max(get_rss() - start_rss, 0)
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        STAGE_MEMORY.observe(rss_growth, stage=stage)
+        logger.debug(
+            "Stage %s took %.3fs",
+            stage,
+            elapsed,
+            extra={
+                "stage": stage,
+                "duration_ms": round(elapsed * 1000, 3),
+                "rss_growth_bytes": rss_growth,
+            },
+        )
+
+
+def instrument(func=None, stage=None):
+    """Decorator recording each call of a function as a stage (module.function)."""
+    if func is None:
+        return functools.partial(instrument, stage=stage)
+    stage = stage or f"{func.__module__}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with timed(stage):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def record_cache(cache, hit):
+    """Count a cache lookup and update the cache's hit ratio."""
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+    hits = CACHE_REQUESTS.get(cache=cache, result="hit")
+    misses = CACHE_REQUESTS.get(cache=cache, result="miss")
+    CACHE_HIT_RATIO.set(hits / (hits + misses), cache=cache)
+
+
+def render_metrics():
+    """Render all metrics in the Prometheus text exposition format."""
+    PROCESS_RSS.set(get_rss())
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def register_metrics_route(app):
+    """Expose the metrics at /metrics on a Dash app's or Flask server."""
+    server = getattr(app, "server", app)
+
+    @server.route("/metrics")
+    def metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,170 @@
+import cProfile
+import functools
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from flask import has_request_context, request
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Profile every decorated callback, not just requests asking for it
+PROFILE_ALL = os.environ.get("MTA_PROFILE", "0") == "1"
+# Let requests ask to be profiled, off by default as any client could then
+# add profiling overhead and disk writes to its requests
+PROFILE_ALLOW = os.environ.get("MTA_PROFILE_ALLOW", "0") == "1"
+# "sample" for the low-overhead stack sampler, "cprofile" for deterministic profiling
+PROFILER = os.environ.get("MTA_PROFILER", "sample")
+PROFILE_DIR = os.environ.get("MTA_PROFILE_DIR", "profiles")
+# Number of profiles kept in PROFILE_DIR before the oldest are deleted
+PROFILE_KEEP = int(os.environ.get("MTA_PROFILE_KEEP", 50))
+PROFILE_TOP_N = int(os.environ.get("MTA_PROFILE_TOP_N", 30))
+SAMPLE_INTERVAL = float(os.environ.get("MTA_PROFILE_INTERVAL", 0.005))
+
+
+def profiling_requested():
+    """
+    Check whether the current request asked to be profiled, with ?profile=1 on
+    the request or on the dashboard page that sent it, or an X-Profile header.
+    Requests can only ask for it when PROFILE_ALLOW is set.
+    """
+    if PROFILE_ALL:
+        return True
+    if not PROFILE_ALLOW or not has_request_context():
+        return False
+    if request.args.get("profile") == "1" or request.headers.get("X-Profile") == "1":
+        return True
+    page_query = parse_qs(urlparse(request.referrer or "").query)
+    return page_query.get("profile") == ["1"]
+
+
+class StackSampler:
+    """Sample the call stack of one thread at a fixed interval."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                module = os.path.splitext(os.path.basename(code.co_filename))[0]
+                stack.append(f"{module}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        """Stacks in the folded format read by flamegraph.pl and speedscope."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+    def top(self, n):
+        """The n functions with the most samples, by self and total samples."""
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+
+        samples = sum(self.stacks.values())
+        lines = [f"{samples} samples every {self.interval * 1000:g} ms", ""]
+        lines.append(f"{'self':>8} {'total':>8}  function")
+        for frame, count in own.most_common(n):
+            lines.append(f"{count:8d} {total[frame]:8d}  {frame}")
+        return "\n".join(lines) + "\n"
+
+
+def _remove_old_profiles():
+    profiles = sorted(
+        {entry.rsplit(".", 1)[0] for entry in os.listdir(PROFILE_DIR)}, reverse=True
+    )
+    for old in profiles[PROFILE_KEEP:]:
+        for entry in os.listdir(PROFILE_DIR):
+            if entry.startswith(old + "."):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, entry))
+                except FileNotFoundError:
+                    # Deleted by the rotation of a concurrent profile
+                    pass
+
+
+def _write_profile(name, files):
+    """
+    Write one profile's files and delete the oldest beyond PROFILE_KEEP. I/O
+    errors are logged, so the profiled callback still returns its result.
+    """
+    now = time.time()
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+    prefix = f"{stamp}-{int(now * 1000) % 1000:03d}-{name}"
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        for ext, content in files.items():
+            mode = "wb" if isinstance(content, bytes) else "w"
+            with open(os.path.join(PROFILE_DIR, f"{prefix}.{ext}"), mode) as f:
+                f.write(content)
+        _remove_old_profiles()
+    except OSError as e:
+        logger.warning("Could not write profile %s: %s", prefix, e)
+        return
+
+    logger.info("Wrote profile %s to %s", prefix, PROFILE_DIR)
+
+
+def _run_sampled(func, args, kwargs):
+    with StackSampler(threading.get_ident()) as sampler:
+        result = func(*args, **kwargs)
+    _write_profile(
+        func.__name__, {"folded": sampler.folded(), "txt": sampler.top(PROFILE_TOP_N)}
+    )
+    return result
+
+
+def _run_cprofile(func, args, kwargs):
+    profile = cProfile.Profile()
+    result = profile.runcall(func, *args, **kwargs)
+
+    report = io.StringIO()
+    stats = pstats.Stats(profile, stream=report)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    profile.create_stats()
+    _write_profile(
+        func.__name__,
+        # .prof is the format read by pstats and snakeviz
+        {"txt": report.getvalue(), "prof": marshal.dumps(profile.stats)},
+    )
+    return result
+
+
+def profile_callback(func):
+    """Decorator profiling a callback when profiling is requested."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not profiling_requested():
+            return func(*args, **kwargs)
+        if PROFILER == "cprofile":
+            return _run_cprofile(func, args, kwargs)
+        return _run_sampled(func, args, kwargs)
+
+    return wrapper
@@ -0,0 +1,94 @@
+import logging
+import os
+import requests
+from arrow_bundle import MIME_TYPE, decode_bundle
+from metrics import instrument
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+BACKEND_TIMEOUT = float(os.environ.get("MTA_BACKEND_TIMEOUT", 120))
+
+
+def _as_tuple(value):
+    """Turn nested JSON lists back into the tuples they were sent as."""
+    if isinstance(value, list):
+        return tuple(_as_tuple(item) for item in value)
+    return value
+
+
+class QueryClient:
+    """Client for the query service, returning results as local calls would."""
+
+    def __init__(self, url, timeout=BACKEND_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _get(self, path, start_date=None, end_date=None, filters=None, **extra):
+        params = {}
+        if start_date is not None and end_date is not None:
+            params = {"start_date": str(start_date), "end_date": str(end_date)}
+        # Selected values are sent as repeated parameters, e.g. ?payment_method=omny
+        for column, values in (filters or {}).items():
+            if values:
+                params[column] = list(values)
+        params.update(extra)
+        response = self.session.get(
+            self.url + path,
+            params=params,
+            headers={"Accept": MIME_TYPE},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        logger.debug(
+            "Fetched %s (%d bytes) from the query service",
+            path,
+            len(response.content),
+            extra={"path": path, "bytes": len(response.content)},
+        )
+        return decode_bundle(response.content)
+
+    @instrument(stage="query_client.get_processed_data")
+    def get_processed_data(
+        self, start_date=None, end_date=None, filters=None, approximate=False
+    ):
+        """
+        Processed data for a range, without the raw and filtered rows. With
+        approximate, the service may answer from its sample, see
+        data.get_approximate_data.
+        """
+        extra = {"approximate": "1"} if approximate else {}
+        results = self._get("/processed", start_date, end_date, filters, **extra)
+        # The cache key keys the plot cache and request coalescing, so it
+        # must stay hashable once filters nest tuples in it
+        if results.get("cache_key") is not None:
+            results["cache_key"] = _as_tuple(results["cache_key"])
+        return results
+
+    def stream_export(self, name, fmt, params):
+        """Start streaming an export from the query service, see export.py."""
+        return self.session.get(
+            f"{self.url}/export/{name}.{fmt}",
+            params=list(params),
+            stream=True,
+            timeout=self.timeout,
+        )
+
+    def get_heatmap_tile(self, level, tx, ty, params):
+        """Fetch a heatmap tile from the query service, see heatmap_tiles.py."""
+        return self.session.get(
+            f"{self.url}/heatmap/{level}/{tx}/{ty}.png",
+            params=list(params),
+            timeout=self.timeout,
+        )
+
+    @instrument(stage="query_client.get_aggregation")
+    def get_aggregation(self, name, start_date=None, end_date=None, filters=None):
+        """Output of one aggregation in data.py (e.g. get_line_stats_df) by key."""
+        return self._get(f"/aggregations/{name}", start_date, end_date, filters)
+
+    @instrument(stage="query_client.get_forecast")
+    def get_forecast(self, station=None):
+        """Forecast of a station, or of all stations, see forecast.py."""
+        extra = {"station": station} if station else {}
+        return self._get("/forecast", **extra)
@@ -0,0 +1,118 @@
+import argparse
+import logging
+import os
+from flask import Flask, Response, abort, jsonify, request
+from arrow_bundle import MIME_TYPE, encode_bundle
+from data import AGGREGATIONS, filter_data, get_approximate_data, get_processed_data
+from export import register_export_route, request_query
+from forecast import get_forecast, station_forecast
+from heatmap_tiles import register_heatmap_route
+from log_config import setup_logging
+from metrics import instrument, register_metrics_route
+from station_series import build_station_series
+from warmup import record_range, register_warmup
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+HOST = os.environ.get("MTA_QUERY_HOST", "127.0.0.1")
+PORT = int(os.environ.get("MTA_QUERY_PORT", 8051))
+
+# Results computed for the Dash app; the raw and filtered rows stay here
+CLIENT_EXCLUDED_KEYS = ("ridership_df", "filtered_df")
+AGGREGATION_FUNCS = {func.__name__: (keys, func) for keys, func in AGGREGATIONS}
+
+
+def _bundle_response(results):
+    return Response(encode_bundle(results), mimetype=MIME_TYPE)
+
+
+@instrument
+def query_processed_data(data, start_date, end_date, filters=None, approximate=False):
+    """
+    Processed data for a range as sent to the Dash app, estimated from the
+    sample when approximate is set and exact results would take long.
+    """
+    new_data = None
+    if approximate:
+        new_data = get_approximate_data(start_date, end_date, data["version"], filters)
+    if new_data is None:
+        new_data = get_processed_data(
+            data["ridership_df"],
+            start_date,
+            end_date,
+            version=data["version"],
+            filters=filters,
+        )
+    results = {
+        key: value for key, value in new_data.items() if key not in CLIENT_EXCLUDED_KEYS
+    }
+    results["version"] = data["version"]
+    # Needs the filtered rows, so it is built on this side
+    results["station_series"] = build_station_series(new_data)
+    return results
+
+
+def create_service(data=None):
+    """Create the query service serving processed data as Arrow IPC."""
+    data = data or get_processed_data()
+    server = Flask(__name__)
+
+    @server.route("/health")
+    def health():
+        return jsonify(status="ok", version=data["version"])
+
+    @server.route("/processed")
+    def processed():
+        start_date, end_date, filters = request_query(data)
+        record_range(start_date, end_date)
+        return _bundle_response(
+            query_processed_data(
+                data,
+                start_date,
+                end_date,
+                filters,
+                approximate=request.args.get("approximate") == "1",
+            )
+        )
+
+    @server.route("/aggregations/<name>")
+    def aggregation(name):
+        if name not in AGGREGATION_FUNCS:
+            abort(404)
+        keys, func = AGGREGATION_FUNCS[name]
+        filtered_df = filter_data(data["ridership_df"], *request_query(data))
+        result = func(filtered_df)
+        if len(keys) == 1:
+            result = (result,)
+        return _bundle_response(dict(zip(keys, result)))
+
+    @server.route("/forecast")
+    def forecast():
+        station = request.args.get("station")
+        return _bundle_response(station_forecast(get_forecast(data), station))
+
+    register_metrics_route(server)
+    register_export_route(server, data)
+    register_heatmap_route(server, data)
+    register_warmup(
+        server,
+        data,
+        tracked_paths=("/processed", "/aggregations/", "/export/", "/heatmap/"),
+    )
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve processed ridership data.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
+    setup_logging()
+    server = create_service()
+    logger.info("Query service listening on %s:%d", args.host, args.port)
+    server.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import logging
+import os
+import numpy as np
+import pandas as pd
+from metrics import instrument
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Answer long ranges from pre-summed rollups instead of hourly rows
+ROLLUPS = os.environ.get("MTA_ROLLUPS", "1") == "1"
+
+# Grains of the station rollups, coarsest first, with their period boundaries.
+# There is no weekly grain: with the day of week in the keys, a weekly rollup
+# has as many rows as the daily one.
+PERIOD_OFFSETS = {
+    "year": pd.offsets.YearBegin(),
+    "month": pd.offsets.MonthBegin(),
+    "day": pd.offsets.Day(),
+}
+# What every aggregation except the hourly trend and fare classes groups by.
+# Stations are keyed by ID, as several share a name once format_station_name
+# drops their lines, e.g. "86 St (R)" in Brooklyn and "86 St (4,5,6)"
+KEYS = ["station_complex_id", "day", "hour"]
+FARE_DIMENSIONS = ["payment_method", "fare_class_category"]
+# Per-station columns, the same on every row of a station
+STATION_ATTRS = [
+    "station_complex",
+    "latitude",
+    "longitude",
+    "borough",
+    "station_size",
+    "line_color",
+    "line",
+    "lines",
+]
+TIME_BLOCKS = {
+    hour: f"{hour // 3 * 3:02d}:00-{hour // 3 * 3 + 3:02d}:00" for hour in range(24)
+}
+
+# Rollups of each dataset version, see register_rollups
+_rollups = {}
+
+
+def _collapse(df, keys):
+    """Sum ridership and row counts per group, keeping each group's first position."""
+    collapsed = (
+        df.groupby(keys, sort=False, observed=True)
+        .agg(
+            ridership=("ridership", "sum"),
+            rows=("rows", "sum"),
+            first=("first", "min"),
+        )
+        .reset_index()
+    )
+    if "period" in keys:
+        collapsed.sort_values("period", kind="stable", inplace=True, ignore_index=True)
+    return collapsed
+
+
+def _station_rows(df, first):
+    """Station-hour rows reduced to the rollup keys with their row counts."""
+    return pd.DataFrame(
+        {
+            "station_complex_id": df["station_complex_id"].to_numpy(),
+            "day": df["day"].to_numpy(),
+            "hour": df["hour"].to_numpy(),
+            "ridership": df["ridership"].to_numpy(),
+            "rows": df["rows"].to_numpy(),
+            "first": first,
+        }
+    )
+
+
+def collapse_fare_classes(df):
+    """
+    Sum the payment method and fare class rows of each station-hour, by
+    station ID, keeping the order of first appearance and the number of rows
+    summed.
+    """
+    station_hourly = (
+        df.assign(position=np.arange(len(df)))
+        .groupby(["transit_timestamp", "station_complex_id"], sort=False)
+        .agg(
+            station_complex=("station_complex", "first"),
+            day=("day", "first"),
+            hour=("hour", "first"),
+            ridership=("ridership", "sum"),
+            rows=("ridership", "size"),
+            position=("position", "min"),
+        )
+        .reset_index()
+    )
+    station_hourly.sort_values("position", inplace=True, ignore_index=True)
+    return station_hourly.drop(columns="position")
+
+
+def _sum_by(df, keys):
+    return df.groupby(keys, observed=True)["ridership"].sum().reset_index()
+
+
+@instrument
+def build_rollups(df):
+    """
+    Build the rollups of the cleaned ridership data (sorted by descending
+    timestamp as clean_data leaves it):
+
+    - station_hourly: station-hour totals over payment methods and fare classes
+    - hourly_borough: hourly ridership by borough for the trend chart
+    - hourly_fare: hourly ridership by payment method and fare class
+    - day, month, year: ridership, row count and first station-hour position
+      by (period, station, day of week, hour)
+    """
+    station_hourly = collapse_fare_classes(df)
+    rows = _station_rows(station_hourly, np.arange(len(station_hourly)))
+    rows.insert(0, "period", station_hourly["transit_timestamp"].dt.normalize())
+    rollups = {
+        "station_hourly": station_hourly,
+        "hourly_borough": _sum_by(df, ["transit_timestamp", "borough"]),
+        "hourly_fare": _sum_by(df, ["transit_timestamp", *FARE_DIMENSIONS]),
+        "day": _collapse(rows, ["period", *KEYS]),
+    }
+    # Coarser grains are rolled up from the next finer one
+    for period, finer, freq in (("month", "day", "M"), ("year", "month", "Y")):
+        partial = rollups[finer]
+        rollups[period] = _collapse(
+            partial.assign(period=partial["period"].dt.to_period(freq).dt.start_time),
+            ["period", *KEYS],
+        )
+    return rollups
+
+
+def update_rollups(rollups, new_df):
+    """
+    Fold newly ingested rows into existing rollups. The rows must be newer
+    than the data the rollups were built from and prepended to it, as the
+    descending sort in clean_data does.
+    """
+    new = build_rollups(new_df)
+    # Positions stay relative to the old rows, the new ones come before them
+    offset = rollups.get("offset", 0) - len(new["station_hourly"])
+    updated = {
+        "station_hourly": pd.concat(
+            [new["station_hourly"], rollups["station_hourly"]], ignore_index=True
+        ),
+        "hourly_borough": _sum_by(
+            pd.concat([rollups["hourly_borough"], new["hourly_borough"]]),
+            ["transit_timestamp", "borough"],
+        ),
+        "hourly_fare": _sum_by(
+            pd.concat([rollups["hourly_fare"], new["hourly_fare"]]).astype(
+                dict.fromkeys(FARE_DIMENSIONS, "category")
+            ),
+            ["transit_timestamp", *FARE_DIMENSIONS],
+        ),
+        "offset": offset,
+    }
+    for period in PERIOD_OFFSETS:
+        updated[period] = _collapse(
+            pd.concat(
+                [
+                    new[period].assign(first=new[period]["first"] + offset),
+                    rollups[period],
+                ],
+                ignore_index=True,
+            ),
+            ["period", *KEYS],
+        )
+    return updated
+
+
+def register_rollups(version, rollups, df):
+    """Make rollups available to get_processed_data for a dataset version."""
+    stations = df.drop_duplicates(subset=["station_complex_id"]).set_index(
+        "station_complex_id"
+    )[STATION_ATTRS]
+    _rollups.clear()
+    _rollups[version] = {**rollups, "stations": stations}
+
+
+def get_rollups(version):
+    return _rollups.get(version)
+
+
+def _period_slice(rollup, start, end):
+    """Rows of a rollup for the periods starting in [start, end)."""
+    periods = rollup["period"].to_numpy()
+    lo, hi = np.searchsorted(periods, [np.datetime64(start), np.datetime64(end)])
+    return rollup.iloc[lo:hi]
+
+
+def row_positions(timestamps, start, end, inclusive=False):
+    """Positions of the rows in [start, end) of a frame sorted by descending time."""
+    ascending = timestamps[::-1]
+    lo = np.searchsorted(ascending, np.datetime64(start), "left")
+    hi = np.searchsorted(
+        ascending, np.datetime64(end), "right" if inclusive else "left"
+    )
+    return len(timestamps) - hi, len(timestamps) - lo
+
+
+def plan_periods(start_day, end_day):
+    """
+    Cover the full days in [start_day, end_day) with the coarsest periods:
+    whole years, then whole months, then single days.
+    """
+    plan, spans = [], [(start_day, end_day)]
+    for period, offset in PERIOD_OFFSETS.items():
+        remaining = []
+        for lo, hi in spans:
+            period_lo, period_hi = offset.rollforward(lo), offset.rollback(hi)
+            if period_lo < period_hi:
+                plan.append((period, period_lo, period_hi))
+                remaining += [(lo, period_lo), (period_hi, hi)]
+            else:
+                remaining.append((lo, hi))
+        spans = [(lo, hi) for lo, hi in remaining if lo < hi]
+    return plan
+
+
+def _with_station_attrs(df, stations):
+    """Add the per-station columns and time blocks the aggregations use."""
+    for column in STATION_ATTRS:
+        df[column] = df["station_complex_id"].map(stations[column])
+    df["time_block"] = df["hour"].map(TIME_BLOCKS)
+    return df
+
+
+def _time_slice(df, start, end):
+    """Rows of a frame sorted by ascending time with start <= time <= end."""
+    timestamps = df["transit_timestamp"].to_numpy()
+    lo = np.searchsorted(timestamps, np.datetime64(start), "left")
+    hi = np.searchsorted(timestamps, np.datetime64(end), "right")
+    return df.iloc[lo:hi]
+
+
+@instrument
+def query_rollups(rollups, start_date, end_date):
+    """
+    Answer a date range from the rollups. Returns the input of the
+    aggregations: the range's rows pre-summed by (station, day of week, hour)
+    from the coarsest periods covering its full days, or its station-hour
+    totals when it covers no full day, both with a `rows` count and ordered
+    by first appearance like the hourly rows. Also returns the hourly
+    borough and fare class totals for the aggregations that read them.
+    """
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    station_hourly = rollups["station_hourly"]
+    offset = rollups.get("offset", 0)
+    inputs = {
+        "get_hourly_ridership": _time_slice(rollups["hourly_borough"], start, end),
+        "get_fare_class_ridership": _time_slice(rollups["hourly_fare"], start, end),
+    }
+
+    # Days whose every hour is in the range; the hours around them are read
+    # from the station-hour totals
+    start_day, end_day = start.ceil("D"), (end + pd.Timedelta(hours=1)).floor("D")
+    timestamps = station_hourly["transit_timestamp"].to_numpy()
+    if start_day >= end_day:
+        first, last = row_positions(timestamps, start, end, inclusive=True)
+        filtered_df = station_hourly.iloc[first:last].copy()
+        return _with_station_attrs(filtered_df, rollups["stations"]), inputs
+
+    plan = plan_periods(start_day, end_day)
+    pieces = [_period_slice(rollups[period], lo, hi) for period, lo, hi in plan]
+    for lo, hi, inclusive in ((start, start_day, False), (end_day, end, True)):
+        first, last = row_positions(timestamps, lo, hi, inclusive)
+        if first < last:
+            edge = station_hourly.iloc[first:last]
+            pieces.append(_station_rows(edge, np.arange(first, last) + offset))
+    logger.debug(
+        "Range %s - %s planned as %s",
+        start,
+        end,
+        [(period, str(lo.date()), str(hi.date())) for period, lo, hi in plan],
+    )
+
+    collapsed = _collapse(pd.concat(pieces, ignore_index=True), KEYS)
+    collapsed.sort_values("first", inplace=True, ignore_index=True)
+    return _with_station_attrs(collapsed, rollups["stations"]), inputs
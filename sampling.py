@@ -0,0 +1,92 @@
+import logging
+import os
+import numpy as np
+import pandas as pd
+from metrics import instrument
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Send results estimated from a sample first for ranges that scan many rows
+PROGRESSIVE = os.environ.get("MTA_PROGRESSIVE", "1") == "1"
+# The sample keeps one in SAMPLE_STEP rows of every stratum
+SAMPLE_STEP = int(os.environ.get("MTA_SAMPLE_STEP", 100))
+# Scans of fewer hourly rows than this are fast enough to wait for
+PROGRESSIVE_MIN_ROWS = int(os.environ.get("MTA_PROGRESSIVE_MIN_ROWS", 2_000_000))
+# Ridership varies far more between stations and fare classes than within
+# them, and the fare filters select whole strata. Stations are keyed by ID,
+# as several share a formatted name, see rollups.KEYS
+STRATA = ["station_complex_id", "fare_class_category"]
+# Normal quantile of the 95% margins of error
+Z_SCORE = 1.96
+
+# Sample of each dataset version, see register_sample
+_samples = {}
+
+
+@instrument
+def build_sample(df, step=SAMPLE_STEP, seed=0):
+    """
+    Draw a stratified sample of 1/step of the rows of df, in the order of df.
+    Every stratum of STRATA is shuffled and every step-th row kept from a
+    random start, so each row is drawn with probability 1/step. Ridership is
+    scaled by step so sums estimate totals, and each row stands for step
+    hourly rows in `rows`.
+    """
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(df))
+    strata = pd.Series(order).groupby(
+        [df[column].to_numpy()[order] for column in STRATA], sort=False
+    )
+    starts = rng.integers(0, step, strata.ngroups)[strata.ngroup().to_numpy()]
+    keep = strata.cumcount().to_numpy() % step == starts
+    sample = df.iloc[np.sort(order[keep])].copy()
+    sample["ridership"] *= step
+    sample["rows"] = step
+    return sample
+
+
+def register_sample(version, sample):
+    """Make a sample available to get_approximate_data for a dataset version."""
+    _samples.clear()
+    _samples[version] = sample
+
+
+def get_sample(version):
+    return _samples.get(version)
+
+
+def _station_variances(sample_df, step):
+    """Variance of the estimated total of each station, summed over its strata."""
+    ridership = sample_df.groupby(STRATA, observed=True)["ridership"]
+    variances = (1 - 1 / step) * ridership.count() * ridership.var().fillna(0)
+    return variances.groupby(level="station_complex_id").sum()
+
+
+def _margin(variance):
+    return int(round(Z_SCORE * np.sqrt(variance)))
+
+
+@instrument
+def error_bounds(sample_df, metrics, step=SAMPLE_STEP):
+    """
+    95% margins of error of the totals on the key metric cards, as estimated
+    by get_key_metrics from a sample drawn by build_sample.
+    """
+    variances = _station_variances(sample_df, step)
+    stations = sample_df.drop_duplicates(subset=["station_complex_id"]).set_index(
+        "station_complex_id"
+    )
+    # The busiest station's name may cover several stations, as it does in
+    # get_key_metrics
+    is_busiest_station = stations["station_complex"] == metrics["busiest_station"][0]
+    busiest_line = metrics["busiest_line"][0]
+    on_busiest_line = stations["lines"].map(lambda lines: busiest_line in lines)
+    in_busiest_borough = stations["borough"] == metrics["busiest_borough"][0]
+    return {
+        "sample_rows": len(sample_df),
+        "step": step,
+        "no_of_rides": _margin(variances.sum()),
+        "busiest_station": _margin(variances[is_busiest_station].sum()),
+        "busiest_line": _margin(variances[on_busiest_line].sum()),
+        "busiest_borough": _margin(variances[in_busiest_borough].sum()),
+    }
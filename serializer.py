@@ -0,0 +1,127 @@
+import base64
+import logging
+import os
+import time
+import numpy as np
+import plotly.io as pio
+from plotly.io.json import to_json_plotly
+from plotly.offline import get_plotlyjs_version
+from metrics import instrument
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Log encoded size and encode time of every callback output
+MEASURE_PAYLOADS = os.environ.get("MTA_MEASURE_PAYLOADS", "0") == "1"
+# Send numeric trace arrays to plotly.js as base64 typed arrays
+TYPED_ARRAYS = os.environ.get("MTA_TYPED_ARRAYS", "1") == "1"
+# Shorter arrays are smaller as plain JSON lists than as typed array specs
+TYPED_ARRAY_MIN_LENGTH = 64
+
+# Smallest plotly.js typed array that can hold a range of integers
+INT_TYPED_ARRAYS = [
+    ("i1", np.int8),
+    ("u1", np.uint8),
+    ("i2", np.int16),
+    ("u2", np.uint16),
+    ("i4", np.int32),
+    ("u4", np.uint32),
+]
+
+
+def configure_json_engine():
+    """Use orjson, with native numpy support, for all Plotly and Dash encoding."""
+    if orjson is None:
+        logger.warning("orjson is not installed, using the default JSON encoder.")
+        return
+    pio.json.config.default_engine = "orjson"
+    logger.info("Using orjson for JSON serialization.")
+
+
+def typed_arrays_supported():
+    """Typed array specs ({dtype, bdata}) are understood by plotly.js >= 2.28."""
+    major, minor = (int(part) for part in get_plotlyjs_version().split(".")[:2])
+    return TYPED_ARRAYS and (major, minor) >= (2, 28)
+
+
+def typed_array(values):
+    """Encode a 1-D numeric array as a plotly.js base64 typed array spec."""
+    arr = np.asarray(values)
+    if arr.dtype.kind in "iu" and arr.size:
+        low, high = arr.min(), arr.max()
+        for dtype, np_type in INT_TYPED_ARRAYS:
+            info = np.iinfo(np_type)
+            if info.min <= low and high <= info.max:
+                break
+        else:
+            dtype, np_type = "f8", np.float64
+    elif arr.dtype == np.float32:
+        dtype, np_type = "f4", np.float32
+    else:
+        dtype, np_type = "f8", np.float64
+
+    data = np.ascontiguousarray(arr, dtype=np_type)
+    return {"dtype": dtype, "bdata": base64.b64encode(data.tobytes()).decode("ascii")}
+
+
+def _is_numeric_array(value):
+    return (
+        isinstance(value, np.ndarray)
+        and value.ndim == 1
+        and value.dtype.kind in "iuf"
+        and len(value) >= TYPED_ARRAY_MIN_LENGTH
+    )
+
+
+def _pack_trace(trace):
+    """Replace numeric arrays in a trace (and nested objects) with typed arrays."""
+    packed = {}
+    for key, value in trace.items():
+        if isinstance(value, dict):
+            packed[key] = _pack_trace(value)
+        elif _is_numeric_array(value):
+            packed[key] = typed_array(value)
+        else:
+            packed[key] = value
+    return packed
+
+
+@instrument
+def pack_figure(fig):
+    """
+    Convert a figure to a dict for the wire, with numeric trace arrays sent as
+    base64 typed arrays where plotly.js supports them.
+    """
+    if not isinstance(fig, dict):
+        fig = fig.to_plotly_json()
+    if not typed_arrays_supported():
+        return fig
+    return {**fig, "data": [_pack_trace(trace) for trace in fig["data"]]}
+
+
+def encode(obj):
+    """Encode an object exactly as Dash does when sending it to the browser."""
+    return to_json_plotly(obj).encode("utf-8")
+
+
+def measure_outputs(outputs_list, values):
+    """Log the encoded size and encode time of each callback output."""
+    stats = []
+    for output, value in zip(outputs_list, values):
+        start = time.perf_counter()
+        size = len(encode(value))
+        elapsed = time.perf_counter() - start
+        name = f"{output['id']}.{output['property']}"
+        stats.append({"output": name, "bytes": size, "encode_seconds": elapsed})
+        logger.info(
+            "Output %s: %d bytes, encoded in %.4fs",
+            name,
+            size,
+            elapsed,
+            extra={"output": name, "bytes": size, "encode_seconds": elapsed},
+        )
+    return stats
@@ -0,0 +1,48 @@
+import logging
+import threading
+from concurrent.futures import Future
+from metrics import Counter
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+COALESCED_CALLS = Counter(
+    "mta_coalesced_calls_total",
+    "Calls by group and role: leaders compute, followers wait for a leader.",
+)
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent calls with the same key: the first caller computes
+    the result and later callers wait for it instead of computing it again.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            COALESCED_CALLS.inc(group=self.group, role="follower")
+            logger.debug("Waiting for in-flight %s %s", self.group, key)
+            return future.result()
+
+        COALESCED_CALLS.inc(group=self.group, role="leader")
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
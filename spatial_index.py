@@ -0,0 +1,276 @@
+import logging
+import os
+import numpy as np
+import pandas as pd
+from metrics import instrument
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+# Side of a grid cell in degrees, about 1 km in New York
+GRID_CELL_DEGREES = float(os.environ.get("MTA_GRID_CELL_DEGREES", 0.01))
+# Maps of more stations than this only get the stations in view, so panning
+# and zooming fetch them from the server
+VIEWPORT_MIN_POINTS = int(os.environ.get("MTA_VIEWPORT_MIN_POINTS", 1000))
+# Below this zoom level the stations in view are drawn as clusters
+CLUSTER_MAX_ZOOM = float(os.environ.get("MTA_CLUSTER_MAX_ZOOM", 11))
+# Width of the screen area whose stations are merged into one cluster
+CLUSTER_PIXELS = 60
+# Stations listed by the nearest-stations lookup
+NEAREST_STATIONS = int(os.environ.get("MTA_NEAREST_STATIONS", 5))
+
+KM_PER_DEGREE = 111.32
+TILE_PIXELS = 256
+# Map size assumed for the first figure, before the browser reports its view
+INITIAL_VIEW_PIXELS = (1600, 600)
+INITIAL_ZOOM = 11
+
+# Index of the stations of the loaded data, see register_station_index
+_station_index = None
+
+
+class GridIndex:
+    """
+    Uniform grid over latitude and longitude. Points are sorted by cell, row
+    by row, so the points of a run of cells in one grid row are one slice.
+    """
+
+    def __init__(self, latitudes, longitudes, cell=GRID_CELL_DEGREES):
+        self.lat = np.asarray(latitudes, dtype=float)
+        self.lon = np.asarray(longitudes, dtype=float)
+        self.cell = cell
+        self.lat0 = self.lat.min() if len(self.lat) else 0.0
+        self.lon0 = self.lon.min() if len(self.lon) else 0.0
+        rows, cols = self._row(self.lat), self._col(self.lon)
+        self.n_rows = int(rows.max()) + 1 if len(rows) else 1
+        self.n_cols = int(cols.max()) + 1 if len(cols) else 1
+        keys = rows * self.n_cols + cols
+        self.order = np.argsort(keys, kind="stable")
+        # Points of cell k are order[starts[k]:starts[k + 1]]
+        self.starts = np.searchsorted(
+            keys[self.order], np.arange(self.n_rows * self.n_cols + 1)
+        )
+
+    def __len__(self):
+        return len(self.lat)
+
+    def _row(self, lat):
+        return np.floor((np.asarray(lat) - self.lat0) / self.cell).astype(np.int64)
+
+    def _col(self, lon):
+        return np.floor((np.asarray(lon) - self.lon0) / self.cell).astype(np.int64)
+
+    def _block(self, row_lo, row_hi, col_lo, col_hi):
+        """Positions of the points in a block of cells, bounds included."""
+        row_lo, row_hi = max(row_lo, 0), min(row_hi, self.n_rows - 1)
+        col_lo, col_hi = max(col_lo, 0), min(col_hi, self.n_cols - 1)
+        if row_lo > row_hi or col_lo > col_hi:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(
+            [
+                self.order[
+                    self.starts[row * self.n_cols + col_lo] : self.starts[
+                        row * self.n_cols + col_hi + 1
+                    ]
+                ]
+                for row in range(row_lo, row_hi + 1)
+            ]
+        )
+
+    def within(self, west, south, east, north):
+        """Positions of the points inside a bounding box, in ascending order."""
+        candidates = self._block(
+            int(self._row(south)),
+            int(self._row(north)),
+            int(self._col(west)),
+            int(self._col(east)),
+        )
+        lat, lon = self.lat[candidates], self.lon[candidates]
+        inside = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+        return np.sort(candidates[inside])
+
+    def distances(self, positions, lat, lon):
+        """Equirectangular distances in km from a location to some points."""
+        dy = self.lat[positions] - lat
+        dx = (self.lon[positions] - lon) * np.cos(np.radians(lat))
+        return np.hypot(dx, dy) * KM_PER_DEGREE
+
+    def nearest(self, lat, lon, k=NEAREST_STATIONS):
+        """
+        Positions of the k points nearest to a location and their distances in
+        km, nearest first. Rings of cells around the location are searched
+        until the k-th nearest point found is closer than any point beyond them.
+        """
+        k = min(k, len(self))
+        row, col = int(self._row(lat)), int(self._col(lon))
+        # Smallest distance covered by one cell, in km
+        cell_km = self.cell * min(1.0, np.cos(np.radians(lat))) * KM_PER_DEGREE
+        radius = 0
+        while True:
+            candidates = self._block(
+                row - radius, row + radius, col - radius, col + radius
+            )
+            covers_grid = (
+                row - radius <= 0
+                and col - radius <= 0
+                and row + radius >= self.n_rows - 1
+                and col + radius >= self.n_cols - 1
+            )
+            if len(candidates) >= k:
+                distances = self.distances(candidates, lat, lon)
+                if k == 0 or np.partition(distances, k - 1)[k - 1] <= radius * cell_km:
+                    break
+            if covers_grid:
+                distances = self.distances(candidates, lat, lon)
+                break
+            radius += 1
+        nearest = np.argsort(distances, kind="stable")[:k]
+        return candidates[nearest], distances[nearest]
+
+
+def cluster_labels(latitudes, longitudes, zoom):
+    """
+    Label points by the cluster they fall in at a zoom level: the map is cut
+    into squares of CLUSTER_PIXELS screen pixels at that zoom.
+    """
+    size = CLUSTER_PIXELS * 360 / (TILE_PIXELS * 2**zoom)
+    cells = np.column_stack(
+        [np.floor(latitudes / size), np.floor(longitudes / size)]
+    ).astype(np.int64)
+    return np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+
+
+class StationIndex:
+    """Grid index over the stations of get_stations, looked up by name."""
+
+    def __init__(self, stations_df):
+        stations = stations_df.dropna(subset=["latitude", "longitude"])
+        self.names = stations["station_complex"].to_numpy()
+        self.grid = GridIndex(stations["latitude"], stations["longitude"])
+
+    def __len__(self):
+        return len(self.names)
+
+    def in_view(self, viewport):
+        """Names of the stations inside a viewport's bounding box."""
+        return self.names[self.grid.within(*viewport["bounds"])]
+
+    def nearest(self, lat, lon, k=NEAREST_STATIONS):
+        """The k stations nearest to a location as (name, distance in km)."""
+        positions, distances = self.grid.nearest(lat, lon, k)
+        return list(zip(self.names[positions], distances.round(2)))
+
+
+@instrument
+def build_station_index(stations_df):
+    return StationIndex(stations_df)
+
+
+def register_station_index(index):
+    """Make a station index available to the map's viewport queries."""
+    global _station_index
+    _station_index = index
+
+
+def get_station_index(stations_df=None):
+    """The registered station index, or an index built over stations_df."""
+    if _station_index is None and stations_df is not None:
+        return build_station_index(stations_df)
+    return _station_index
+
+
+def parse_viewport(relayout_data):
+    """
+    Bounds as (west, south, east, north) and zoom of a map view from a
+    graph's relayoutData, or None when it does not describe a map view.
+    Plotly reports the corners of the view under "<subplot>._derived".
+    """
+    if not relayout_data:
+        return None
+    derived = next(
+        (value for key, value in relayout_data.items() if key.endswith("._derived")),
+        None,
+    )
+    zoom = next(
+        (value for key, value in relayout_data.items() if key.endswith(".zoom")),
+        None,
+    )
+    if not derived or zoom is None:
+        return None
+    lon, lat = np.asarray(derived["coordinates"], dtype=float).T
+    return {
+        "bounds": (lon.min(), lat.min(), lon.max(), lat.max()),
+        "zoom": float(zoom),
+    }
+
+
+def initial_viewport(stations_df):
+    """
+    Approximate view of a map centered on the stations at INITIAL_ZOOM, as
+    plotly express centers it, for the first figure of a large map.
+    """
+    lat, lon = stations_df["latitude"].mean(), stations_df["longitude"].mean()
+    degrees_per_pixel = 360 / (TILE_PIXELS * 2**INITIAL_ZOOM)
+    half_width = INITIAL_VIEW_PIXELS[0] / 2 * degrees_per_pixel
+    half_height = (
+        INITIAL_VIEW_PIXELS[1] / 2 * degrees_per_pixel * np.cos(np.radians(lat))
+    )
+    return {
+        "bounds": (
+            lon - half_width,
+            lat - half_height,
+            lon + half_width,
+            lat + half_height,
+        ),
+        "zoom": INITIAL_ZOOM,
+    }
+
+
+def cluster_stations(stations_df, zoom):
+    """
+    Merge the stations near each other at a zoom level into clusters, with
+    the columns plot_station_map_view draws: the centroid, the number of
+    stations and their total ridership. Single stations are kept as they are.
+    """
+    labels = cluster_labels(
+        stations_df["latitude"].to_numpy(), stations_df["longitude"].to_numpy(), zoom
+    )
+    groups = stations_df.groupby(labels)
+    sizes = groups["station_complex"].transform("size").to_numpy()
+    clusters = groups.agg(
+        latitude=("latitude", "mean"),
+        longitude=("longitude", "mean"),
+        borough=("borough", lambda boroughs: ", ".join(sorted(set(boroughs)))),
+        ridership=("ridership", "sum"),
+        stations=("station_complex", "size"),
+    )
+    clusters = clusters[clusters["stations"] > 1]
+    clusters = clusters.assign(
+        station_complex=clusters["stations"].map("{} stations".format),
+        station_complex_id=-1,
+        # Marker area grows with the number of stations
+        station_size=7 * np.sqrt(clusters["stations"]),
+        line_color="cluster",
+        line="Clusters",
+    ).drop(columns="stations")
+    return pd.concat(
+        [stations_df[sizes == 1], clusters[stations_df.columns]], ignore_index=True
+    )
+
+
+@instrument
+def stations_in_view(stations_df, viewport):
+    """
+    The stations of stations_df to draw in a map view: those in its bounds,
+    clustered below CLUSTER_MAX_ZOOM.
+    """
+    index = get_station_index(stations_df)
+    in_view = stations_df[stations_df["station_complex"].isin(index.in_view(viewport))]
+    if viewport["zoom"] < CLUSTER_MAX_ZOOM:
+        in_view = cluster_stations(in_view, viewport["zoom"])
+    logger.debug(
+        "Drawing %d of %d stations at zoom %.1f",
+        len(in_view),
+        len(stations_df),
+        viewport["zoom"],
+    )
+    return in_view
@@ -0,0 +1,40 @@
+from helper import generate_time_blocks
+from metrics import instrument
+from visualizer import DAY_ORDER
+
+
+@instrument
+def build_station_series(data):
+    """
+    Build compact per-station ridership arrays (by day of week, time block and
+    hour of day), sent to the browser once per loaded range. Clientside
+    callbacks draw the station charts and station details from them.
+    """
+    if "station_series" in data:
+        # Built by the query service in remote-backend mode
+        return data["station_series"]
+    df = data["filtered_df"]
+    stations = data["station_stats_df"]["Station"]
+
+    def profile(column, order):
+        return (
+            df.groupby(["station_complex", column])["ridership"]
+            .sum()
+            .unstack(fill_value=0)
+            .reindex(index=stations, columns=order, fill_value=0)
+            .to_numpy()
+            .tolist()
+        )
+
+    time_blocks = generate_time_blocks()
+    return {
+        "stations": stations.tolist(),
+        # Row of each station in the arrays and in the stations stats table,
+        # so the browser looks stations up by key instead of scanning
+        "positions": {station: i for i, station in enumerate(stations)},
+        "days": DAY_ORDER,
+        "time_blocks": time_blocks,
+        "daily": profile("day", DAY_ORDER),
+        "time_block": profile("time_block", time_blocks),
+        "hourly": profile("hour", list(range(24))),
+    }
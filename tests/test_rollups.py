@@ -0,0 +1,51 @@
+import pandas as pd
+import pytest
+import disk_cache
+from benchmarks.synthetic import make_ridership
+from data import AGGREGATIONS, clean_data, get_processed_data
+from rollups import build_rollups, register_rollups
+
+VERSION = "test-rollups"
+RANGES = [
+    # Whole months, days and edge hours
+    ("2024-10-29 05:00:00", "2024-12-03 17:00:00"),
+    # Whole days only
+    ("2024-11-04 00:00:00", "2024-11-10 23:00:00"),
+    # Less than a day, read from the station-hour totals
+    ("2024-11-12 07:00:00", "2024-11-12 19:00:00"),
+]
+
+
+@pytest.fixture(scope="module", params=[False, True], ids=["hourly", "fares"])
+def ridership_df(request):
+    """
+    Synthetic data whose station names collide once their lines are dropped,
+    as "86 St (R)" and "86 St (4,5,6)" do, with or without fare classes.
+    """
+    fare_classes = request.param
+    hours = 24 * (7 if fare_classes else 40)
+    rows = 60 * hours * (12 if fare_classes else 1)
+    start = "2024-11-08" if fare_classes else "2024-10-28"
+    df = clean_data(make_ridership(rows, 60, start=start, fare_classes=fare_classes))
+    return df.reset_index(drop=True)
+
+
+def test_station_names_collide(ridership_df):
+    stations = ridership_df.drop_duplicates("station_complex_id")
+    assert stations["station_complex"].duplicated().any()
+
+
+@pytest.mark.parametrize("start_date, end_date", RANGES)
+def test_rollups_match_hourly_rows(ridership_df, start_date, end_date, monkeypatch):
+    monkeypatch.setattr(disk_cache, "DISK_CACHE", False)
+    register_rollups(VERSION, build_rollups(ridership_df), ridership_df)
+
+    expected = get_processed_data(ridership_df, start_date, end_date)
+    actual = get_processed_data(ridership_df, start_date, end_date, version=VERSION)
+
+    for keys, _ in AGGREGATIONS:
+        for key in keys:
+            if isinstance(expected[key], pd.DataFrame):
+                pd.testing.assert_frame_equal(actual[key], expected[key], obj=key)
+            else:
+                assert actual[key] == expected[key], key
@@ -1,15 +1,76 @@
 import plotly.express as px
+import plotly.io as pio
 import logging
 from helper import create_buttons, add_bars_to_figure
 import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from metrics import instrument
+from serializer import pack_figure, typed_arrays_supported
+from disk_cache import load_results, store_results
+from single_flight import SingleFlight
+from spatial_index import (
+    CLUSTER_MAX_ZOOM,
+    VIEWPORT_MIN_POINTS,
+    initial_viewport,
+    stations_in_view,
+)
 
 logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
 
+# Build figures "serial" or in a "process" pool returning figure dicts
+PLOT_MODE = os.environ.get("MTA_PLOT_MODE", "serial")
+PLOT_WORKERS = int(os.environ.get("MTA_PLOT_WORKERS", os.cpu_count()))
+# Emit the station-level figures as plain dicts, skipping go.Figure validation
+FAST_FIGURES = os.environ.get("MTA_FAST_FIGURES", "0") == "1"
+# Keys whose series are switched by clientside callbacks rather than by
+# hidden traces and dropdown buttons in the figure
+CLIENTSIDE_KEYS = {"station_complex"}
+# Draw the trend chart and station map with "svg"/Mapbox traces, "webgl"
+# (Scattergl and MapLibre) traces, or pick by number of points with "auto"
+RENDER_MODE = os.environ.get("MTA_RENDER_MODE", "auto")
+# Points from which "auto" draws the trend chart with Scattergl. In
+# benchmarks/render_results.json SVG was faster at every size measured, up
+# to 262,800 points, so the default lies just past that range
+WEBGL_MIN_POINTS = int(os.environ.get("MTA_WEBGL_MIN_POINTS", 300_000))
+# Stations from which "auto" draws the map with MapLibre. It was faster than
+# Mapbox GL at every size measured, from 100 stations
+MAP_WEBGL_MIN_POINTS = int(os.environ.get("MTA_MAP_WEBGL_MIN_POINTS", 0))
 
-def plot_hourly_ridership(hourly_ridership_df):
+DAY_ORDER = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+
+_plot_pool = None
+# Concurrent requests for the same range share one set of figures
+_plot_flights = SingleFlight("plots")
+_template_dict = None
+
+
+def use_webgl(points, render_mode=None, min_points=None):
+    """Whether a figure with this many points is drawn with WebGL traces."""
+    render_mode = render_mode or RENDER_MODE
+    if render_mode == "auto":
+        return points >= (WEBGL_MIN_POINTS if min_points is None else min_points)
+    return render_mode == "webgl"
+
+
+@instrument
+def plot_hourly_ridership(hourly_ridership_df, render_mode=None):
     columns_to_plot = [
         col for col in hourly_ridership_df.columns if col != "transit_timestamp"
     ]
+    webgl = use_webgl(len(hourly_ridership_df) * len(columns_to_plot), render_mode)
     fig = px.line(
         hourly_ridership_df,
         x="transit_timestamp",
@@ -19,6 +80,7 @@ def plot_hourly_ridership(hourly_ridership_df):
             "value": "No of riders",
             "variable": "Borough",
         },
+        render_mode="webgl" if webgl else "svg",
     )
     fig.for_each_trace(
         lambda t: (
@@ -30,8 +92,95 @@ def plot_hourly_ridership(hourly_ridership_df):
     return fig
 
 
-def plot_weekly_ridership(weekly_ridership_df, key):
+@instrument
+def bar_figure_dict(df, key, x_col, x_title, category_order, label):
+    """
+    Build the same dropdown bar figure as px.bar and add_bars_to_figure, but as
+    a plain figure dict so Plotly's per-property validation is skipped.
+    """
+    total_data = df.groupby(x_col)["total_ridership"].sum()
+    hovertemplate = f"{x_title}=%{{x}}<br>Number of Riders=%{{y}}<extra></extra>"
+    traces = [
+        {
+            "type": "bar",
+            "x": total_data.index.to_numpy(),
+            "y": total_data.to_numpy(),
+            "alignmentgroup": "True",
+            "offsetgroup": "",
+            "hovertemplate": hovertemplate,
+            "legendgroup": "",
+            "marker": {"color": "#636efa", "pattern": {"shape": ""}},
+            "name": "",
+            "orientation": "v",
+            "showlegend": False,
+            "textposition": "auto",
+            "xaxis": "x",
+            "yaxis": "y",
+        }
+    ]
+
+    unique_keys = []
+    if key not in CLIENTSIDE_KEYS:
+        for value, group in df.groupby(key, sort=False):
+            unique_keys.append(value)
+            traces.append(
+                {
+                    "type": "bar",
+                    "x": group[x_col].to_numpy(),
+                    "y": group["total_ridership"].to_numpy(),
+                    "name": value,
+                    "visible": False,
+                }
+            )
+
+    layout = {
+        "template": _plotly_template(),
+        "xaxis": {
+            "anchor": "y",
+            "domain": [0.0, 1.0],
+            "title": {"text": x_title},
+            "categoryorder": "array",
+            "categoryarray": category_order,
+        },
+        "yaxis": {
+            "anchor": "x",
+            "domain": [0.0, 1.0],
+            "title": {"text": "Number of Riders"},
+        },
+        "legend": {"tracegroupgap": 0},
+        "margin": {"t": 60},
+        "barmode": "relative",
+    }
+    if unique_keys:
+        layout["updatemenus"] = [
+            {
+                "buttons": create_buttons(unique_keys, label),
+                "direction": "down",
+                "showactive": True,
+                "x": 1.12,
+                "y": 1,
+            }
+        ]
+
+    return {"data": traces, "layout": layout}
+
+
+def _plotly_template():
+    """Return the default Plotly template as a dict, converted once."""
+    global _template_dict
+    if _template_dict is None:
+        _template_dict = pio.templates[pio.templates.default].to_plotly_json()
+    return _template_dict
+
+
+@instrument
+def plot_weekly_ridership(weekly_ridership_df, key, validate=True):
     label = "All Boroughs" if key == "borough" else "All Stations"
+    if not validate:
+        return bar_figure_dict(
+            weekly_ridership_df, key, "day", "Day of the Week", DAY_ORDER, label
+        )
+
     unique_keys = weekly_ridership_df[key].unique()
     total_data = (
         weekly_ridership_df.groupby("day")["total_ridership"].sum().reset_index()
@@ -45,18 +194,10 @@ def plot_weekly_ridership(weekly_ridership_df, key):
             "day": "Day of the Week",
             "total_ridership": "Number of Riders",
         },
-        category_orders={
-            "day": [
-                "Monday",
-                "Tuesday",
-                "Wednesday",
-                "Thursday",
-                "Friday",
-                "Saturday",
-                "Sunday",
-            ]
-        },
+        category_orders={"day": DAY_ORDER},
     )
+    if key in CLIENTSIDE_KEYS:
+        return fig
 
     buttons = create_buttons(unique_keys, label)
     add_bars_to_figure(
@@ -78,8 +219,20 @@ def plot_weekly_ridership(weekly_ridership_df, key):
     return fig
 
 
-def plot_time_block_ridership(time_block_ridership_df, key):
+@instrument
+def plot_time_block_ridership(time_block_ridership_df, key, validate=True):
     label = "All Boroughs" if key == "borough" else "All Stations"
+    category_order = [f"{hour:02d}:00 - {hour+3:02d}:00" for hour in range(0, 24, 3)]
+    if not validate:
+        return bar_figure_dict(
+            time_block_ridership_df,
+            key,
+            "time_block",
+            "Time Block",
+            category_order,
+            label,
+        )
+
     unique_keys = time_block_ridership_df[key].unique()
     total_data = (
         time_block_ridership_df.groupby("time_block")["total_ridership"]
@@ -95,12 +248,10 @@ def plot_time_block_ridership(time_block_ridership_df, key):
             "time_block": "Time Block",
             "total_ridership": "Number of Riders",
         },
-        category_orders={
-            "time_block": [
-                f"{hour:02d}:00 - {hour+3:02d}:00" for hour in range(0, 24, 3)
-            ]
-        },
+        category_orders={"time_block": category_order},
     )
+    if key in CLIENTSIDE_KEYS:
+        return fig
 
     buttons = create_buttons(unique_keys, label)
     add_bars_to_figure(
@@ -122,17 +273,82 @@ def plot_time_block_ridership(time_block_ridership_df, key):
     return fig
 
 
-def plot_station_map_view(stations_df):
+@instrument
+def plot_fare_class_ridership(fare_class_ridership_df):
+    fig = px.bar(
+        fare_class_ridership_df,
+        x="fare_class_category",
+        y="ridership",
+        color="payment_method",
+        labels={
+            "fare_class_category": "Fare Class",
+            "ridership": "Number of Riders",
+            "payment_method": "Payment Method",
+        },
+    )
+    fig.update_layout(xaxis={"categoryorder": "total descending"})
+    return fig
+
+
+@instrument
+def plot_forecast(history_df, forecast_df):
+    """Actual ridership of the last weeks and the forecasts of the next."""
+    series = pd.concat(
+        [
+            history_df.rename(columns={"ridership": "Actual"}),
+            forecast_df.rename(
+                columns={"seasonal_naive": "Seasonal naive", "ridge": "Regression"}
+            ).dropna(axis=1, how="all"),
+        ],
+        ignore_index=True,
+    )
+    fig = px.line(
+        series,
+        x="transit_timestamp",
+        y=[column for column in series.columns if column != "transit_timestamp"],
+        labels={
+            "transit_timestamp": "Time",
+            "value": "No of riders",
+            "variable": "Series",
+        },
+    )
+    fig.for_each_trace(
+        lambda t: t.update(line=dict(dash="dash")) if t.name != "Actual" else None
+    )
+    return fig
+
+
+@lru_cache(maxsize=1)
+def _borough_boundaries():
     with open("data/borough_boundaries.geojson", "r") as f:
-        borough_boundaries = json.load(f)
+        return json.load(f)
+
+
+@instrument
+def plot_station_map_view(stations_df, render_mode=None, viewport=None):
+    """
+    Station map. Maps of more than VIEWPORT_MIN_POINTS stations only draw
+    the stations in a viewport (see spatial_index.parse_viewport), or in the
+    initial view when none is given, clustered at low zoom.
+    """
+    borough_boundaries = _borough_boundaries()
     # Ensure required columns exist
     required_cols = {"latitude", "longitude", "station_complex"}
     if not required_cols.issubset(stations_df.columns):
         raise ValueError(
             f"Missing required columns: {required_cols - set(stations_df.columns)}"
         )
+    if viewport is None and len(stations_df) > VIEWPORT_MIN_POINTS:
+        viewport = initial_viewport(stations_df)
+    if viewport is not None:
+        stations_df = stations_in_view(stations_df, viewport)
 
-    station_map = px.scatter_mapbox(
+    # scatter_map draws with MapLibre, scatter_mapbox with Mapbox GL
+    webgl = use_webgl(len(stations_df), render_mode, MAP_WEBGL_MIN_POINTS)
+    scatter, subplot = (
+        (px.scatter_map, "map") if webgl else (px.scatter_mapbox, "mapbox")
+    )
+    station_map = scatter(
         stations_df,
         lat="latitude",
         lon="longitude",
@@ -149,19 +365,25 @@ def plot_station_map_view(stations_df):
         zoom=11,
         height=600,
         size="station_size",
-        size_max=7,
+        # Single stations keep a 7px marker next to larger clusters
+        size_max=7
+        * np.sqrt(np.max(stations_df["station_size"].to_numpy(), initial=7) / 7),
         color="line_color",
     )
 
     station_map.update_layout(
-        mapbox_layers=[
-            {
-                "source": borough_boundaries,
-                "type": "line",
-                "color": "gray",
-                "line": {"width": 1},
+        {
+            subplot: {
+                "layers": [
+                    {
+                        "source": borough_boundaries,
+                        "type": "line",
+                        "color": "gray",
+                        "line": {"width": 1},
+                    }
+                ]
             }
-        ],
+        }
     )
 
     # Update legend values to use the "line" column
@@ -178,36 +400,138 @@ def plot_station_map_view(stations_df):
     )
 
     station_map.update_layout(
-        mapbox_style="carto-positron",
+        {subplot: {"style": "carto-positron"}},
         margin={"r": 0, "t": 40, "l": 0, "b": 0},
         legend_title={"text": "Lines"},
     )
 
     # Add click event handling
     station_map.update_traces(
-        marker=dict(opacity=0.7), selector=dict(type="scattermapbox")
+        marker=dict(opacity=0.7), selector=dict(type=f"scatter{subplot}")
     )
-    station_map.update_layout(clickmode="event+select")
+    # Keep the user's pan and zoom when the figure is replaced
+    station_map.update_layout(clickmode="event+select", uirevision="station-map")
 
     return station_map
 
 
-def get_all_plots(data):
-    plots = {}
+def _plot_jobs(data):
+    """List the figures to build as (name, plot function, arguments)."""
+    validate = not FAST_FIGURES
+    return [
+        (
+            "hourly_ridership_plot",
+            plot_hourly_ridership,
+            (data["hourly_ridership_df"],),
+        ),
+        (
+            "weekly_ridership_plot",
+            plot_weekly_ridership,
+            (data["weekly_ridership_df"], "borough"),
+        ),
+        (
+            "station_weekly_ridership_plot",
+            plot_weekly_ridership,
+            (data["station_weekly_ridership_df"], "station_complex", validate),
+        ),
+        (
+            "time_block_ridership_plot",
+            plot_time_block_ridership,
+            (data["time_block_ridership_df"], "borough"),
+        ),
+        (
+            "station_time_block_ridership_plot",
+            plot_time_block_ridership,
+            (data["stations_time_block_ridership_df"], "station_complex", validate),
+        ),
+        ("station_map_view", plot_station_map_view, (data["stations_df"],)),
+        (
+            "fare_class_ridership_plot",
+            plot_fare_class_ridership,
+            (data["fare_class_ridership_df"],),
+        ),
+    ]
 
-    plots["hourly_ridership_plot"] = plot_hourly_ridership(data["hourly_ridership_df"])
-    plots["weekly_ridership_plot"] = plot_weekly_ridership(
-        data["weekly_ridership_df"], "borough"
-    )
-    plots["station_weekly_ridership_plot"] = plot_weekly_ridership(
-        data["station_weekly_ridership_df"], "station_complex"
-    )
-    plots["time_block_ridership_plot"] = plot_time_block_ridership(
-        data["time_block_ridership_df"], "borough"
-    )
-    plots["station_time_block_ridership_plot"] = plot_time_block_ridership(
-        data["stations_time_block_ridership_df"], "station_complex"
+
+def _timed_plot(func, args, serialize=False):
+    """Build a figure and return it with the elapsed time."""
+    start = time.perf_counter()
+    fig = func(*args)
+    if serialize and not isinstance(fig, dict):
+        fig = fig.to_plotly_json()
+    return fig, time.perf_counter() - start
+
+
+def _get_plot_pool():
+    """Return the process pool used for figure building, created on first use."""
+    global _plot_pool
+    if _plot_pool is None:
+        _plot_pool = ProcessPoolExecutor(PLOT_WORKERS)
+    return _plot_pool
+
+
+@instrument
+def get_all_plots(data, mode=None):
+    """
+    Build all figures. In process mode each figure is built in a worker
+    process and returned as a serialized figure dict. Figures for a cached
+    date range are read from the disk cache as packed figure dicts.
+    """
+    cache_key = data.get("cache_key")
+    if cache_key:
+        cache_key = (
+            *cache_key,
+            typed_arrays_supported(),
+            RENDER_MODE,
+            WEBGL_MIN_POINTS,
+            MAP_WEBGL_MIN_POINTS,
+            VIEWPORT_MIN_POINTS,
+            CLUSTER_MAX_ZOOM,
+        )
+        return _plot_flights.do(cache_key, _get_cached_plots, data, mode, cache_key)
+    return _build_plots(data, mode)
+
+
+def _get_cached_plots(data, mode, cache_key):
+    plots = load_results("plots", *cache_key)
+    if plots is None:
+        # Packed once here, so callers' pack_figure calls are cheap
+        plots = {
+            name: pack_figure(fig) for name, fig in _build_plots(data, mode).items()
+        }
+        store_results("plots", plots, *cache_key)
+    return plots
+
+
+def _build_plots(data, mode):
+    mode = mode or PLOT_MODE
+    jobs = _plot_jobs(data)
+
+    start = time.perf_counter()
+    if mode == "serial":
+        results = [_timed_plot(func, args) for _, func, args in jobs]
+    elif mode == "process":
+        pool = _get_plot_pool()
+        futures = [pool.submit(_timed_plot, func, args, True) for _, func, args in jobs]
+        results = [future.result() for future in futures]
+    else:
+        raise ValueError(f"Unknown plot mode: {mode}")
+
+    plots = {}
+    for (name, _, _), (fig, elapsed) in zip(jobs, results):
+        logger.debug(
+            "%s took %.3fs",
+            name,
+            elapsed,
+            extra={"stage": name, "duration_ms": round(elapsed * 1000, 3)},
+        )
+        plots[name] = fig
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "Plots (%s) took %.3fs",
+        mode,
+        elapsed,
+        extra={"stage": "plots", "duration_ms": round(elapsed * 1000, 3)},
     )
-    plots["station_map_view"] = plot_station_map_view(data["stations_df"])
 
     return plots
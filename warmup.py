@@ -0,0 +1,206 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+import pandas as pd
+from flask import g, request
+from helper import normalize_range
+from metrics import Counter as MetricCounter
+from data import get_processed_data
+from visualizer import get_all_plots
+import disk_cache
+
+logger = logging.getLogger("MTA_Subway_Ridership_Dashboard")
+
+WARMUP = os.environ.get("MTA_WARMUP", "1") == "1"
+# Comma-separated: full, last_7_days, weeks, months or explicit START:END dates
+WARMUP_RANGES = os.environ.get("MTA_WARMUP_RANGES", "full,last_7_days,weeks,months")
+# Number of the most requested ranges warmed on top of the configured ones
+WARMUP_TOP_N = int(os.environ.get("MTA_WARMUP_TOP_N", 10))
+# Seconds between warm-up passes, which pick up newly popular ranges
+WARMUP_INTERVAL = float(os.environ.get("MTA_WARMUP_INTERVAL", 600))
+# Fraction of the time warm-up may be busy; it sleeps for the rest
+WARMUP_DUTY_CYCLE = float(os.environ.get("MTA_WARMUP_DUTY_CYCLE", 0.25))
+# Seconds without callbacks in flight before warm-up computes the next range
+IDLE_SECONDS = float(os.environ.get("MTA_WARMUP_IDLE_SECONDS", 2))
+
+POPULAR_RANGES_FILE = os.path.join(disk_cache.CACHE_DIR, "popular_ranges.json")
+
+WARMUP_RANGES_TOTAL = MetricCounter(
+    "mta_warmup_ranges_total", "Date ranges handled by warm-up, by result."
+)
+
+_requested_ranges = Counter()
+_lock = threading.Lock()
+_in_flight = 0
+_last_request = 0.0
+
+
+def record_range(start_date, end_date):
+    """Count a requested date range so popular ranges are warmed next time."""
+    with _lock:
+        _requested_ranges[normalize_range(start_date, end_date)] += 1
+
+
+def load_popular_ranges():
+    try:
+        with open(POPULAR_RANGES_FILE) as f:
+            counts = json.load(f)
+    except (OSError, ValueError):
+        return
+    with _lock:
+        for start, end, count in counts:
+            _requested_ranges[(start, end)] += count
+
+
+def save_popular_ranges():
+    with _lock:
+        counts = [[*key, count] for key, count in _requested_ranges.most_common(100)]
+    try:
+        os.makedirs(disk_cache.CACHE_DIR, exist_ok=True)
+        with open(POPULAR_RANGES_FILE, "w") as f:
+            json.dump(counts, f)
+    except OSError as e:
+        logger.warning("Could not save popular ranges: %s", e)
+
+
+def configured_ranges(default_dates, spec=WARMUP_RANGES):
+    """Expand the warm-up range spec into (start, end) dates as the pickers send them."""
+    first, last = (pd.Timestamp(date) for date in default_dates)
+    first_day, last_day = first.normalize(), last.normalize()
+    ranges = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        if item == "full":
+            ranges.append((first, last))
+        elif item == "last_7_days":
+            ranges.append((max(last_day - pd.Timedelta(days=6), first_day), last_day))
+        elif item == "weeks":
+            for monday in pd.date_range(first_day - pd.Timedelta(days=6), last_day):
+                if monday.dayofweek == 0:
+                    ranges.append((monday, monday + pd.Timedelta(days=6)))
+        elif item == "months":
+            for month in pd.period_range(first_day, last_day, freq="M"):
+                ranges.append((month.start_time, month.end_time.normalize()))
+        elif ":" in item:
+            start, end = item.split(":", 1)
+            ranges.append((pd.Timestamp(start), pd.Timestamp(end)))
+        else:
+            logger.warning("Unknown warm-up range %r", item)
+    return [normalize_range(start, end) for start, end in ranges]
+
+
+def popular_ranges(n=WARMUP_TOP_N):
+    with _lock:
+        return [key for key, _ in _requested_ranges.most_common(n)]
+
+
+def _wait_until_idle():
+    """Block while callbacks are in flight or were until recently."""
+    while True:
+        with _lock:
+            busy = _in_flight or time.monotonic() - _last_request < IDLE_SECONDS
+        if not busy:
+            return
+        time.sleep(IDLE_SECONDS / 4)
+
+
+def _lower_thread_priority():
+    """Give the warm-up thread the lowest scheduling priority where supported."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+def warm_range(ridership_df, version, start_date, end_date):
+    """Compute and cache the data and figures of one range unless already cached."""
+    key = (version, start_date, end_date)
+    if disk_cache.contains("aggregations", *key):
+        WARMUP_RANGES_TOTAL.inc(result="cached")
+        return False
+    _wait_until_idle()
+    data = get_processed_data(ridership_df, start_date, end_date, version=version)
+    _wait_until_idle()
+    get_all_plots(data)
+    WARMUP_RANGES_TOTAL.inc(result="computed")
+    return True
+
+
+def run_warmup_pass(data):
+    """Warm the configured and the most requested ranges, throttling between them."""
+    ranges = configured_ranges(data["dates"]) + popular_ranges()
+    start = time.perf_counter()
+    computed = 0
+    for start_date, end_date in dict.fromkeys(ranges):
+        job_start = time.perf_counter()
+        try:
+            computed += warm_range(
+                data["ridership_df"], data["version"], start_date, end_date
+            )
+        except Exception:
+            WARMUP_RANGES_TOTAL.inc(result="error")
+            logger.warning(
+                "Warm-up of %s - %s failed", start_date, end_date, exc_info=True
+            )
+        busy = time.perf_counter() - job_start
+        time.sleep(busy * (1 / WARMUP_DUTY_CYCLE - 1))
+    save_popular_ranges()
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "Warm-up computed %d of %d ranges in %.3fs",
+        computed,
+        len(ranges),
+        elapsed,
+        extra={"stage": "warmup", "duration_ms": round(elapsed * 1000, 3)},
+    )
+
+
+def _run(data):
+    _lower_thread_priority()
+    while True:
+        run_warmup_pass(data)
+        time.sleep(WARMUP_INTERVAL)
+
+
+def register_warmup(app, data, tracked_paths=None):
+    """
+    Track requests in flight on a Dash app's or Flask server so warm-up only
+    runs when it is idle, and start the background warm-up thread. A Dash
+    app tracks its callbacks under its routes_pathname_prefix and the export
+    and heatmap routes of its server.
+    """
+    server = getattr(app, "server", app)
+    if tracked_paths is None:
+        tracked_paths = (
+            app.config.routes_pathname_prefix + "_dash-update-component",
+            "/export/",
+            "/heatmap/",
+        )
+    load_popular_ranges()
+    atexit.register(save_popular_ranges)
+    if not (WARMUP and disk_cache.DISK_CACHE):
+        logger.info("Cache warm-up disabled.")
+        return None
+
+    @server.before_request
+    def track_callback_start():
+        global _in_flight
+        if request.path.startswith(tracked_paths):
+            g.warmup_tracked = True
+            with _lock:
+                _in_flight += 1
+
+    @server.teardown_request
+    def track_callback_end(exc):
+        global _in_flight, _last_request
+        if g.pop("warmup_tracked", False):
+            with _lock:
+                _in_flight -= 1
+                _last_request = time.monotonic()
+
+    thread = threading.Thread(target=_run, args=(data,), name="warmup", daemon=True)
+    thread.start()
+    return thread